@@ -0,0 +1,199 @@
+"""
+Matching of recipient addresses against many local address rules.
+
+Rules are classified when added, so that the cost of a lookup does not grow with the number of rules:
+  user@example.com   exact address, one hash lookup
+  @example.com       the domain and its subdomains, one hash lookup per label of the recipient's domain
+  anything else      literal substring, one pass of an Aho-Corasick automaton over the address
+
+Matching is case insensitive. An exact address wins over a domain, a more specific domain over a less specific one
+and domains over substrings; among substrings the leftmost, then the longest, wins.
+
+Rules are added while configuring, then `build` prepares the automaton once. Matching only reads the index, so any
+number of parser threads can match concurrently.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+TRUE_VALUES = ('yes', '1', 'true')
+
+
+class SubstringAutomaton(object):
+    """
+    Aho-Corasick automaton finding the leftmost longest of many literal strings in a single pass over the text.
+    """
+
+    def __init__(self):
+        self.goto = [dict()]  # state -> {char -> state}
+        self.fail = [0]  # state -> state of the longest proper suffix
+        self.depth = [0]  # state -> length of the prefix it represents
+        self.output = [None]  # state -> pattern ending in the state
+        self.next_output = [0]  # state -> nearest suffix state with an output
+        self.patterns = 0
+        self.built = True
+
+    def __len__(self):
+        return self.patterns
+
+    def add(self, pattern):
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append(dict())
+                self.fail.append(0)
+                self.depth.append(self.depth[state] + 1)
+                self.output.append(None)
+                self.next_output.append(0)
+            state = next_state
+        if self.output[state] is None:
+            self.patterns += 1
+        self.output[state] = pattern
+        self.built = False
+
+    def build(self):
+        """
+        Computes failure links breadth first, so links of shorter prefixes are ready when longer ones need them
+        :return: None
+        """
+        goto, fail, output, next_output = self.goto, self.fail, self.output, self.next_output
+        queue = goto[0].values()
+        for state in queue:
+            fail[state] = 0
+            next_output[state] = 0
+        for state in queue:
+            for char, next_state in goto[state].iteritems():
+                queue.append(next_state)
+                link = fail[state]
+                while link and char not in goto[link]:
+                    link = fail[link]
+                link = goto[link].get(char, 0)
+                fail[next_state] = link
+                next_output[next_state] = link if output[link] is not None else next_output[link]
+        self.built = True
+
+    def search(self, text):
+        """
+        Only reads the automaton, safe to call from many threads
+        :return: leftmost longest pattern found in text or None
+        :raises RuntimeError: if patterns were added since `build`
+        """
+        if not self.built:
+            raise RuntimeError('Substring automaton used before build()')
+        goto, fail, depth, output, next_output = self.goto, self.fail, self.depth, self.output, self.next_output
+        best = None
+        best_start = 0
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if best is not None and end - depth[state] > best_start:
+                break  # every later match starts right of the best one
+            found = state if output[state] is not None else next_output[state]
+            while found:
+                pattern = output[found]
+                start = end - len(pattern)
+                if best is None or start < best_start or (start == best_start and len(pattern) > len(best)):
+                    best, best_start = pattern, start
+                found = next_output[found]
+        return best
+
+
+class AddressMatcher(object):
+    """
+    Index of local address rules, each carrying a value returned when it matches.
+    """
+
+    def __init__(self):
+        self.addresses = dict()
+        self.domains = dict()
+        self.substrings = SubstringAutomaton()
+        self.substring_values = dict()
+
+    def __len__(self):
+        return len(self.addresses) + len(self.domains) + len(self.substrings)
+
+    def add(self, rule, value):
+        """
+        :param rule: "user@example.com", "@example.com" or a substring
+        :param value: returned by `match` for addresses matching the rule
+        :return: None
+        """
+        rule = rule.strip().lower()
+        if not rule:
+            raise ValueError('Empty local address rule')
+        local, at, domain = rule.rpartition('@')
+        if at and domain and '@' not in local and ' ' not in rule:
+            if local:
+                self.addresses[rule] = (rule, value)
+            else:
+                self.domains[domain] = (rule, value)
+        else:
+            self.substrings.add(rule)
+            self.substring_values[rule] = (rule, value)
+
+    def build(self):
+        """
+        Prepares the index for matching, must be called after rules were added
+        :return: None
+        """
+        self.substrings.build()
+
+    def match(self, address):
+        """
+        :param address: recipient address
+        :return: (rule, value) of the best matching rule or None
+        """
+        address = address.lower()
+        if self.addresses:
+            found = self.addresses.get(address)
+            if found:
+                return found
+        if self.domains:
+            domain = address.rpartition('@')[2]
+            while domain:
+                found = self.domains.get(domain)
+                if found:
+                    return found
+                domain = domain.partition('.')[2]
+        if self.substring_values:
+            pattern = self.substrings.search(address)
+            if pattern is not None:
+                return self.substring_values[pattern]
+        return None
+
+    def add_spec(self, spec):
+        """
+        Adds rule given as "STRING,NAME,COUNT"
+        :return: None
+        """
+        try:
+            rule, name, count = spec.strip().strip('()').split(',')
+        except ValueError:
+            raise ValueError('LOCAL_TUPLE requires 3 fields: {}'.format(spec))
+        self.add(rule, (name.strip(), count.strip().lower() in TRUE_VALUES))
+
+    def load(self, path):
+        """
+        Adds rules from a file with one "STRING,NAME,COUNT" per line, empty lines and lines starting with # are skipped
+        :return: number of rules added
+        """
+        added = 0
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                try:
+                    self.add_spec(line)
+                except ValueError, e:
+                    raise ValueError('{}:{}: {}'.format(path, number, e))
+                added += 1
+        self.build()
+        logger.debug('Loaded %d local address rules from %s', added, path)
+        return added
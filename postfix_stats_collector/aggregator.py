@@ -0,0 +1,465 @@
+"""
+In-process aggregation of StatsD metrics.
+
+Handlers increment counters, set gauges and record timings in memory; a `Flusher` thread ships them through a single
+StatsD pipeline (packed up to STATSD_MAXUDPSIZE by the client) every `interval` seconds, or earlier when
+`max_pending` metrics are waiting to be sent.
+
+With `max_hosts` set, counters are additionally kept per source host of the line being parsed (see `set_host`) and
+sent as "<first part>.hosts.<host>.<rest>", ie. "postfix.hosts.relay1_example_com.messages.bounce". Only the first
+`max_hosts` hosts seen get their own counters, the rest are counted together as "other".
+
+With `top_k` set, heavy hitters offered by `top` (ie. client IPs) are tracked in fixed memory and the `top_k` most
+frequent items of every flush interval are sent as counters "postfix.top.<name>.<item>".
+
+With `quantiles` set, values passed to `observe` are kept in LogHistograms instead of being sent one by one; every
+flush sends gauges "<stat>.p50", "<stat>.p99", ... and "<stat>.max" for values observed in the interval.
+"""
+
+import os
+import time
+import fcntl
+import errno
+import select
+import logging
+from collections import defaultdict
+from threading import Thread, Lock, Event, local
+from postfix_stats_collector.topk import SpaceSaving
+from postfix_stats_collector.quantiles import LogHistogram
+
+logger = logging.getLogger(__name__)
+
+OTHER_HOSTS = 'other'
+
+
+def host_stat(stat, host):
+    """
+    :return: name of the stat counted for a host
+    """
+    head, _, tail = stat.partition('.')
+    return '{}.hosts.{}.{}'.format(head, host, tail)
+
+
+def top_stat(name, item):
+    """
+    :return: name of the stat counting a heavy hitter
+    """
+    return 'postfix.top.{}.{}'.format(name, item.replace('.', '_').replace(':', '_'))
+
+
+def quantile_name(q):
+    """
+    :param q: quantile, ie. 0.99 or 0.999
+    :return: suffix of the stat, ie. "p99" or "p99_9"
+    """
+    return 'p' + ('%g' % (q * 100)).replace('.', '_')
+
+
+class Metrics(object):
+    """
+    Plain container of pending metrics, it can be pickled and sent between processes.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.gauges = dict()
+        self.timers = defaultdict(list)
+        self.hosts = dict()  # host -> counters
+        self.tops = dict()  # name -> SpaceSaving
+        self.top_k = 0  # number of heavy hitters sent per name
+        self.histograms = dict()  # stat -> LogHistogram
+        self.quantiles = ()  # quantiles sent for histograms
+        self.pending = 0  # number of counters, gauges and timing samples
+
+    def host_counters(self, host):
+        counters = self.hosts.get(host)
+        if counters is None:
+            counters = self.hosts[host] = defaultdict(int)
+        return counters
+
+    def merge(self, other, host_key=None):
+        """
+        :param other: Metrics
+        :param host_key: callable mapping hosts of other to hosts of self
+        :return: None
+        """
+        for stat, count in other.counters.iteritems():
+            if stat not in self.counters:
+                self.pending += 1
+            self.counters[stat] += count
+        for host, host_counters in other.hosts.iteritems():
+            counters = self.host_counters(host_key(host) if host_key else host)
+            for stat, count in host_counters.iteritems():
+                if stat not in counters:
+                    self.pending += 1
+                counters[stat] += count
+        for stat, value in other.gauges.iteritems():
+            if stat not in self.gauges:
+                self.pending += 1
+            self.gauges[stat] = value
+        for stat, values in other.timers.iteritems():
+            self.timers[stat].extend(values)
+            self.pending += len(values)
+        for name, summary in other.tops.iteritems():
+            if name in self.tops:
+                self.tops[name].merge(summary)
+            else:
+                self.tops[name] = summary
+        self.top_k = max(self.top_k, other.top_k)
+        for stat, histogram in other.histograms.iteritems():
+            if stat in self.histograms:
+                self.histograms[stat].merge(histogram)
+            else:
+                self.histograms[stat] = histogram
+        self.quantiles = self.quantiles or other.quantiles
+
+    def top(self):
+        """
+        :return: generator of (name, item, count) of heavy hitters to be sent
+        """
+        for name, summary in self.tops.iteritems():
+            for item, count, error in summary.top(self.top_k):
+                yield name, item, count
+
+    def quantile_gauges(self):
+        """
+        :return: generator of (stat, value) of quantiles and max of histograms
+        """
+        for stat, histogram in self.histograms.iteritems():
+            for q, value in zip(self.quantiles, histogram.quantiles(self.quantiles)):
+                yield '{}.{}'.format(stat, quantile_name(q)), round(value, 3)
+            yield stat + '.max', histogram.max
+
+    def send(self, client):
+        """
+        Sends all metrics as one StatsD pipeline
+        :param client: StatsD client
+        :return: number of metrics sent
+        """
+        if self.pending or self.tops or self.histograms:
+            with client.pipeline() as pipe:
+                for stat, count in self.counters.iteritems():
+                    pipe.incr(stat, count)
+                for host, counters in self.hosts.iteritems():
+                    for stat, count in counters.iteritems():
+                        pipe.incr(host_stat(stat, host), count)
+                for name, item, count in self.top():
+                    pipe.incr(top_stat(name, item), count)
+                for stat, value in self.gauges.iteritems():
+                    pipe.gauge(stat, value)
+                for stat, value in self.quantile_gauges():
+                    pipe.gauge(stat, value)
+                for stat, values in self.timers.iteritems():
+                    for value in values:
+                        pipe.timing(stat, value)
+        return self.pending
+
+
+class Wakeup(object):
+    """
+    Event (`set`, `is_set`, `clear`, `wait`) whose waiting thread blocks in the kernel on a self-pipe. On Python 2
+    `threading.Event.wait` with a timeout polls with short sleeps, which keeps waking an idle collector up.
+    """
+
+    def __init__(self):
+        self.flag = False
+        self.lock = Lock()
+        self.pipe = None  # created by the first `wait`, ie. not in every forked worker
+
+    def is_set(self):
+        return self.flag
+
+    def set(self):
+        if self.flag:
+            return
+        with self.lock:
+            if not self.flag:
+                self.flag = True
+                if self.pipe:
+                    os.write(self.pipe[1], '.')  # at most one byte is ever in the pipe
+
+    def clear(self):
+        with self.lock:
+            self.flag = False
+            if self.pipe:
+                try:
+                    os.read(self.pipe[0], 4096)
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+
+    def wait(self, timeout=None):
+        """
+        :param timeout: seconds or None to wait until set
+        :return: True if set
+        """
+        with self.lock:
+            if self.pipe is None:
+                self.pipe = os.pipe()
+                fcntl.fcntl(self.pipe[0], fcntl.F_SETFL, fcntl.fcntl(self.pipe[0], fcntl.F_GETFL) | os.O_NONBLOCK)
+            if self.flag:
+                return True
+        try:
+            select.select([self.pipe[0]], [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+        return self.flag
+
+
+class StatsAggregator(object):
+    """
+    Thread-safe accumulator of metrics.
+    """
+
+    def __init__(self, max_pending=1000, max_hosts=0, top_k=0, top_capacity=1000, quantiles=()):
+        """
+        :param max_pending: number of pending metrics that triggers an early flush
+        :param max_hosts: number of source hosts counted separately, 0 disables counting per host
+        :param top_k: number of heavy hitters sent per name and flush, 0 disables tracking of heavy hitters
+        :param top_capacity: number of items monitored per name
+        :param quantiles: quantiles sent for observed values, ie. (0.5, 0.9, 0.99), empty disables `observe`
+        :return:
+        """
+        self.max_pending = max_pending
+        self.max_hosts = max_hosts
+        self.top_k = top_k
+        self.top_capacity = top_capacity
+        self.quantiles = quantiles
+        self.reset()
+
+    def reset(self):
+        """
+        Drops all pending metrics and recreates synchronisation primitives (ie. in a freshly forked process)
+        :return: None
+        """
+        self.lock = Lock()
+        self.metrics = Metrics()
+        self.flush_needed = Wakeup()
+        self.context = local()
+        self.hosts = dict()  # source host -> host in stat names
+
+    def set_host(self, host):
+        """
+        Sets source host of the line parsed by the calling thread, counters incremented by the thread are counted
+        for the host as well
+        :param host: source host or None
+        :return: None
+        """
+        self.context.host = host
+
+    def set_scale(self, scale):
+        """
+        Sets how many lines each line parsed by the calling thread stands for (see `sampling`), counters and heavy
+        hitters incremented by the thread are multiplied by it
+        :param scale: sampling rate, 1 when all lines are parsed
+        :return: None
+        """
+        self.context.scale = scale
+
+    def host_key(self, host):
+        """
+        Must be called with lock held
+        :return: host as used in stat names, OTHER_HOSTS once max_hosts hosts are known
+        """
+        key = self.hosts.get(host)
+        if key is None:
+            if host == OTHER_HOSTS or len(self.hosts) >= self.max_hosts:
+                return OTHER_HOSTS
+            key = self.hosts[host] = host.replace('.', '_')
+        return key
+
+    def incr(self, stat, count=1):
+        count *= getattr(self.context, 'scale', 1)
+        with self.lock:
+            counters = self.metrics.counters
+            if stat not in counters:
+                self.metrics.pending += 1
+                if self.metrics.pending >= self.max_pending:
+                    self.flush_needed.set()
+            counters[stat] += count
+
+            if self.max_hosts:
+                host = getattr(self.context, 'host', None)
+                if host:
+                    counters = self.metrics.host_counters(self.host_key(host))
+                    if stat not in counters:
+                        self.metrics.pending += 1
+                        if self.metrics.pending >= self.max_pending:
+                            self.flush_needed.set()
+                    counters[stat] += count
+
+    def top(self, name, item, count=1):
+        """
+        Counts an occurrence of item among heavy hitters of the given name
+        :param name: ie. "clients"
+        :param item: ie. client IP
+        :return: None
+        """
+        if not self.top_k:
+            return
+        count *= getattr(self.context, 'scale', 1)
+        with self.lock:
+            summary = self.metrics.tops.get(name)
+            if summary is None:
+                summary = self.metrics.tops[name] = SpaceSaving(self.top_capacity)
+            summary.offer(item, count)
+
+    def observe(self, stat, value):
+        """
+        Adds a value to the histogram of the stat, only quantiles are sent on flush
+        :param stat: name of the stat
+        :param value: non-negative number
+        :return: None
+        """
+        if not self.quantiles:
+            return
+        with self.lock:
+            histogram = self.metrics.histograms.get(stat)
+            if histogram is None:
+                histogram = self.metrics.histograms[stat] = LogHistogram()
+            histogram.add(value)
+
+    def gauge(self, stat, value):
+        """
+        Sets a gauge, only the last value set before flush is sent
+        """
+        with self.lock:
+            gauges = self.metrics.gauges
+            if stat not in gauges:
+                self.metrics.pending += 1
+                if self.metrics.pending >= self.max_pending:
+                    self.flush_needed.set()
+            gauges[stat] = value
+
+    def timing(self, stat, value):
+        """
+        Records a timing sample, all samples are sent on flush
+        :param stat: name of the stat
+        :param value: milliseconds
+        :return: None
+        """
+        with self.lock:
+            self.metrics.timers[stat].append(value)
+            self.metrics.pending += 1
+            if self.metrics.pending >= self.max_pending:
+                self.flush_needed.set()
+
+    def merge(self, metrics):
+        """
+        Adds metrics collected elsewhere (ie. in a worker process)
+        :param metrics: Metrics
+        :return: None
+        """
+        with self.lock:
+            self.metrics.merge(metrics, self.host_key if self.max_hosts else None)
+            if self.metrics.pending >= self.max_pending:
+                self.flush_needed.set()
+
+    def swap(self):
+        """
+        Takes all pending metrics out of the aggregator
+        :return: Metrics
+        """
+        with self.lock:
+            metrics, self.metrics = self.metrics, Metrics()
+        metrics.top_k = self.top_k
+        metrics.quantiles = self.quantiles
+        return metrics
+
+    def dump(self):
+        """
+        Takes pending metrics out of the aggregator for a snapshot
+        :return: Metrics
+        """
+        return self.swap()
+
+    def load(self, metrics):
+        """
+        Adds pending metrics of a snapshot, they are sent with the next flush
+        :param metrics: Metrics
+        :return: None
+        """
+        self.merge(metrics)
+
+    def flush(self, client):
+        """
+        Sends all pending metrics as one StatsD pipeline
+        :param client: StatsD client
+        :return: number of metrics sent
+        """
+        return self.swap().send(client)
+
+
+class Flusher(Thread):
+    """
+    Background thread calling `flush` every `interval` seconds or whenever aggregator asks for it.
+    It is the single timer of the collector: other periodic jobs added with `every` run in it too, the thread sleeps
+    in `select` until the next flush or job is due, or the aggregator asks for a flush.
+    """
+
+    def __init__(self, aggregator, flush, interval):
+        """
+        :param aggregator: StatsAggregator
+        :param flush: callable shipping pending metrics
+        :param interval: seconds between flushes
+        :return:
+        """
+        super(Flusher, self).__init__()
+        self.aggregator = aggregator
+        self.flush = flush
+        self.interval = interval
+        self.stopped = Event()
+        self.jobs = []  # [due time, interval, job]
+        self.daemon = True
+
+    def every(self, interval, job):
+        """
+        Calls job every interval seconds, it must return quickly (ie. by starting a thread) not to delay flushes
+        :param interval: seconds
+        :param job: callable without arguments
+        :return: None
+        """
+        self.jobs.append([time.time() + interval, interval, job])
+
+    def run(self):
+        next_flush = time.time() + self.interval
+        while not self.stopped.is_set():
+            due = min([next_flush] + [job[0] for job in self.jobs])
+            self.aggregator.flush_needed.wait(max(due - time.time(), 0))
+            if self.stopped.is_set():
+                break  # the last flush is up to `stop`
+
+            now = time.time()
+            for job in self.jobs:
+                if job[0] <= now:
+                    job[0] = max(job[0] + job[1], now)  # skip missed runs instead of catching up
+                    try:
+                        job[2]()
+                    except Exception:
+                        logger.exception('Error running job %s', job[2])
+
+            if self.aggregator.flush_needed.is_set() or now >= next_flush:
+                self.aggregator.flush_needed.clear()
+                self.flush_once()
+                next_flush = time.time() + self.interval
+
+    def flush_once(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Error flushing stats')
+
+    def stop(self, flush=True):
+        """
+        Stops the thread and ships whatever is still pending
+        :param flush: False leaves pending metrics in the aggregator, ie. to be saved in a snapshot
+        :return: None
+        """
+        self.stopped.set()
+        self.aggregator.flush_needed.set()
+        if self.is_alive():
+            self.join()
+        self.aggregator.flush_needed.clear()
+        if flush:
+            self.flush_once()
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+"""
+Processes historical postfix logs in parallel, ie. to back-fill stats from rotated logs.
+
+Plain files are memory mapped and split into line aligned chunks, compressed ones (.gz, .bz2, .xz) are decompressed
+as a stream by the worker parsing them, one file per worker. Chunks and files are parsed by a pool of worker processes
+and their metrics are merged. With --bucket, metrics are kept per time bucket of the syslog timestamp and written in the Graphite plaintext
+format ("stat value timestamp"), which keeps their time unlike StatsD. Without an output file the merged totals are
+sent to StatsD.
+
+Messages crossing a chunk boundary are seen by two workers, so lifecycle stats of such messages are incomplete.
+"""
+
+import os
+import sys
+import bz2
+import signal
+import time
+import gzip
+import mmap
+import calendar
+import argparse
+import subprocess
+import multiprocessing
+from collections import defaultdict, deque
+from postfix_stats_collector.common import log_init
+from postfix_stats_collector.aggregator import Metrics, host_stat, top_stat
+from postfix_stats_collector.logparser import Parser, stats, tracker, configure, handler_argparse_maker
+
+from postfix_stats_collector.sinks import make_sink
+
+CHUNK_SIZE = 64  # megabytes
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# set before the pool of workers is forked
+bucket_seconds = 0
+year = time.localtime().tm_year
+
+
+class XzFile(object):
+    """
+    Iterable of lines of an .xz file decompressed by `xz -dc`, used when the lzma module is missing
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.process = subprocess.Popen(['xz', '-dc', path], stdout=subprocess.PIPE, bufsize=1 << 20)
+
+    def __iter__(self):
+        return iter(self.process.stdout)
+
+    def close(self):
+        """
+        Waits for xz to exit
+        :return: None
+        :raises IOError: if xz failed
+        """
+        self.process.stdout.close()
+        status = self.process.wait()
+        if status and status != -signal.SIGPIPE:  # SIGPIPE when closed before reading everything
+            raise IOError('xz -dc {} failed with exit status {}'.format(self.path, status))
+
+
+def open_log(path):
+    """
+    :return: file object reading decompressed content of path
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    if path.endswith('.xz'):
+        if lzma:
+            return lzma.open(path, 'rb')
+        return XzFile(path)
+    return open(path, 'rb')
+
+
+def iscompressed(path):
+    return path.endswith(('.gz', '.bz2', '.xz'))
+
+
+def split_chunks(path, chunk_size):
+    """
+    :param path: plain log file
+    :param chunk_size: bytes
+    :return: list of (path, start, end) offsets of chunks ending with a new line (or end of file)
+    """
+    size = os.path.getsize(path)
+    if not size:
+        return []
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            chunks = []
+            start = 0
+            while start < size:
+                end = start + chunk_size
+                if end < size:
+                    end = mm.find('\n', end)
+                    end = size if end < 0 else end + 1
+                else:
+                    end = size
+                chunks.append((path, start, end))
+                start = end
+            return chunks
+        finally:
+            mm.close()
+
+
+def tasks(log_files, chunk_size):
+    """
+    :return: generator of work for `parse_task`, chunks of plain files and paths of compressed ones
+    """
+    for path in log_files:
+        if iscompressed(path):
+            yield path
+        else:
+            for chunk in split_chunks(path, chunk_size):
+                yield chunk
+
+
+def parse_timestamp(date):
+    """
+    :param date: syslog timestamp, "Nov  1 06:25:09" in local time of `year` or ISO 8601
+    :return: unix timestamp
+    """
+    if date[:1].isdigit():
+        timestamp = calendar.timegm(time.strptime(date[:19], '%Y-%m-%dT%H:%M:%S'))
+        zone = date[19:].lstrip('.0123456789')
+        if zone and zone != 'Z':
+            offset = int(zone[1:3]) * 3600 + int(zone[4:6]) * 60
+            timestamp -= offset if zone[0] == '+' else -offset
+        return timestamp
+    return time.mktime(time.strptime('{} {}'.format(year, ' '.join(date.split())), '%Y %b %d %H:%M:%S'))
+
+
+def line_date(line):
+    """
+    :return: timestamp of syslog line as written in the line
+    """
+    pos = 0
+    if line.startswith('<'):
+        pos = line.find('>') + 1
+        if line.startswith('1 ', pos):
+            pos += 2
+    if line[pos:pos + 1].isdigit():
+        return line[pos:line.find(' ', pos)]
+    return line[pos:line.find(':', pos) + 6]
+
+
+def parse_lines(lines):
+    """
+    Parses lines with handlers
+    :param lines: iterable of lines
+    :return: (number of lines, number of bytes, {bucket -> Metrics})
+    """
+    results = defaultdict(Metrics)
+    bucket = 0
+    last_date = None
+    count = 0
+    size = 0
+    for line in lines:
+        count += 1
+        size += len(line) + 1
+        if not line:
+            continue
+        if bucket_seconds:
+            date = line_date(line)
+            if date != last_date:
+                last_date = date
+                try:
+                    line_bucket = int(parse_timestamp(date) // bucket_seconds * bucket_seconds)
+                except ValueError:
+                    line_bucket = bucket
+                if line_bucket != bucket:
+                    results[bucket].merge(stats.swap())
+                    bucket = line_bucket
+        Parser.parse_line(line)
+    results[bucket].merge(stats.swap())
+    return count, size, dict((bucket, metrics) for bucket, metrics in results.iteritems()
+                                  if metrics.pending or metrics.tops or metrics.histograms)
+
+
+def parse_task(task):
+    """
+    Runs in a worker process
+    :param task: (path, start, end) of a chunk or path of a compressed file
+    :return: result of `parse_lines`
+    """
+    if isinstance(task, basestring):
+        f = open_log(task)
+        try:
+            return parse_lines(line.rstrip('\n') for line in f)
+        finally:
+            f.close()
+
+    path, start, end = task
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            data = mm[start:end]
+        finally:
+            mm.close()
+    lines = data.split('\n')
+    if lines and not lines[-1]:
+        lines.pop()
+    return parse_lines(lines)
+
+
+def init_worker():
+    stats.reset()  # drop whatever was inherited from the parent
+    tracker.reset()
+
+
+def graphite_lines(metrics):
+    """
+    :return: generator of (stat, value) of all metrics
+    """
+    for stat, count in metrics.counters.iteritems():
+        yield stat, count
+    for host, counters in metrics.hosts.iteritems():
+        for stat, count in counters.iteritems():
+            yield host_stat(stat, host), count
+    for stat, value in metrics.gauges.iteritems():
+        yield stat, value
+    for stat, values in metrics.timers.iteritems():
+        yield stat + '.count', len(values)
+        yield stat + '.mean', round(float(sum(values)) / len(values), 3)
+    for stat, value in metrics.quantile_gauges():
+        yield stat, value
+    for name, item, count in metrics.top():
+        yield top_stat(name, item), count
+
+
+def write_graphite(results, output):
+    """
+    :param results: {bucket timestamp -> Metrics}
+    :param output: file object
+    :return: number of lines written
+    """
+    written = 0
+    now = int(time.time())
+    for bucket in sorted(results):
+        for stat, value in sorted(graphite_lines(results[bucket])):
+            output.write('{} {} {}\n'.format(stat, value, bucket or now))
+            written += 1
+    return written
+
+
+def backfill(log_files, processes=None, chunk_size=CHUNK_SIZE, bucket=0, output=None, sink=None):
+    """
+    Parses log files in parallel, handlers must be configured already
+    :param log_files: plain or compressed log files
+    :param processes: number of worker processes
+    :param chunk_size: megabytes of plain files parsed at once
+    :param bucket: seconds of time buckets, 0 merges everything
+    :param output: file object receiving Graphite plaintext lines or None to send totals to StatsD
+    :param sink: StatsD client like sink receiving totals, see `sinks`, StatsD over UDP by default
+    :return: (lines, bytes, seconds)
+    """
+    global bucket_seconds
+    bucket_seconds = bucket
+    processes = processes or multiprocessing.cpu_count()
+
+    t0 = time.time()
+    results = defaultdict(Metrics)
+    counts = [0, 0]  # lines, bytes
+
+    def collect(result):
+        task_lines, task_size, task_results = result.get()
+        counts[0] += task_lines
+        counts[1] += task_size
+        for task_bucket, metrics in task_results.iteritems():
+            results[task_bucket].merge(metrics)
+
+    pool = multiprocessing.Pool(processes, initializer=init_worker)
+    try:
+        # tasks are submitted in a bounded window, so results of finished tasks do not pile up in memory
+        pending = deque()
+        for task in tasks(log_files, chunk_size * 1024 * 1024):
+            pending.append(pool.apply_async(parse_task, (task,)))
+            if len(pending) >= 2 * processes:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+    finally:
+        pool.close()
+        pool.join()
+    lines, size = counts
+
+    if output:
+        write_graphite(results, output)
+    else:
+        total = Metrics()
+        for metrics in results.itervalues():
+            total.merge(metrics)
+        total.send(sink or make_sink())
+    return lines, size, time.time() - t0
+
+
+def argparse_maker():
+    """
+    :return: argparse object
+    """
+    parser = argparse.ArgumentParser(description=__doc__, parents=[handler_argparse_maker()],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-v", "--verbose", dest="verbosity", default=0, action="count",
+                        help="-v for a little info, -vv for debugging")
+    parser.add_argument("-c", "--concurrency", dest="concurrency", default=multiprocessing.cpu_count(), type=int,
+                        metavar="processes",
+                        help="Number of worker processes")
+    parser.add_argument("--chunk-size", dest="chunk_size", default=CHUNK_SIZE, type=int,
+                        metavar="megabytes",
+                        help="Size of chunks plain files are split into")
+    parser.add_argument("--bucket", dest="bucket", default=0, type=int,
+                        metavar="seconds",
+                        help="Keep metrics per time bucket of this many seconds, written with bucket timestamps")
+    parser.add_argument("--year", dest="year", default=year, type=int,
+                        help="Year of syslog timestamps without one")
+    parser.add_argument("-o", "--output", dest="output", default=None, metavar="file",
+                        help="Write metrics in Graphite plaintext format to file (- for stdout) instead of sending "
+                             "totals to StatsD")
+    parser.add_argument("--sink", dest="sink_spec", default=None,
+                        metavar="spec",
+                        help="Where to send totals without --output: udp://host:port, tcp://host:port, "
+                             "file:///path.jsonl or null, StatsD over UDP configured by STATSD_* variables by default")
+    parser.add_argument('log_files', metavar='file', type=str, nargs='+',
+                        help='plain, .gz, .bz2 or .xz log files')
+    return parser
+
+
+def main():
+    global year
+    parser = argparse_maker()
+    args = parser.parse_args()
+    log_init(args.verbosity)
+    year = args.year
+
+    if not configure(local_emails=args.local_emails, local_files=args.local_files, rule_files=args.rule_files,
+                     track_messages=args.track_messages, track_ttl=args.track_ttl, max_hosts=args.max_hosts,
+                     top_k=args.top_k, top_capacity=args.top_capacity, quantiles=args.quantiles):
+        sys.exit(1)
+
+    output = None
+    if args.output == '-':
+        output = sys.stdout
+    elif args.output:
+        output = open(args.output, 'w')
+    try:
+        lines, size, seconds = backfill(args.log_files, args.concurrency, args.chunk_size, args.bucket, output,
+                                        make_sink(args.sink_spec))
+    finally:
+        if output and output is not sys.stdout:
+            output.close()
+
+    sys.stderr.write('Parsed {} lines ({:.1f} MB) of {} files in {:.1f}s: {:.0f} lines/s, {:.1f} MB/s\n'.format(
+        lines, size / 1e6, len(args.log_files), seconds, lines / max(seconds, 1e-9), size / 1e6 / max(seconds, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
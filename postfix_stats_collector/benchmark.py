@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+"""
+Benchmarks hot paths of the collector on synthetic postfix logs, qshape output and spool trees.
+Results are printed as JSON, pass a previous result with --compare to see ratios against it.
+"""
+
+import re
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from postfix_stats_collector import logparser
+from postfix_stats_collector.logparser import Handler, Parser, register_handlers, parse_envelope, ParserPool, \
+    BatchReader, stats
+from postfix_stats_collector.qshape import QUEUES, run_qshape, transform_qshape
+from postfix_stats_collector.spool import SpoolScanner, HEADERS, write_queue_file
+from postfix_stats_collector.addresses import AddressMatcher
+from postfix_stats_collector.sinks import NullSink
+
+# envelope regex used by Parser before the string scanning tokenizer, kept as a baseline
+LEGACY_LINE_RE = re.compile(r'\A(?P<iso_date>\D{3}\s+\d{1,2}\s+\d{2}:\d{2}:\d{2})\s+(?P<source>.+?)\s+(?P<facility>.+?)\[(?P<pid>\d+?)\]:\s(?P<message>.*)\Z')
+
+# (facility, weight, message template)
+LOG_TEMPLATES = [
+    ('pickup', 5, '{qid}: uid=0 from=<root>'),
+    ('cleanup', 10, '{qid}: message-id=<{qid}@mail.example.com>'),
+    ('qmgr', 10, '{qid}: from=<user@{domain}>, size={size}, nrcpt=1 (queue active)'),
+    ('smtp', 8, '{qid}: to=<user@{domain}>, relay=mx.{domain}[198.51.100.1]:25, delay={delay}, delays=0.04/0.02/0.04/0, dsn=2.0.0, status=sent (250 2.0.0 Ok)'),
+    ('smtp', 1, '{qid}: to=<user@{domain}>, relay=none, delay={delay}, delays=0.01/0/0.01/0, dsn=4.4.1, status=deferred (connect to mx.{domain}[198.51.100.1]:25: Connection timed out)'),
+    ('smtp', 1, '{qid}: to=<user@{domain}>, relay=127.0.0.1[127.0.0.1]:10024, conn_use=2, delay={delay}, delays=0.01/0/0.01/0.3, dsn=2.0.0, status=sent (250 2.0.0 Ok)'),
+    ('local', 2, '{qid}: to=<user@{domain}>, orig_to=<user>, relay=local, delay={delay}, delays=0.01/0/0/0, dsn=2.0.0, status=sent (delivered to mailbox)'),
+    ('bounce', 1, '{qid}: sender non-delivery notification: {qid}'),
+    ('qmgr', 10, '{qid}: removed'),
+    ('smtpd', 5, '{qid}: client=unknown[198.51.100.7]'),
+    ('smtpd', 10, 'connect from unknown[198.51.100.7]'),
+    ('smtpd', 10, 'disconnect from unknown[198.51.100.7]'),
+    ('anvil', 5, 'statistics: max connection rate 1/60s for (smtp:198.51.100.7) at Nov  1 06:25:09'),
+    ('master', 2, 'warning: process /usr/lib/postfix/showq pid 8852 exit status 1'),
+    ('showq', 3, 'fatal: scan_dir_push: open directory hold: No such file or directory'),
+]
+
+
+def parse_mix(mix):
+    """
+    :param mix: "facility=weight,..." overriding weights of LOG_TEMPLATES
+    :return: dict of facility -> weight
+    """
+    weights = dict()
+    for item in filter(None, (mix or '').split(',')):
+        facility, weight = item.split('=')
+        weights[facility.strip()] = int(weight)
+    return weights
+
+
+def generate_log_lines(count, seed=0, mix=None, domains=50):
+    """
+    Generates syslog lines following the facility mix of LOG_TEMPLATES
+    :param count: number of lines
+    :param seed: random seed, the same seed always generates the same log
+    :param mix: dict of facility -> weight overriding weights of LOG_TEMPLATES
+    :param domains: number of distinct recipient domains
+    :return: list of lines
+    """
+    mix = mix or {}
+    rnd = random.Random(seed)
+    weighted = [template for template in LOG_TEMPLATES for i in xrange(mix.get(template[0], template[1]))]
+    lines = []
+    for i in xrange(count):
+        facility, weight, template = rnd.choice(weighted)
+        message = template.format(qid='%010X' % rnd.randint(0, 0xFFFFF),
+                                  domain='domain{}.example.com'.format(rnd.randint(0, domains - 1)),
+                                  size=rnd.randint(500, 500000),
+                                  delay=round(rnd.expovariate(1), 2))
+        lines.append('Nov  1 06:{:02d}:{:02d} relay postfix/{}[{}]: {}'.format(
+            (i / 60) % 60, i % 60, facility, rnd.randint(100, 9999), message))
+    return lines
+
+
+def generate_qshape_output(domains, seed=0):
+    """
+    Generates output of `qshape -b 12` for given number of domains
+    :return: string
+    """
+    rnd = random.Random(seed)
+    rows = []
+    for i in xrange(domains):
+        rows.append(('domain{}.example.com'.format(i), [rnd.randint(0, 20) for header in HEADERS]))
+    total = [sum(column) for column in zip(*[counts for domain, counts in rows])] or [0] * len(HEADERS)
+
+    lines = ['T ' + ' '.join(HEADERS)]
+    for domain, counts in [('TOTAL', total)] + rows:
+        lines.append('{} {} {}'.format(domain, sum(counts), ' '.join(str(count) for count in counts)))
+    return '\n'.join(lines) + '\n'
+
+
+def generate_spool(spool_dir, messages, domains, seed=0, now=None):
+    """
+    Generates spool tree with hashed deferred queue and flat other queues
+    :param messages: number of queue files per queue
+    :param domains: number of distinct recipient domains
+    :return: None
+    """
+    rnd = random.Random(seed)
+    now = now or time.time()
+    for queue in QUEUES:
+        for i in xrange(messages):
+            name = '%010X' % rnd.randint(0, 0xFFFFFFFFF)
+            directory = os.path.join(spool_dir, queue, name[0]) if queue == 'deferred' else os.path.join(spool_dir, queue)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            recipients = ['user@domain{}.example.com'.format(rnd.randint(0, domains - 1))
+                          for r in xrange(rnd.randint(1, 3))]
+            write_queue_file(os.path.join(directory, name), now - rnd.expovariate(1.0 / 3600), recipients)
+
+
+def rate(count, seconds):
+    return count / max(seconds, 1e-9)
+
+
+def lines_per_second(func, lines, *args):
+    t0 = time.time()
+    for line in lines:
+        func(line, *args)
+    return rate(len(lines), time.time() - t0)
+
+
+def legacy_envelope(line, handlers):
+    pln = LEGACY_LINE_RE.match(line)
+    if pln:
+        pline = pln.groupdict()
+        facility = pline['facility'].split('/')
+        return handlers.get(facility[-1])
+
+
+@contextmanager
+def null_statsd():
+    """
+    Replaces sink of the log parser with NullSink, so benchmarks measure parsing only, and drops pending metrics
+    afterwards
+    """
+    client = logparser.sink
+    logparser.sink = NullSink()
+    try:
+        yield
+    finally:
+        logparser.sink = client
+        stats.swap()
+
+
+@contextmanager
+def log_file(lines):
+    """
+    Writes lines to a temporary file
+    :return: path of the file
+    """
+    fd, path = tempfile.mkstemp(prefix='postfix-stats-bench')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines))
+            f.write('\n')
+        yield path
+    finally:
+        os.unlink(path)
+
+
+def bench_envelope(lines):
+    """
+    Compares envelope parsing of the legacy regex with the string scanning tokenizer
+    :return: dict of name -> lines/sec
+    """
+    return {
+        'legacy_line_re': lines_per_second(legacy_envelope, lines, Handler.handlers),
+        'parse_envelope': lines_per_second(parse_envelope, lines, Handler.handlers),
+    }
+
+
+def bench_parse_line(lines):
+    """
+    :return: lines/sec through Parser.parse_line including handlers
+    """
+    with null_statsd():
+        return {'parse_line': lines_per_second(Parser.parse_line, lines)}
+
+
+def bench_handlers(lines):
+    """
+    Measures cost of each handler's regex on messages of its facilities
+    :return: dict of handler -> {'messages', 'matched', 'us_per_message'}
+    """
+    messages = dict()
+    for line in lines:
+        envelope = parse_envelope(line)
+        if envelope:
+            messages.setdefault(envelope[2], []).append(envelope[3])
+
+    results = dict()
+    for handler in set(handler for handlers in Handler.handlers.values() for handler in handlers):
+        sample = [message for facility in handler.facilities for message in messages.get(facility, [])]
+        match = handler.filter_re.match
+        t0 = time.time()
+        matched = sum(1 for message in sample if match(message))
+        seconds = time.time() - t0
+        results[handler.__class__.__name__] = {
+            'messages': len(sample),
+            'matched': matched,
+            'us_per_message': 1e6 * seconds / len(sample) if sample else None,
+        }
+    return results
+
+
+def bench_ingestion(lines, num_parsers=2, batch_size=500):
+    """
+    Compares line by line queueing of a log file with batched ingestion
+    :return: dict of name -> lines/sec
+    """
+    with log_file(lines) as path, null_statsd():
+        t0 = time.time()
+        parser_pool = ParserPool(num_parsers)
+        with open(path) as f:
+            for line in iter(f.readline, ''):
+                parser_pool.add_line(line.strip('\n'), block=True)
+        parser_pool.join()
+        t1 = time.time()
+
+        parser_pool = ParserPool(num_parsers, queue_size=max(num_parsers * 1000 / batch_size, num_parsers))
+        for batch in BatchReader([path], batch_size=batch_size):
+            parser_pool.add_batch(batch, block=True)
+        parser_pool.join()
+        t2 = time.time()
+
+    return {
+        'line_by_line': rate(len(lines), t1 - t0),
+        'batched': rate(len(lines), t2 - t1),
+    }
+
+
+def bench_process(lines, concurrency=2):
+    """
+    End-to-end `logparser.process()` throughput over a log file with null metrics sink
+    :return: dict of mode -> lines/sec
+    """
+    results = dict()
+    stdout = sys.stdout
+    with log_file(lines) as path, null_statsd():
+        sys.stdout = open(os.devnull, 'w')  # process() prints its progress
+        try:
+            for mode, processes in (('threads', False), ('processes', True)):
+                t0 = time.time()
+                logparser.process([path], concurrency=concurrency, local_emails=[], processes=processes)
+                results[mode] = rate(len(lines), time.time() - t0)
+        finally:
+            sys.stdout = stdout
+    return results
+
+
+def generate_local_rules(count, seed=0):
+    """
+    :return: list of "STRING,NAME,COUNT" rules, a third of each kind: addresses, domains and substrings
+    """
+    rnd = random.Random(seed)
+    rules = []
+    for i in xrange(count):
+        kind = i % 3
+        if kind == 0:
+            rule = 'mailbox{}@domain{}.example.com'.format(i, rnd.randint(0, 99))
+        elif kind == 1:
+            rule = '@local{}.example.org'.format(i)
+        else:
+            rule = 'tag{}+'.format(i)
+        rules.append('{},local{},{}'.format(rule, i % 10, rnd.choice(('yes', 'no'))))
+    return rules
+
+
+def bench_local_addresses(counts=(10, 100, 1000, 10000), lookups=20000, seed=0):
+    """
+    Measures lookups of recipient addresses against growing number of local address rules, next to the escaped
+    alternation regex used before the index
+    :return: dict of number of rules -> {name -> lookups/sec}
+    """
+    results = dict()
+    for count in counts:
+        rules = generate_local_rules(count, seed)
+        rnd = random.Random(seed)
+        addresses = []
+        for i in xrange(lookups):
+            if i % 2:
+                addresses.append('nobody{}@example.net'.format(i))
+                continue
+            rule = rnd.choice(rules).split(',')[0]
+            if rule.startswith('@'):
+                addresses.append('user' + rule)
+            elif '@' in rule:
+                addresses.append(rule)
+            else:
+                addresses.append('user+{}x@example.net'.format(rule))
+        matcher = AddressMatcher()
+        for rule in rules:
+            matcher.add_spec(rule)
+        matcher.build()
+        regex = re.compile('|'.join(re.escape(rule.split(',')[0]) for rule in rules))
+        results[str(count)] = {
+            'matcher': lines_per_second(matcher.match, addresses),
+            'regex': lines_per_second(regex.search, addresses),
+        }
+    return results
+
+
+def bench_qshape(domains, repeat=10):
+    """
+    Measures parsing and transformation of qshape output with many domains
+    :return: dict with seconds per queue and number of stats produced
+    """
+    output = generate_qshape_output(domains)
+    check_output = subprocess.check_output
+    subprocess.check_output = lambda args: output
+    try:
+        t0 = time.time()
+        for i in xrange(repeat):
+            headers, rows = run_qshape('deferred', domains)
+        t1 = time.time()
+        for i in xrange(repeat):
+            produced = len(list(transform_qshape('deferred', headers, rows)))
+        t2 = time.time()
+    finally:
+        subprocess.check_output = check_output
+
+    return {
+        'domains': domains,
+        'stats': produced,
+        'parse_seconds': (t1 - t0) / repeat,
+        'transform_seconds': (t2 - t1) / repeat,
+    }
+
+
+def bench_spool(messages, domains):
+    """
+    Measures cold and cached (incremental) native scans of a synthetic spool
+    :return: dict with seconds per scan of all queues
+    """
+    spool_dir = tempfile.mkdtemp(prefix='postfix-stats-bench')
+    try:
+        generate_spool(spool_dir, messages, domains)
+        scanner = SpoolScanner(spool_dir)
+        timings = []
+        for i in xrange(2):
+            t0 = time.time()
+            for queue in QUEUES:
+                scanner.shape(queue, domains)
+            timings.append(time.time() - t0)
+    finally:
+        shutil.rmtree(spool_dir)
+
+    return {
+        'queue_files': messages * len(QUEUES),
+        'cold_seconds': timings[0],
+        'cached_seconds': timings[1],
+    }
+
+
+def compare(results, baseline):
+    """
+    :return: results with every number replaced by its ratio to the same number in baseline
+    """
+    if isinstance(results, dict):
+        if not isinstance(baseline, dict):
+            return None
+        return dict((key, compare(value, baseline[key])) for key, value in results.iteritems() if key in baseline)
+    if isinstance(results, (int, float)) and isinstance(baseline, (int, float)) and baseline:
+        return float(results) / baseline
+    return None
+
+
+def argparse_maker():
+    """
+    :return: argparse object
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-n", "--lines", dest="lines", default=100000, type=int,
+                        help="Number of synthetic log lines")
+    parser.add_argument("-s", "--seed", dest="seed", default=0, type=int,
+                        help="Random seed of the generators")
+    parser.add_argument("-m", "--mix", dest="mix", default=None,
+                        help="Facility weights overriding the default mix, ie. smtp=20,anvil=0")
+    parser.add_argument("-d", "--domains", dest="domains", default=1000, type=int,
+                        help="Number of domains in synthetic qshape output and spool")
+    parser.add_argument("-q", "--queue-files", dest="queue_files", default=1000, type=int,
+                        help="Number of synthetic queue files per queue")
+    parser.add_argument("-c", "--concurrency", dest="concurrency", default=2, type=int,
+                        help="Parsers used by ingestion and process() benchmarks")
+    parser.add_argument("--compare", dest="compare", default=None, metavar="file",
+                        help="JSON results of a previous run to compare with")
+    parser.add_argument("-o", "--output", dest="output", default=None, metavar="file",
+                        help="Write JSON results to file instead of stdout")
+    return parser
+
+
+def main():
+    parser = argparse_maker()
+    args = parser.parse_args()
+    register_handlers()
+
+    lines = generate_log_lines(args.lines, args.seed, parse_mix(args.mix))
+    results = {
+        'parameters': {
+            'lines': args.lines,
+            'seed': args.seed,
+            'mix': args.mix,
+            'domains': args.domains,
+            'queue_files': args.queue_files,
+            'concurrency': args.concurrency,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+        },
+        'envelope': bench_envelope(lines),
+        'parse_line': bench_parse_line(lines),
+        'handlers': bench_handlers(lines),
+        'ingestion': bench_ingestion(lines, args.concurrency),
+        'process': bench_process(lines, args.concurrency),
+        'qshape': bench_qshape(args.domains),
+        'spool': bench_spool(args.queue_files, args.domains),
+        'local_addresses': bench_local_addresses(seed=args.seed),
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            results['comparison'] = compare(results, json.load(f))
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
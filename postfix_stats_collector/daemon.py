@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Parses postfix logs and collects qshape of postfix queues in a single process.
+
+Both share one aggregator, one flush to StatsD (or another --sink) and one set of collector health stats. Queue
+shapes are collected every --qshape-interval seconds by the thread flushing the aggregator, which sleeps until the
+next flush or collection is due instead of polling. Queue shapes are sent as gauges only when they change, like
+postfix-stats-qshape does. With --snapshot, the gauges sent last are saved and loaded together with the log parser's
+state.
+Supported enviroment variables and their respective defaults:
+STATSD_HOST=localhost
+STATSD_PORT=8125
+STATSD_PREFIX=None
+STATSD_MAXUDPSIZE=512
+STATSD_FLUSH_INTERVAL=1
+STATSD_DELAY=10
+"""
+
+from postfix_stats_collector import logparser
+from postfix_stats_collector.common import log_init
+from postfix_stats_collector.qshape import GaugeSnapshot, CollectionJob, report_qshape, STATSD_DELAY, \
+    RESYNC_INTERVAL
+from postfix_stats_collector.spool import SpoolScanner, SPOOL_DIR
+
+
+def qshape_job(native=False, spool_dir=SPOOL_DIR, timeout=STATSD_DELAY, resync_interval=RESYNC_INTERVAL):
+    """
+    :param native: read queue files from `spool_dir` instead of executing `qshape`
+    :param spool_dir: postfix spool directory
+    :param timeout: seconds to wait for collection of all queues
+    :param resync_interval: seconds between sends of all gauges
+    :return: (CollectionJob adding queue shapes to the log parser's aggregator, its GaugeSnapshot)
+    """
+    scanner = SpoolScanner(spool_dir) if native else None
+    snapshot = GaugeSnapshot(resync_interval)
+
+    def report(skipped_ticks=0):
+        report_qshape(logparser.stats, snapshot, scanner, timeout, skipped_ticks)
+
+    return CollectionJob(report), snapshot
+
+
+def argparse_maker():
+    """
+    :return: argparse object
+    """
+    parser = logparser.argparse_maker(__doc__)
+    parser.add_argument("--qshape-interval", dest="qshape_interval", default=STATSD_DELAY, type=float,
+                        metavar="seconds",
+                        help="Interval between collections of queue shapes")
+    parser.add_argument("-n", "--native", dest="native", default=False, action="store_true",
+                        help="Read queue files directly instead of executing /usr/sbin/qshape")
+    parser.add_argument("-s", "--spool-dir", dest="spool_dir", default=SPOOL_DIR,
+                        help="Postfix spool directory used by --native")
+    parser.add_argument("-t", "--timeout", dest="qshape_timeout", default=STATSD_DELAY, type=float,
+                        metavar="seconds",
+                        help="Deadline for collecting all queues, slower queues are reported as timed out")
+    parser.add_argument("--resync-interval", dest="resync_interval", default=RESYNC_INTERVAL, type=float,
+                        metavar="seconds",
+                        help="Interval between sends of all queue gauges, only changed ones are sent in between")
+    return parser
+
+
+def main():
+    parser = argparse_maker()
+    args = parser.parse_args()
+    log_init(args.verbosity)
+
+    job, snapshot = qshape_job(args.native, args.spool_dir, args.qshape_timeout, args.resync_interval)
+    logparser.process_args(args, jobs=[(args.qshape_interval, job)], states=[('qshape', snapshot)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Pull-based exposition of collected metrics in OpenMetrics (or Prometheus 0.0.4) text format.
+
+The registry is updated on every flush and renders its text right away, a scrape only returns the cached text. Scrape
+cost therefore does not depend on log volume and scrapes never touch locks used by parsers.
+
+StatsD names are mapped to metric names by replacing characters not allowed by Prometheus with "_":
+  counters   postfix.messages.bounce -> postfix_messages_bounce_total
+  gauges     postfix.qshape.active.total.5 -> postfix_qshape_active_total_5
+  timings    postfix.messages.lifecycle.delay -> summary postfix_messages_lifecycle_delay_count/_sum
+Counters kept per source host are exposed with a host label, ie. postfix_messages_bounce_total{host="relay1"}.
+Heavy hitters of the last flush interval are gauges labelled by item, ie. postfix_top_clients{item="192.0.2.1"}.
+"""
+
+import re
+import logging
+import threading
+from collections import defaultdict
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+invalid_chars_re = re.compile(r'[^a-zA-Z0-9_:]')
+
+
+def metric_name(stat):
+    """
+    :param stat: StatsD name
+    :return: valid Prometheus metric name
+    """
+    name = invalid_chars_re.sub('_', stat)
+    if name[:1].isdigit():
+        name = '_' + name
+    return name
+
+
+class MetricsRegistry(object):
+    """
+    Cumulative view of flushed metrics: counters are summed, gauges keep the last value and timings are summarised as
+    count and sum.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()  # (name, labels) -> value
+        self.gauges = dict()
+        self.summaries = dict()  # name -> [count, sum]
+        self.tops = dict()  # name -> [(item, count)] of the last flush
+        self.openmetrics = '# EOF\n'
+        self.prometheus = ''
+
+    def update(self, metrics):
+        """
+        Adds flushed metrics and renders the text exposition
+        :param metrics: Metrics
+        :return: None
+        """
+        with self.lock:
+            for stat, count in metrics.counters.iteritems():
+                key = (metric_name(stat), '')
+                self.counters[key] = self.counters.get(key, 0) + count
+            for host, counters in metrics.hosts.iteritems():
+                labels = '{{host="{}"}}'.format(host)
+                for stat, count in counters.iteritems():
+                    key = (metric_name(stat), labels)
+                    self.counters[key] = self.counters.get(key, 0) + count
+            for stat, value in metrics.gauges.iteritems():
+                self.gauges[metric_name(stat)] = value
+            for stat, value in metrics.quantile_gauges():
+                self.gauges[metric_name(stat)] = value
+            for stat, values in metrics.timers.iteritems():
+                summary = self.summaries.setdefault(metric_name(stat), [0, 0.0])
+                summary[0] += len(values)
+                summary[1] += sum(values)
+            if metrics.tops:
+                tops = defaultdict(list)
+                for name, item, count in metrics.top():
+                    tops[metric_name('postfix.top.' + name)].append((item, count))
+                self.tops = tops
+            self.render()
+
+    def set_gauges(self, stats, counters=()):
+        """
+        Sets gauges from (stat, value) pairs, ie. queue shapes of `get_qshape_stats`, adds counters of events (ie. a
+        timed out collection) and renders the text exposition
+        :return: None
+        """
+        with self.lock:
+            for stat, value in stats:
+                self.gauges[metric_name(stat)] = value
+            for stat, count in counters:
+                key = (metric_name(stat), '')
+                self.counters[key] = self.counters.get(key, 0) + count
+            self.render()
+
+    def render(self):
+        """
+        Must be called with lock held
+        :return: None
+        """
+        openmetrics = []
+        prometheus = []
+        previous = None
+        for (name, labels), value in sorted(self.counters.iteritems()):
+            if name != previous:
+                openmetrics.append('# TYPE {0} counter\n'.format(name))
+                prometheus.append('# TYPE {0}_total counter\n'.format(name))
+                previous = name
+            sample = '{}_total{} {}\n'.format(name, labels, value)
+            openmetrics.append(sample)
+            prometheus.append(sample)
+        for name, value in sorted(self.gauges.iteritems()):
+            text = '# TYPE {0} gauge\n{0} {1}\n'.format(name, value)
+            openmetrics.append(text)
+            prometheus.append(text)
+        for name, items in sorted(self.tops.iteritems()):
+            text = ['# TYPE {0} gauge\n'.format(name)]
+            for item, count in items:
+                text.append('{}{{item="{}"}} {}\n'.format(name, item.replace('\\', '\\\\').replace('"', '\\"'), count))
+            openmetrics.extend(text)
+            prometheus.extend(text)
+        for name, (count, total) in sorted(self.summaries.iteritems()):
+            text = '# TYPE {0} summary\n{0}_count {1}\n{0}_sum {2}\n'.format(name, count, total)
+            openmetrics.append(text)
+            prometheus.append(text)
+        openmetrics.append('# EOF\n')
+
+        self.openmetrics = ''.join(openmetrics)
+        self.prometheus = ''.join(prometheus)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        if 'application/openmetrics-text' in self.headers.get('Accept', ''):
+            body, content_type = self.server.registry.openmetrics, OPENMETRICS_CONTENT_TYPE
+        else:
+            body, content_type = self.server.registry.prometheus, PROMETHEUS_CONTENT_TYPE
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_http_server(registry, port, addr=''):
+    """
+    Serves registry on http://addr:port/metrics from a background thread
+    :param registry: MetricsRegistry
+    :return: MetricsServer
+    """
+    server = MetricsServer((addr, port), MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http')
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving metrics on %s:%s', addr or '*', server.server_address[1])
+    return server
@@ -0,0 +1,220 @@
+"""
+Follows a growing log file like `tail -F`, surviving log rotation and restarts of the collector.
+
+Rotation by rename is noticed when the path points to a new inode; the old file is read to its end before the new one
+is opened. Truncation (ie. copytruncate) is noticed when the file gets shorter than what was read, reading then
+starts over from its beginning.
+
+With a checkpoint file, inode and offset of the last line handed out are saved every `checkpoint_interval` seconds and
+when following stops. On start the file is resumed at the checkpoint; if it was rotated in the meantime, the rest of
+the rotated file (found by its inode next to the log file) is read first. Without a checkpoint following starts at the
+end of the file.
+"""
+
+import os
+import json
+import time
+import errno
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def find_inode(path, inode):
+    """
+    :return: path of a file in the directory of path, named like path, with the given inode, or None
+    """
+    directory = os.path.dirname(path) or '.'
+    name = os.path.basename(path)
+    for candidate in sorted(os.listdir(directory)):
+        if candidate.startswith(name) and candidate != name:
+            candidate = os.path.join(directory, candidate)
+            try:
+                if os.stat(candidate).st_ino == inode:
+                    return candidate
+            except OSError:
+                pass
+    return None
+
+
+class FollowReader(object):
+    """
+    Yields batches of lines appended to a log file, see `BatchReader`.
+    """
+
+    def __init__(self, path, batch_size=500, max_latency=0.1, block_size=65536, poll_interval=0.25, checkpoint=None,
+                 checkpoint_interval=5):
+        """
+        :param path: log file
+        :param batch_size: max lines in a batch
+        :param max_latency: seconds a partial batch may wait for more lines
+        :param block_size: bytes read at once
+        :param poll_interval: seconds to wait for more data at the end of the file
+        :param checkpoint: file keeping position in the log file or None
+        :param checkpoint_interval: seconds between saves of the position
+        :return:
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.block_size = block_size
+        self.poll_interval = poll_interval
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_at = 0
+        self.fd = None
+        self.inode = None
+        self.offset = 0  # bytes read from the current file
+        self.stopped = False
+
+    def islive(self):
+        """
+        :return: False, the file keeps lines until parsers catch up, so nothing has to be dropped
+        """
+        return False
+
+    def stop(self):
+        """
+        Makes iteration finish, can be called from any thread or a signal handler
+        :return: None
+        """
+        self.stopped = True
+
+    def load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return None
+        try:
+            with open(self.checkpoint) as f:
+                checkpoint = json.load(f)
+            return int(checkpoint['inode']), int(checkpoint['offset'])
+        except (IOError, ValueError, KeyError, TypeError), e:
+            logger.warning('Ignoring invalid checkpoint %s: %s', self.checkpoint, e)
+            return None
+
+    def save_checkpoint(self, offset):
+        """
+        Atomically replaces the checkpoint
+        :param offset: offset in the current file of the first line not handed out yet
+        :return: None
+        """
+        if not self.checkpoint or self.inode is None:
+            return
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'path': self.path, 'inode': self.inode, 'offset': offset, 'time': time.time()}, f)
+        os.rename(tmp, self.checkpoint)
+        self.checkpoint_at = time.time()
+
+    def open(self, path, offset=0):
+        self.close()
+        self.fd = os.open(path, os.O_RDONLY)
+        self.inode = os.fstat(self.fd).st_ino
+        self.offset = os.lseek(self.fd, offset, os.SEEK_SET)
+        logger.info('Following %s (inode %s) from offset %s', path, self.inode, offset)
+
+    def resume(self):
+        """
+        Opens the file at the checkpoint, the rotated file if the checkpoint belongs to it, or at the end
+        :return: None
+        """
+        while not os.path.exists(self.path):
+            if self.stopped:
+                return
+            time.sleep(self.poll_interval)
+
+        checkpoint = self.load_checkpoint()
+        size = os.stat(self.path).st_size
+        if checkpoint is None:
+            self.open(self.path, size)
+            return
+
+        inode, offset = checkpoint
+        if os.stat(self.path).st_ino == inode:
+            self.open(self.path, offset if offset <= size else 0)
+            return
+
+        rotated = find_inode(self.path, inode)
+        if rotated and offset <= os.stat(rotated).st_size:
+            self.open(rotated, offset)  # rotated since the checkpoint, continues with self.path once drained
+        else:
+            logger.warning('File of checkpoint %s not found, following %s from its start', self.checkpoint, self.path)
+            self.open(self.path)
+
+    def changed(self):
+        """
+        Checks, at the end of the current file, whether it was rotated or truncated
+        :return: True if reading continues with another file or from the start
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return False  # rotation in progress
+            raise
+        if st.st_ino != self.inode:
+            if os.fstat(self.fd).st_size > self.offset:
+                return False  # drain the old file first
+            logger.info('%s rotated', self.path)
+            self.open(self.path)
+            return True
+        if os.fstat(self.fd).st_size < self.offset:
+            logger.info('%s truncated', self.path)
+            self.open(self.path)
+            return True
+        return False
+
+    def __iter__(self):
+        if self.fd is None:
+            self.resume()
+            if self.fd is None:
+                return
+
+        batch = []
+        partial = ''
+        deadline = None
+        try:
+            while not self.stopped:
+                block = os.read(self.fd, self.block_size)
+                if block:
+                    self.offset += len(block)
+                    lines = (partial + block).split('\n') if partial else block.split('\n')
+                    partial = lines.pop()
+                    if lines:
+                        if not batch:
+                            deadline = time.time() + self.max_latency
+                        batch.extend(lines)
+                    while len(batch) >= self.batch_size:
+                        yield batch[:self.batch_size]
+                        batch = batch[self.batch_size:]
+                else:
+                    if batch and time.time() >= deadline:
+                        yield batch
+                        batch = []
+                        continue
+                    last = partial
+                    if self.changed():
+                        if last:  # the old file ended without a new line
+                            batch.append(last)
+                        partial = ''
+                        if batch:  # lines of the old file, before the checkpoint moves to the new one
+                            yield batch
+                            batch = []
+                        continue
+                    time.sleep(min(self.poll_interval, max(deadline - time.time(), 0)) if batch
+                               else self.poll_interval)
+
+                if time.time() - self.checkpoint_at >= self.checkpoint_interval:
+                    # lines still waiting in batch are read again after a restart
+                    self.save_checkpoint(self.offset - len(partial) - sum(len(line) + 1 for line in batch))
+        except KeyboardInterrupt:
+            pass
+
+        if batch:
+            yield batch
+        self.save_checkpoint(self.offset - len(partial))
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
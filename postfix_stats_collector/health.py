@@ -0,0 +1,133 @@
+"""
+Self-instrumentation of the collector, so we can tell when the collector itself is the bottleneck.
+
+Reported on every flush under a configurable prefix (default "postfix.collector"):
+  lines.read, lines.dropped                  lines read from input and dropped because parsers were full
+  lines.shed                                 lines dropped by sampling under overload
+  lines.parsed, lines.ignored                lines of a facility with a handler and the other ones
+  lines.matched, lines.unmatched             parsed lines matched or not matched by any handler
+  lines.errors                               lines raising an exception in a handler
+  handlers.<handler>.matches                 lines matched by a handler
+  handlers.<handler>.regex_time              milliseconds spent in handler's regex
+  workers.<worker>.utilisation               fraction of time a parser was busy (gauge)
+  queue_depth                                batches waiting for parsers (gauge)
+  sampling_rate                              1 in how many lines is parsed, with load shedding enabled (gauge)
+  flush_time                                 milliseconds taken by previous flush (gauge)
+"""
+
+import time
+from collections import defaultdict
+
+PREFIX = 'postfix.collector'
+
+
+class ParserHealth(object):
+    """
+    Counters of a single parser thread or process. They are written only by their owner, so no locking is needed;
+    `report` running in another thread only reads them.
+    """
+    fields = ('parsed', 'ignored', 'matched', 'unmatched', 'errors')
+
+    def __init__(self, name):
+        self.name = name
+        self.parsed = 0
+        self.ignored = 0
+        self.matched = 0
+        self.unmatched = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.handler_matches = defaultdict(int)
+        self.handler_time = defaultdict(float)
+        self.reported = dict()
+        self.reported_at = time.time()
+
+    def delta(self, key, value):
+        delta = value - self.reported.get(key, 0)
+        self.reported[key] = value
+        return delta
+
+    def report(self, stats, prefix=PREFIX):
+        """
+        Adds changes since the previous report to the aggregator
+        :param stats: StatsAggregator
+        :param prefix: prefix of the stats
+        :return: None
+        """
+        for field in self.fields:
+            delta = self.delta(field, getattr(self, field))
+            if delta:
+                stats.incr('{}.lines.{}'.format(prefix, field), delta)
+
+        for name, matches in self.handler_matches.items():
+            delta = self.delta(('matches', name), matches)
+            if delta:
+                stats.incr('{}.handlers.{}.matches'.format(prefix, name), delta)
+        for name, seconds in self.handler_time.items():
+            delta = self.delta(('time', name), int(seconds * 1000))  # whole ms, the remainder carries over
+            if delta:
+                stats.incr('{}.handlers.{}.regex_time'.format(prefix, name), delta)
+
+        now = time.time()
+        busy = self.delta('busy_time', self.busy_time)
+        stats.gauge('{}.workers.{}.utilisation'.format(prefix, self.name),
+                    round(min(busy / max(now - self.reported_at, 1e-9), 1.0), 3))
+        self.reported_at = now
+
+
+class CollectorHealth(object):
+    """
+    Health of the whole collector: input side counters, queue depth, flush latency and health of thread parsers.
+    """
+
+    def __init__(self, prefix=PREFIX):
+        self.prefix = prefix
+        self.lines_read = 0
+        self.lines_dropped = 0
+        self.lines_shed = 0
+        self.flush_time = None
+        self.parsers = []  # ParserHealth of parser threads, worker processes report on their own
+        self.queue_depth = None  # callable returning number of waiting batches
+        self.sampling_rate = None  # callable returning current sampling rate
+        self.reported = dict()
+
+    def parser(self, name):
+        """
+        :return: new ParserHealth reported together with the collector
+        """
+        health = ParserHealth(name)
+        self.parsers.append(health)
+        return health
+
+    def report(self, stats):
+        """
+        Adds collector health to the aggregator
+        :param stats: StatsAggregator
+        :return: None
+        """
+        for field in ('lines_read', 'lines_dropped', 'lines_shed'):
+            value = getattr(self, field)
+            delta = value - self.reported.get(field, 0)
+            self.reported[field] = value
+            if delta:
+                stats.incr('{}.{}'.format(self.prefix, field.replace('_', '.')), delta)
+
+        if self.queue_depth:
+            stats.gauge('{}.queue_depth'.format(self.prefix), self.queue_depth())
+        if self.sampling_rate:
+            stats.gauge('{}.sampling_rate'.format(self.prefix), self.sampling_rate())
+        if self.flush_time is not None:
+            stats.gauge('{}.flush_time'.format(self.prefix), round(self.flush_time * 1000, 3))
+
+        for parser in self.parsers:
+            parser.report(stats, self.prefix)
+
+    def timed_flush(self, flush):
+        """
+        Calls flush and remembers how long it took, to be reported with the next flush
+        :return: result of flush
+        """
+        t0 = time.time()
+        try:
+            return flush()
+        finally:
+            self.flush_time = time.time() - t0
@@ -0,0 +1,249 @@
+"""
+Receives syslog messages (RFC3164 or RFC5424) directly over UDP and TCP, without syslog-ng piping them to stdin.
+
+One datagram carries one message. TCP streams may use both framings of RFC6587, detected for every message:
+  octet counting       "<length> <message>", messages may contain new lines
+  non-transparent      messages terminated by a new line
+All sockets are served by a single select loop in the thread iterating the listener, which yields batches of
+messages just like `BatchReader`.
+"""
+
+import os
+import time
+import errno
+import select
+import socket
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_SIZE = 65536
+MAX_DATAGRAMS = 1000  # received from the UDP socket at once, so TCP connections are not starved
+
+
+def parse_address(address):
+    """
+    :param address: "port", "host:port" or "[ipv6]:port"
+    :return: (family, (host, port))
+    """
+    host, _, port = address.rpartition(':')
+    host = host.strip('[]')
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    return family, (host, int(port))
+
+
+class StreamFramer(object):
+    """
+    Splits a TCP stream into syslog messages.
+    """
+
+    def __init__(self, max_size=MAX_MESSAGE_SIZE):
+        self.buffer = ''
+        self.max_size = max_size
+        self.dropped = 0  # bytes dropped because a message exceeded max_size
+
+    def feed(self, data):
+        """
+        :param data: bytes received
+        :return: list of complete messages
+        """
+        buf = self.buffer + data if self.buffer else data
+        messages = []
+        pos = 0
+        size = len(buf)
+        while pos < size:
+            char = buf[pos]
+            if char == '\n' or char == '\r':
+                pos += 1
+                continue
+            if char.isdigit():
+                space = buf.find(' ', pos, pos + 10)
+                if space > 0 and buf[pos:space].isdigit():
+                    end = space + 1 + int(buf[pos:space])
+                    if end > size:
+                        break
+                    messages.append(buf[space + 1:end])
+                    pos = end
+                    continue
+                elif space < 0 and size - pos < 10 and buf[pos:].isdigit():
+                    break  # length not received completely yet
+            end = buf.find('\n', pos)
+            if end < 0:
+                break
+            messages.append(buf[pos:end].rstrip('\r'))
+            pos = end + 1
+
+        self.buffer = buf[pos:] if pos < size else ''
+        if len(self.buffer) > self.max_size:
+            logger.warning('Dropping %d bytes of syslog message exceeding %d bytes', len(self.buffer), self.max_size)
+            self.dropped += len(self.buffer)
+            self.buffer = ''
+        return messages
+
+    def close(self):
+        """
+        :return: list with the last message when the stream ended without a new line
+        """
+        buf, self.buffer = self.buffer.rstrip('\r\n'), ''
+        return [buf] if buf else []
+
+
+class SyslogListener(object):
+    """
+    Listens for syslog messages on UDP and/or TCP and yields them in batches.
+    A partial batch is yielded once its first message waited `max_latency` seconds for more messages.
+    """
+
+    def __init__(self, udp_address=None, tcp_address=None, batch_size=500, max_latency=0.1, recv_buffer=None,
+                 max_message_size=MAX_MESSAGE_SIZE):
+        """
+        :param udp_address: "[host:]port" to receive datagrams on or None
+        :param tcp_address: "[host:]port" to accept connections on or None
+        :param batch_size: max messages in a batch
+        :param max_latency: seconds a partial batch may wait for more messages
+        :param recv_buffer: SO_RCVBUF in bytes, system default if None
+        :param max_message_size: longer messages are dropped
+        :return:
+        """
+        assert udp_address or tcp_address
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.recv_buffer = recv_buffer
+        self.max_message_size = max_message_size
+        self.udp = None
+        self.tcp = None
+        self.connections = dict()  # socket -> StreamFramer
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.stopped = False
+
+        if udp_address:
+            family, address = parse_address(udp_address)
+            self.udp = self.bind(socket.socket(family, socket.SOCK_DGRAM), address)
+            logger.info('Listening for syslog on udp %s:%s', *self.udp.getsockname()[:2])
+        if tcp_address:
+            family, address = parse_address(tcp_address)
+            self.tcp = self.bind(socket.socket(family, socket.SOCK_STREAM), address)
+            self.tcp.listen(128)
+            logger.info('Listening for syslog on tcp %s:%s', *self.tcp.getsockname()[:2])
+
+    def bind(self, sock, address):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.recv_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer)
+        sock.bind(address)
+        sock.setblocking(False)
+        return sock
+
+    def islive(self):
+        """
+        :return: True, senders can not be slowed down so batches are dropped when parsers fall behind
+        """
+        return True
+
+    def stop(self):
+        """
+        Makes iteration finish, can be called from any thread or a signal handler
+        :return: None
+        """
+        self.stopped = True
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError:
+            pass  # already closed
+
+    def __iter__(self):
+        batch = []
+        deadline = None
+        sockets = [self.wakeup_r] + [sock for sock in (self.udp, self.tcp) if sock]
+        try:
+            while not self.stopped:
+                timeout = max(deadline - time.time(), 0) if batch else None
+                try:
+                    readable = select.select(sockets + self.connections.keys(), [], [], timeout)[0]
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                for sock in readable:
+                    if sock is self.tcp:
+                        self.accept()
+                        continue
+                    elif sock is self.udp:
+                        messages = self.receive_datagrams()
+                    elif sock is self.wakeup_r:
+                        os.read(self.wakeup_r, 512)
+                        continue
+                    else:
+                        messages = self.receive_stream(sock)
+
+                    if messages:
+                        if not batch:
+                            deadline = time.time() + self.max_latency
+                        batch.extend(messages)
+
+                while len(batch) >= self.batch_size:
+                    yield batch[:self.batch_size]
+                    batch = batch[self.batch_size:]
+                if batch and time.time() >= deadline:
+                    yield batch
+                    batch = []
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+        if batch:
+            yield batch
+
+    def accept(self):
+        try:
+            sock, address = self.tcp.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                return
+            raise
+        logger.debug('Syslog connection from %s', address)
+        sock.setblocking(False)
+        self.connections[sock] = StreamFramer(self.max_message_size)
+
+    def receive_datagrams(self):
+        messages = []
+        for i in xrange(MAX_DATAGRAMS):
+            try:
+                data = self.udp.recv(self.max_message_size)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            message = data.rstrip('\r\n')
+            if message:
+                messages.append(message)
+        return messages
+
+    def receive_stream(self, sock):
+        framer = self.connections[sock]
+        try:
+            data = sock.recv(self.max_message_size)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            logger.debug('Syslog connection error: %s', e)
+            data = ''
+
+        if data:
+            return framer.feed(data)
+        del self.connections[sock]
+        sock.close()
+        return framer.close()
+
+    def close(self):
+        for sock in self.connections.keys() + [self.udp, self.tcp]:
+            if sock:
+                sock.close()
+        self.connections.clear()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
@@ -6,6 +6,7 @@ STATSD_HOST=localhost
 STATSD_PORT=8125
 STATSD_PREFIX=None
 STATSD_MAXUDPSIZE=512
+STATSD_FLUSH_INTERVAL=1
 """
 
 """
@@ -14,42 +15,224 @@ STATSD_MAXUDPSIZE=512
 :license: Apache License 2.0, see LICENSE-APACHE2.0 for more details.
 """
 
+import os
 import re
 import sys
 import time
+import errno
 import logging
-import fileinput
+import select
+import signal
+import socket
+import inspect
 import argparse
+import string
+import ConfigParser
 import multiprocessing
 from postfix_stats_collector.common import log_init
-from collections import defaultdict, Iterator
-from Queue import Queue, Full
-from threading import Thread, Lock
-
-from statsd.defaults.env import statsd
+from postfix_stats_collector.aggregator import StatsAggregator, Flusher
+from postfix_stats_collector.tracker import MessageTracker, DELAYS
+from postfix_stats_collector.health import CollectorHealth, ParserHealth, PREFIX
+from postfix_stats_collector.exposition import MetricsRegistry, start_http_server
+from postfix_stats_collector.addresses import AddressMatcher
+from postfix_stats_collector.listener import SyslogListener
+from postfix_stats_collector.follow import FollowReader
+from postfix_stats_collector.sampling import LoadShedder, SampledBatch
+from postfix_stats_collector.snapshot import save_snapshot, load_snapshot
+from collections import defaultdict
+from Queue import Queue, Full, Empty
+from threading import Thread
+
+from postfix_stats_collector.sinks import make_sink
 
 logger = logging.getLogger(__name__)
 
+STATSD_FLUSH_INTERVAL = float(os.environ.get("STATSD_FLUSH_INTERVAL", 1))
+
 retype = type(re.compile('nothing'))
 
-local_addresses = dict()
-local_addresses_re = None
+local_addresses = AddressMatcher()
 
+stats = StatsAggregator()
+tracker = MessageTracker(stats, max_messages=0)  # enabled by configure
+health = CollectorHealth()
+registry = None  # MetricsRegistry when metrics are exposed over HTTP
+sink = make_sink()  # StatsD client metrics are sent to
 
-class StdinReader(Iterator):
-    def next(self):
-        try:
-            line = sys.stdin.readline()
-        except KeyboardInterrupt:
-            raise StopIteration
 
-        if not line:
-            raise StopIteration
+def flush_stats():
+    """
+    Ships aggregated metrics, together with the collector's own health, to StatsD and the HTTP registry
+    :return: number of metrics sent
+    """
+    health.report(stats)
+    return health.timed_flush(send_stats)
+
 
-        return line
+def send_stats():
+    metrics = stats.swap()
+    if registry:
+        registry.update(metrics)
+    return metrics.send(sink)
+
+
+class BatchReader(object):
+    """
+    Reads syslog lines from stdin or files in large blocks and yields them in batches (lists of lines without
+    trailing new lines).
+    Reading stdin, a partial batch is yielded once its first line waited `max_latency` seconds for more lines.
+    """
+
+    def __init__(self, log_files=None, batch_size=500, max_latency=0.1, block_size=65536):
+        """
+        :param log_files: list of file names, None or "-" for stdin
+        :param batch_size: max lines in a batch
+        :param max_latency: seconds a partial batch may wait for more lines
+        :param block_size: bytes read at once
+        :return:
+        """
+        if not log_files or log_files[0] == '-':
+            log_files = None
+        self.log_files = log_files
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.block_size = block_size
+        self.stopped = False
 
     def isstdin(self):
-        return True
+        return self.log_files is None
+
+    def islive(self):
+        """
+        :return: whether lines are produced by someone else while we read them, parsers falling behind then drop
+                 batches instead of blocking the writer
+        """
+        return self.isstdin()
+
+    def stop(self):
+        """
+        Makes iteration finish, to be called from a signal handler
+        :return: None
+        """
+        self.stopped = True
+
+    def __iter__(self):
+        if self.isstdin():
+            for batch in self.read_batches(sys.stdin.fileno(), wait=True):
+                yield batch
+        else:
+            for log_file in self.log_files:
+                if self.stopped:
+                    break
+                with open(log_file, 'rb') as f:
+                    for batch in self.read_batches(f.fileno(), wait=False):
+                        yield batch
+
+    def read_batches(self, fd, wait):
+        """
+        :param fd: file descriptor
+        :param wait: whether partial batches should be yielded after `max_latency` when no data is available
+        :return: generator of batches
+        """
+        batch = []
+        partial = ''
+        deadline = None
+        while not self.stopped:
+            if wait and batch:
+                timeout = deadline - time.time()
+                try:
+                    readable = timeout > 0 and select.select([fd], [], [], timeout)[0]
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if not readable:
+                    yield batch
+                    batch = []
+                    continue
+
+            try:
+                block = os.read(fd, self.block_size)
+            except KeyboardInterrupt:
+                block = ''
+            except OSError, e:
+                if e.errno == errno.EINTR:  # signal, ie. SIGTERM stopping the reader
+                    continue
+                raise
+
+            if not block:
+                break
+
+            lines = (partial + block).split('\n') if partial else block.split('\n')
+            partial = lines.pop()
+            if not batch:
+                deadline = time.time() + self.max_latency
+                batch = lines
+            else:
+                batch.extend(lines)
+
+            while len(batch) >= self.batch_size:
+                yield batch[:self.batch_size]
+                batch = batch[self.batch_size:]
+
+        if partial:
+            batch.append(partial)
+        if batch:
+            yield batch
+
+
+class MetricNames(object):
+    """
+    Bounded memo of metric names built from values found in logs, so repeated (direction, value) pairs reuse the same
+    string instead of formatting a new one for every line. Dots in values are replaced by "_", so values like DSN
+    codes do not create a tree.
+    """
+
+    def __init__(self, template, max_size=1000):
+        """
+        :param template: format string taking direction and value
+        :param max_size: number of names kept, the memo starts over once it is full
+        :return:
+        """
+        self.template = template
+        self.max_size = max_size
+        self.names = defaultdict(dict)  # direction -> {value -> name}
+        self.size = 0
+
+    def __call__(self, direction, value):
+        names = self.names[direction]
+        name = names.get(value)
+        if name is None:
+            if self.size >= self.max_size:
+                self.names.clear()
+                self.size = 0
+                names = self.names[direction]
+            name = names[value] = self.template.format(direction, value.replace('.', '_'))
+            self.size += 1
+        return name
+
+
+status_names = MetricNames('postfix.messages.{}.status.{}')
+resp_code_names = MetricNames('postfix.messages.{}.resp_codes.{}')
+delay_names = dict()  # direction -> names of histograms of delay and its parts
+
+
+def observe_delays(direction, delay, delays):
+    """
+    Adds delays of a delivery to the recipient to histograms of the direction, in milliseconds
+    :param direction: "send", "recv" or "local"
+    :param delay: total delay, ie. "0.1"
+    :param delays: delay breakdown, ie. "0.04/0.02/0.04/0"
+    :return: None
+    """
+    if not stats.quantiles:
+        return
+    names = delay_names.get(direction)
+    if names is None:
+        names = delay_names[direction] = ['postfix.delays.{}.{}'.format(direction, name) for name in ('total',) + DELAYS]
+    stats.observe(names[0], float(delay) * 1000)
+    for name, value in zip(names[1:], delays.split('/')):
+        stats.observe(name, float(value) * 1000)
 
 
 class Handler(object):
@@ -57,82 +240,94 @@ class Handler(object):
     Class representing abstract log handler. Never instantiate directly, always inherit to implement a specific log
     handler.
     To enable handler, just instantiate class and object will self-register within global Handler.handlers
+    `handle` receives groups of `filter_re` as positional arguments, so its arguments must follow the order of groups.
+    `prefilter` is a literal every matching line contains, lines without it are skipped before running `filter_re`.
     """
     filter_re = re.compile(r'(?!)')
+    prefilter = None
     facilities = None
+    name = None
     handlers = defaultdict(list)  # a class variable; global dictionary of facility -> [handler,...]
 
     def __init__(self, *args, **kwargs):
         assert self.__class__.__name__ != 'Handler'
         assert isinstance(self.filter_re, retype)
+        spec = inspect.getargspec(self.handle)
+        groups = sorted(self.filter_re.groupindex, key=self.filter_re.groupindex.get)
+        assert spec.varargs or spec.args[1:] == groups, \
+            '{}.handle arguments must follow groups of filter_re: {}'.format(self.__class__.__name__, groups)
+        self.name = self.name or self.__class__.__name__
         self.register(self.facilities)
 
     def parse(self, line):
+        if self.prefilter is not None and self.prefilter not in line:
+            return False
         pline = self.filter_re.match(line)
 
         if pline:
-            logger.debug(pline.groupdict())
-            self.handle(**pline.groupdict())
+            self.dispatch(pline)
+        return pline is not None
+
+    def dispatch(self, pline):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s: %s', self.name, pline.groupdict())
+        self.handle(*pline.groups())
 
-    def handle(self, **kwargs):
+    def handle(self, *args):
         raise NotImplementedError()
 
     def register(self, facilities):
         facilities = set(facilities)
         for facility in facilities:
-            if self not in Handler.handlers[facility]:
-                Handler.handlers[facility].append(self)
+            handlers = Handler.handlers[facility]
+            # registering again replaces previously registered instance of the same handler
+            handlers[:] = [handler for handler in handlers if handler.name != self.name]
+            handlers.append(self)
 
         self.facilities |= facilities
 
 
 class BounceHandler(Handler):
     facilities = set(['bounce'])
+    prefilter = ': sender non-delivery notification: '
     filter_re = re.compile((r'\A(?P<message_id>\w+?): sender non-delivery notification: (?P<bounce_message_id>\w+?)\Z'))
 
     def handle(self, message_id=None, bounce_message_id=None):
-        statsd.incr('postfix.messages.bounce', 1)
+        stats.incr('postfix.messages.bounce', 1)
 
 
 class CleanupHandler(Handler):
     facilities = set(['cleanup'])
+    prefilter = ': message-id=<'
     filter_re = re.compile(r'\A(?P<message_id>\w+?): message-id=\<(?P<ext_message_id>.+?)\>\Z')
 
     def handle(self, message_id=None, ext_message_id=None):
-        statsd.incr('postfix.messages.cleanup', 1)
+        stats.incr('postfix.messages.cleanup', 1)
+        tracker.cleanup(message_id)
 
 
 class LocalHandler(Handler):
     facilities = set(['local'])
+    prefilter = ': to=<'
     filter_re = re.compile(r'\A(?P<message_id>\w+?): to=\<(?P<to_email>.*?)\>, orig_to=\<(?P<orig_to_email>.*?)\>, relay=(?P<relay>.+?), delay=(?P<delay>[0-9\.]+), delays=(?P<delays>[0-9\.\/]+), dsn=(?P<dsn>[0-9\.]+), status=(?P<status>\w+) \((?P<response>.+?)\)\Z')
-    local_addresses_re = re.compile(r'(?!)')
 
     def __init__(self, *args, **kwargs):
         super(LocalHandler, self).__init__(*args, **kwargs)
-
-        if local_addresses_re:
-            assert isinstance(local_addresses_re, retype)
-            self.local_addresses_re = local_addresses_re
         self.local_addresses = local_addresses
 
     def handle(self, message_id=None, to_email=None, orig_to_email=None, relay=None, delay=None, delays=None, dsn=None, status=None, response=None):
-        pemail = self.local_addresses_re.search(to_email)
-
-        if pemail:
-            search = pemail.group(1)
+        tracker.delivered(message_id, delay, delays)
+        observe_delays('local', delay, delays)
+        found = self.local_addresses.match(to_email) if self.local_addresses else None
 
-            name, count = self.local_addresses[search]
+        if found:
+            search, (name, count) = found
 
             logger.debug('Local address <%s> count (%s) as "%s"', search, count, name)
 
-            statsd.incr('postfix.messages.local', 1)
-            statsd.incr('postfix.messages.in.status.{}'.format(status), 1)
-            statsd.incr('postfix.messages.in.resp_codes.{}'.format(dsn.replace(".", "_")), 1)   # we don't want to create tree from domain name so "." are forbidden
-            # with stats_lock:
-            #     stats['local'][name] += 1
-            #     if count:
-            #         stats['in']['status'][status] += 1
-            #         stats['in']['resp_codes'][dsn] += 1
+            stats.incr('postfix.messages.local', 1)
+            stats.incr(status_names('in', status), 1)
+            stats.incr(resp_code_names('in', dsn), 1)
 
 
 class QmgrHandler(Handler):
@@ -140,34 +335,126 @@ class QmgrHandler(Handler):
     filter_re = re.compile(r'\A(?P<message_id>\w+?): (?:(?P<removed>removed)|(?:from=\<(?P<from_address>.*?)\>, size=(?P<size>[0-9]+), nrcpt=(?P<nrcpt>[0-9]+) \(queue (?P<queue>[a-z]+)\)))?\Z')
 
     def handle(self, message_id=None, removed=None, from_address=None, size=None, nrcpt=None, queue=None):
-        pass
+        if removed:
+            tracker.removed(message_id)
+        elif size is not None:
+            tracker.queued(message_id, size, nrcpt)
+            if from_address:
+                stats.top('senders', from_address.rpartition('@')[2].lower())
 
 
 class SmtpHandler(Handler):
     facilities = set(['smtp', 'error'])
+    prefilter = ': to=<'
     filter_re = re.compile(r'\A(?P<message_id>\w+?): to=\<(?P<to_email>.+?)\>, relay=(?P<relay>.+?), (?:conn_use=(?P<conn_use>\d), )?delay=(?P<delay>[0-9\.]+), delays=(?P<delays>[0-9\.\/]+), dsn=(?P<dsn>[0-9\.]+), status=(?P<status>\w+) \((?P<response>.+?)\)\Z')
 
     def handle(self, message_id=None, to_email=None, relay=None, conn_use=None, delay=None, delays=None, dsn=None, status=None, response=None):
         stat = 'recv' if '127.0.0.1' in relay else 'send'
-        statsd.incr('postfix.messages.{}.status.{}'.format(stat, status), 1)
-        statsd.incr('postfix.messages.{}.resp_codes.{}'.format(stat, dsn.replace(".", "_")), 1)   # we don't want to create tree from domain name so "." are forbidden
-
-        # with stats_lock:
-        #     stats[stat]['status'][status] += 1
-        #     stats[stat]['resp_codes'][dsn] += 1
+        stats.incr(status_names(stat, status), 1)
+        stats.incr(resp_code_names(stat, dsn), 1)
+        tracker.delivered(message_id, delay, delays)
+        observe_delays(stat, delay, delays)
+        if relay != 'none':
+            stats.top('relays', relay.partition('[')[0])
 
 
 class SmtpdHandler(Handler):
     facilities = set(['smtpd'])
+    prefilter = ': client='
     filter_re = re.compile(r'\A(?P<message_id>\w+?): client=(?P<client_hostname>[.\w-]+)\[(?P<client_ip>[A-Fa-f0-9.:]{3,39})\](?:, sasl_method=[\w-]+)?(?:, sasl_username=[-_.@\w]+)?(?:, sasl_sender=\S)?(?:, orig_queue_id=\w+)?(?:, orig_client=(?P<orig_client_hostname>[.\w-]+)\[(?P<orig_client_ip>[A-Fa-f0-9.:]{3,39})\])?\Z')
 
     def handle(self, message_id=None, client_hostname=None, client_ip=None, orig_client_hostname=None, orig_client_ip=None):
-        statsd.incr('postfix.messages.smtpd', 1)
+        stats.incr('postfix.messages.smtpd', 1)
+        stats.top('clients', orig_client_ip or client_ip)
+
+
+class RuleHandler(Handler):
+    """
+    Handler declared by a rule instead of code, see `load_rules`.
+    """
+
+    def __init__(self, name, facilities, pattern, prefilter=None, incr=(), top=()):
+        """
+        :param name: name of the rule
+        :param facilities: facilities the rule applies to
+        :param pattern: regular expression matched at the start of messages
+        :param prefilter: literal every matching message contains
+        :param incr: counters to increment, "{group}" is replaced by value of the named group
+        :param top: (kind, group) pairs offered to heavy hitters
+        :return:
+        """
+        self.name = name
+        self.facilities = set(facilities)
+        self.filter_re = re.compile(pattern)
+        self.prefilter = prefilter
+        self.incr = [(template, '{' in template) for template in incr]
+        self.top = top
+        groups = [group for kind, group in top]
+        for template in incr:
+            groups.extend(field for _, field, _, _ in string.Formatter().parse(template) if field is not None)
+        for group in groups:
+            if group not in self.filter_re.groupindex:
+                raise ValueError('Rule {} uses group "{}" missing in pattern'.format(name, group))
+        super(RuleHandler, self).__init__()
+
+    def dispatch(self, pline):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s: %s', self.name, pline.groupdict())
+        groups = None
+        for template, formatted in self.incr:
+            if formatted:
+                if groups is None:
+                    groups = dict((group, (value or '').replace('.', '_'))
+                                  for group, value in pline.groupdict().iteritems())
+                template = template.format(**groups)
+            stats.incr(template, 1)
+        for kind, group in self.top:
+            value = pline.group(group)
+            if value:
+                stats.top(kind, value)
+
+    def handle(self, *args):
         pass
-        # ip = orig_client_ip or client_ip
-        #
-        # with stats_lock:
-        #     stats['clients'][ip] += 1
+
+
+def load_rules(path):
+    """
+    Registers handlers declared in an INI file, each section being a rule:
+      facility    comma separated facilities the rule applies to
+      pattern     regular expression matched at the start of the message
+      prefilter   literal the message must contain before pattern is tried (optional)
+      incr        comma separated counters to increment, "{group}" is replaced by value of the named group with "."
+                  replaced by "_"
+      top         comma separated "kind:group" pairs offered to heavy hitters (optional, see --top)
+    :param path: rule file
+    :return: list of RuleHandler
+    """
+    parser = ConfigParser.RawConfigParser()
+    if not parser.read(path):
+        raise IOError('Can not read rules from {}'.format(path))
+
+    def values(section, option):
+        if not parser.has_option(section, option):
+            return []
+        return [value.strip() for value in parser.get(section, option).split(',') if value.strip()]
+
+    rules = []
+    for section in parser.sections():
+        facilities = values(section, 'facility')
+        if not facilities or not parser.has_option(section, 'pattern'):
+            raise ValueError('Rule {} in {} needs facility and pattern'.format(section, path))
+        top = [tuple(value.split(':', 1)) for value in values(section, 'top')]
+        if not all(len(pair) == 2 for pair in top):
+            raise ValueError('Rule {} in {} needs top as kind:group'.format(section, path))
+        try:
+            rules.append(RuleHandler(
+                section, facilities, parser.get(section, 'pattern'),
+                prefilter=parser.get(section, 'prefilter') if parser.has_option(section, 'prefilter') else None,
+                incr=values(section, 'incr'), top=top))
+        except re.error, e:
+            raise ValueError('Rule {} in {} has invalid pattern: {}'.format(section, path, e))
+    logger.debug('Loaded %d rules from %s', len(rules), path)
+    return rules
 
 
 def register_handlers(handlers=[BounceHandler, CleanupHandler, LocalHandler, QmgrHandler, SmtpHandler, SmtpdHandler]):
@@ -179,123 +466,739 @@ def register_handlers(handlers=[BounceHandler, CleanupHandler, LocalHandler, Qmg
         handler()
 
 
+def parse_envelope(line, facilities=None):
+    """
+    Splits syslog line into its envelope fields using plain string scanning instead of regex.
+    Supported formats:
+      Nov  1 06:25:09 host postfix/smtp[5002]: message                      (RFC3164, also "Jul 2 12:24:48")
+      2015-11-01T06:25:09.123+00:00 host postfix/smtp[5002]: message        (RFC3164 with ISO timestamp)
+      <22>1 2015-11-01T06:25:09Z host postfix/smtp 5002 - - message         (RFC5424)
+    Facility is the part of program name after last "/", ie. "smtp" for "postfix/smtp".
+    :param line: syslog line without trailing new line
+    :param facilities: container of accepted facilities, lines for other facilities are dropped before any other
+                       field is extracted
+    :return: (iso_date, source, facility, message) or None
+    """
+    first = line[:1]
+    if first != '<' and not first.isdigit():
+        # fast path for the most common "date host program[pid]: message", scanned backwards from the tag terminator
+        message_start = line.find(']: ')
+        if message_start > 0:
+            program_end = line.rfind('[', 0, message_start)
+            program_start = line.rfind(' ', 0, program_end) + 1
+            facility = line[line.rfind('/', program_start, program_end) + 1:program_end]
+            if facilities is not None and facility not in facilities:
+                return None
+            source_start = line.rfind(' ', 0, program_start - 1) + 1
+            if source_start:
+                return line[:source_start - 1], line[source_start:program_start - 1], facility, line[message_start + 3:]
+
+    pos = 0
+    if line.startswith('<'):  # priority
+        pos = line.find('>') + 1
+        if not pos:
+            return None
+    rfc5424 = line.startswith('1 ', pos)
+    if rfc5424:
+        pos += 2
+
+    if line[pos:pos + 1].isdigit():  # ISO timestamp is a single token
+        date_end = line.find(' ', pos)
+        if date_end < 0:
+            return None
+    else:  # "Mmm dd hh:mm:ss", we locate the time by its first colon
+        colon = line.find(':', pos)
+        date_end = colon + 6
+        if colon < 0 or line[colon + 3:colon + 4] != ':' or line[date_end:date_end + 1] != ' ':
+            return None
+
+    source_start = date_end + 1
+    source_end = line.find(' ', source_start)
+    if source_end < 0:
+        return None
+
+    program_start = source_end + 1
+    if rfc5424:
+        program_end = line.find(' ', program_start)
+        message_start = program_end
+    else:
+        message_start = line.find(': ', program_start)
+        if message_start < 0:
+            return None
+        program_end = line.find('[', program_start, message_start)
+        if program_end < 0:
+            program_end = message_start
+    if program_end < 0:
+        return None
+
+    facility = line[line.rfind('/', program_start, program_end) + 1:program_end]
+    if facilities is not None and facility not in facilities:
+        return None
+
+    if rfc5424:
+        message_start = skip_rfc5424_header(line, message_start)
+        if message_start < 0:
+            return None
+    else:
+        message_start += 2
+
+    return line[pos:date_end], line[source_start:source_end], facility, line[message_start:]
+
+
+def skip_rfc5424_header(line, pos):
+    """
+    Skips PROCID, MSGID and STRUCTURED-DATA fields of RFC5424 message
+    :param line: syslog line
+    :param pos: offset of the space following APP-NAME
+    :return: offset of MSG or -1
+    """
+    for i in xrange(2):  # PROCID, MSGID
+        pos = line.find(' ', pos + 1)
+        if pos < 0:
+            return -1
+    pos += 1
+
+    if line.startswith('-', pos):
+        pos += 1
+    else:
+        while line.startswith('[', pos):
+            pos = line.find(']', pos)
+            while pos > 0 and line[pos - 1] == '\\':  # escaped "]" within PARAM-VALUE
+                pos = line.find(']', pos + 1)
+            if pos < 0:
+                return -1
+            pos += 1
+
+    if line.startswith(' ', pos):
+        pos += 1
+    if line.startswith('\xef\xbb\xbf', pos):  # BOM
+        pos += 3
+    return pos
+
+
 class Parser(Thread):
     """
     Worker thread parsing syslog formatted logs.
     It detests facility of log and then sends it to appropriate registered handler.
     """
     lines = None  # Queue object
-    line_re = re.compile(r'\A(?P<iso_date>\D{3}\s+\d{1,2}\s+\d{2}:\d{2}:\d{2})\s+(?P<source>.+?)\s+(?P<facility>.+?)\[(?P<pid>\d+?)\]:\s(?P<message>.*)\Z')
 
-    def __init__(self, lines):
+    def __init__(self, lines, health=None):
+        """
+        :param lines: Queue of line batches
+        :param health: ParserHealth or None
+        :return:
+        """
         super(Parser, self).__init__()
         self.lines = lines
+        self.health = health
         self.daemon = True
         self.start()
 
     def run(self):
+        health = self.health
         while True:
-            line = self.lines.get()
+            batch = self.lines.get()
+            t0 = time.time()
+            stats.set_scale(getattr(batch, 'scale', 1))
 
             try:
-                self.parse_line(line)
-            except Exception, e:
-                logger.exception('Error parsing line: %s', line)
+                for line in batch:
+                    try:
+                        self.parse_line(line, health)
+                    except Exception, e:
+                        logger.exception('Error parsing line: %s', line)
+                        if health:
+                            health.errors += 1
             finally:
+                if health:
+                    health.busy_time += time.time() - t0
                 self.lines.task_done()
 
-    def parse_line(self, line):
-        pln = self.line_re.match(line)
-
-        if pln:
-            pline = pln.groupdict()
-            logger.debug(pline)
-
-            facility = pline['facility'].split('/')
+    @classmethod
+    def parse_line(cls, line, health=None):
+        envelope = parse_envelope(line, Handler.handlers)
+
+        if not envelope:
+            if health:
+                health.ignored += 1
+            return
+
+        logger.debug(envelope)
+        iso_date, source, facility, message = envelope
+        if stats.max_hosts:
+            stats.set_host(source)
+
+        if not health:
+            for handler in Handler.handlers[facility]:
+                handler.parse(message)
+            return
+
+        health.parsed += 1
+        matched = False
+        for handler in Handler.handlers[facility]:
+            t0 = time.time()
+            if handler.prefilter is not None and handler.prefilter not in message:
+                pline = None
+            else:
+                pline = handler.filter_re.match(message)
+            health.handler_time[handler.name] += time.time() - t0
+            if pline:
+                matched = True
+                health.handler_matches[handler.name] += 1
+                handler.dispatch(pline)
+        if matched:
+            health.matched += 1
+        else:
+            health.unmatched += 1
+
+
+class LinesDropped(Full):
+    """
+    Raised by parser pools when queues of parsers were full and `lines` lines were dropped
+    """
 
-            for handler in Handler.handlers[facility[-1]]:
-                handler.parse(pline['message'])
+    def __init__(self, lines):
+        super(LinesDropped, self).__init__(lines)
+        self.lines = lines
 
 
 class ParserPool(object):
-    def __init__(self, num_parsers):
+    def __init__(self, num_parsers, queue_size=None, health=None):
         """
         :param num_parsers: parsing threads
+        :param queue_size: max batches waiting for parsers, defaults to 1000 per parser
+        :param health: CollectorHealth instrumenting the parsers or None
         :return:
         """
-        self.lines = Queue(num_parsers * 1000)
+        self.capacity = queue_size or num_parsers * 1000
+        self.lines = Queue(self.capacity)
 
         for i in xrange(num_parsers):
             logger.info('Starting parser %s', i)
-            Parser(self.lines)
+            Parser(self.lines, health.parser('thread{}'.format(i)) if health else None)
+        if health:
+            health.queue_depth = self.depth
+
+    def depth(self):
+        """
+        :return: number of batches waiting for parsers
+        """
+        return self.lines.qsize()
 
     def add_line(self, line, block=False):
-        self.lines.put(line, block)
+        self.add_batch((line,), block)
+
+    def add_batch(self, lines, block=False):
+        """
+        Queues whole batch of lines at once, taking queue lock only once
+        :param lines: list of lines
+        :param block: wait for a free slot in the queue instead of raising LinesDropped
+        :return: None
+        """
+        try:
+            self.lines.put(lines, block)
+        except Full:
+            raise LinesDropped(len(lines))
 
     def join(self):
         self.lines.join()
 
 
-def process(log_files, concurrency=None, local_emails=None):
-    print("Starting log parsing for: {}".format(reduce(lambda x, y: "{}, {}".format(x,y), log_files)))
-    print('Press Ctrl+C to exit')
+def queue_id(line):
+    """
+    Cheap extraction of postfix queue ID (ie. "7774E75F4") from syslog line, used for sharding lines between workers
+    Accepts the same formats as `parse_envelope`.
+    :param line: syslog line
+    :return: queue ID or empty string
+    """
+    pos = line.find('>') + 1 if line.startswith('<') else 0
+    if line.startswith('1 ', pos):  # RFC5424, MSG follows the header instead of "program[pid]: "
+        start = pos + 1
+        for i in xrange(3):  # TIMESTAMP, HOSTNAME, APP-NAME
+            start = line.find(' ', start + 1)
+            if start < 0:
+                return ''
+        start = skip_rfc5424_header(line, start)
+        if start < 0:
+            return ''
+    else:
+        start = line.find(']: ')
+        if start < 0:
+            return ''
+        start += 3
+    end = line.find(':', start)
+    if end < 0:
+        return ''
+    return line[start:end]
 
-    # handle local_emails
-    global local_addresses_re
-    global local_addresses
-    true_values = ['yes', '1', 'true']
-    for local_email in local_emails:
+
+class ParserProcess(multiprocessing.Process):
+    """
+    Worker process parsing batches of syslog lines.
+    Metrics are aggregated locally and sent back to the parent every `report_interval` seconds.
+    """
+
+    def __init__(self, lines, results, report_interval=1, health=None, shard=None):
+        """
+        :param lines: multiprocessing.Queue of line batches, None stops the worker
+        :param results: multiprocessing.Queue receiving Metrics, tracked messages and None on exit
+        :param report_interval: seconds between reports to the parent
+        :param health: ParserHealth reported together with the metrics or None
+        :param shard: (index, count) of the worker's shard, messages of the shard tracked by the parent are kept
+        :return:
+        """
+        super(ParserProcess, self).__init__()
+        self.lines = lines
+        self.results = results
+        self.report_interval = report_interval
+        self.health = health
+        self.shard = shard
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_IGN)  # parent decides when to stop
+        stats.reset()  # drop whatever was inherited from the parent
+        if self.shard:
+            index, count = self.shard
+            tracker.reset(lambda message_id: hash(message_id) % count == index)
+        else:
+            tracker.reset()
+        health = self.health
+        last_report = time.time()
+
+        while True:
+            timeout = max(last_report + self.report_interval - time.time(), 0)
+            try:
+                batch = self.lines.get(timeout=timeout)
+            except Empty:
+                batch = ()  # quiet log, report on schedule anyway
+            if batch is None:
+                break
+
+            t0 = time.time()
+            stats.set_scale(getattr(batch, 'scale', 1))
+            for line in batch:
+                try:
+                    Parser.parse_line(line, health)
+                except Exception:
+                    logger.exception('Error parsing line: %s', line)
+                    if health:
+                        health.errors += 1
+            stats.set_scale(1)
+            stats.set_host(None)  # health of the worker is not counted for the host of the last line
+            if health:
+                health.busy_time += time.time() - t0
+
+            if time.time() - last_report >= self.report_interval:
+                self.report()
+                last_report = time.time()
+
+        self.report()
+        self.results.put(tracker.dump())
+        self.results.put(None)
+
+    def report(self):
+        if self.health:
+            self.health.report(stats, health.prefix)
+        self.results.put(stats.swap())
+
+
+class ProcessParserPool(object):
+    """
+    Pool of parsing processes, not limited by GIL.
+    Lines are sharded by postfix queue ID, so all lines of a single message are parsed in order by the same worker.
+    """
+
+    def __init__(self, num_parsers, batch_size=100, max_latency=0.5, health=None):
+        """
+        :param num_parsers: parsing processes
+        :param batch_size: lines sent to a worker at once
+        :param max_latency: seconds a partial batch may wait for more lines
+        :param health: CollectorHealth instrumenting the workers or None
+        :return:
+        """
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.results = multiprocessing.Queue()
+        self.queues = []
+        self.pending = []
+        self.workers = []
+        self.scale = 1  # of lines pending for workers
+        queue_size = max(1000 / batch_size, 2)
+        self.capacity = num_parsers * queue_size
+        for i in xrange(num_parsers):
+            logger.info('Starting parser process %s', i)
+            lines = multiprocessing.Queue(queue_size)
+            self.queues.append(lines)
+            self.pending.append([])
+            worker_health = ParserHealth('process{}'.format(i)) if health else None
+            self.workers.append(ParserProcess(lines, self.results, health=worker_health, shard=(i, num_parsers)))
+        self.last_sent = time.time()
+        tracker.reset()  # workers took over their shards of tracked messages
+        if health:
+            health.queue_depth = self.depth
+
+        self.collector = Thread(target=self.collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def collect(self):
+        """
+        Merges metrics reported by workers into the parent's aggregator, messages still tracked by exiting workers
+        are taken over by the parent's tracker
+        :return: None
+        """
+        running = len(self.workers)
+        while running:
+            result = self.results.get()
+            if result is None:
+                running -= 1
+            elif isinstance(result, list):
+                tracker.load(result)
+            else:
+                stats.merge(result)
+
+    def depth(self):
+        """
+        :return: number of batches waiting for workers
+        """
+        return sum(lines.qsize() for lines in self.queues)
+
+    def add_line(self, line, block=False):
+        shard = hash(queue_id(line)) % len(self.queues)
+        pending = self.pending[shard]
+        pending.append(line)
+
+        dropped = 0
+        if len(pending) >= self.batch_size:
+            dropped = self.send(shard, block)
+        elif time.time() - self.last_sent >= self.max_latency:
+            dropped = self.send_all(block)
+        if dropped:
+            raise LinesDropped(dropped)
+
+    def add_batch(self, lines, block=False):
+        """
+        Shards batch of lines and sends each shard straight to its worker
+        :param lines: list of lines
+        :param block: wait for a free slot in the queues instead of raising LinesDropped
+        :return: None
+        """
+        dropped = 0
+        scale = getattr(lines, 'scale', 1)
+        if scale != self.scale:
+            dropped = self.send_all(block)  # pending lines were sampled at the previous rate
+            self.scale = scale
+        num_shards = len(self.queues)
+        for line in lines:
+            self.pending[hash(queue_id(line)) % num_shards].append(line)
+        dropped += self.send_all(block)
+        if dropped:
+            raise LinesDropped(dropped)
+
+    def send(self, shard, block=True):
+        """
+        Sends pending lines of a shard to its worker, they are dropped if the worker's queue is full
+        :return: number of lines dropped
+        """
+        batch = self.pending[shard]
+        if not batch:
+            return 0
+        self.pending[shard] = []
+        if self.scale != 1:
+            batch = SampledBatch(batch, self.scale)
         try:
-            search, name, count = local_email.strip('()').split(',')
-        except ValueError:
-            logger.error('LOCAL_TUPLE requires 3 fields: %s', local_email)
-            return -1
+            self.queues[shard].put(batch, block)
+        except Full:
+            return len(batch)
+        return 0
 
-        local_addresses[search] = (name, count.lower() in true_values)
+    def send_all(self, block=True):
+        """
+        Sends pending lines of all shards, a full queue of one worker does not hold back the others
+        :return: number of lines dropped
+        """
+        dropped = sum(self.send(shard, block) for shard in xrange(len(self.queues)))
+        self.last_sent = time.time()
+        return dropped
 
-    if local_addresses:
-        local_addresses_re = re.compile(r'(%s)' % '|'.join(local_addresses.keys()))
-        logger.debug('Local email pattern: %s', local_addresses_re.pattern)
-    else:
-        local_addresses_re = re.compile(r'(?!)')
+    def join(self):
+        """
+        Sends all pending lines, stops workers and waits until their metrics are merged
+        :return: None
+        """
+        self.send_all()
+        for lines in self.queues:
+            lines.put(None)
+        self.collector.join()
+        for worker in self.workers:
+            worker.join()
+
+
+def configure(local_emails=None, local_files=(), rule_files=(), track_messages=0, track_ttl=7200,
+              self_prefix=PREFIX, max_hosts=0, top_k=0, top_capacity=1000, quantiles=()):
+    """
+    Registers handlers and configures what they collect
+    :return: False if local addresses or rules could not be loaded
+    """
+    # handle local_emails
+    try:
+        for local_email in local_emails or ():
+            local_addresses.add_spec(local_email)
+        for local_file in local_files:
+            local_addresses.load(local_file)
+        local_addresses.build()  # before parser threads match concurrently
+    except (IOError, ValueError), e:
+        logger.error('%s', e)
+        return False
+    logger.debug('Local address rules: %d', len(local_addresses))
 
     # register all handlers
     register_handlers()
+    try:
+        for rule_file in rule_files:
+            load_rules(rule_file)
+    except (IOError, ValueError, ConfigParser.Error), e:
+        logger.error('%s', e)
+        return False
+    tracker.max_messages = track_messages
+    tracker.ttl = track_ttl
+
+    health.prefix = self_prefix
+    stats.max_hosts = max_hosts
+    stats.top_k = top_k
+    stats.top_capacity = top_capacity
+    stats.quantiles = quantiles
+    return True
+
+
+def process(log_files, concurrency=None, local_emails=None, local_files=(), flush_interval=STATSD_FLUSH_INTERVAL,
+            flush_size=1000, processes=False, batch_size=500, batch_latency=0.1, track_messages=0, track_ttl=7200,
+            self_prefix=PREFIX, http_port=None, http_addr='', listen_udp=None, listen_tcp=None, recv_buffer=None,
+            max_hosts=0, top_k=0, top_capacity=1000, quantiles=(), rule_files=(), follow=False, checkpoint=None,
+            checkpoint_interval=5, max_sampling=0, shed_watermark=0.5, sink_spec=None, jobs=(), snapshot=None,
+            states=()):
+    if follow and (len(log_files) != 1 or log_files[0] == '-'):
+        logger.error('Following needs exactly one log file')
+        return -1
+
+    if listen_udp or listen_tcp:
+        print("Starting log parsing for syslog received on: {}".format(
+            ', '.join('{} {}'.format(proto, address) for proto, address in (('udp', listen_udp), ('tcp', listen_tcp))
+                      if address)))
+    else:
+        print("Starting log parsing for: {}".format(reduce(lambda x, y: "{}, {}".format(x,y), log_files)))
+    print('Press Ctrl+C to exit')
+
+    if not configure(local_emails=local_emails, local_files=local_files, rule_files=rule_files,
+                     track_messages=track_messages, track_ttl=track_ttl, self_prefix=self_prefix, max_hosts=max_hosts,
+                     top_k=top_k, top_capacity=top_capacity, quantiles=quantiles):
+        return -1
 
-    # kick parser
-    parser_pool = ParserPool(concurrency)
-    if not log_files or log_files[0] is '-':
-        reader = StdinReader()
+    # state kept across restarts, loaded before worker processes fork
+    parts = dict(metrics=stats, tracker=tracker)
+    parts.update(states)
+    if snapshot:
+        load_snapshot(snapshot, parts)
+
+    global registry, sink
+    if sink_spec:
+        try:
+            sink = make_sink(sink_spec)
+        except (ValueError, IOError, socket.error), e:
+            logger.error('%s', e)
+            return -1
+
+    # kick parser, worker processes are forked before any other thread is started
+    if processes:
+        parser_pool = ProcessParserPool(concurrency, batch_size=batch_size, max_latency=batch_latency, health=health)
+    else:
+        parser_pool = ParserPool(concurrency, queue_size=max(concurrency * 1000 / batch_size, concurrency),
+                                 health=health)
+
+    # serve metrics once workers are forked, so they inherit neither the listening socket nor locks of its thread
+    if http_port is not None:
+        registry = MetricsRegistry()
+        start_http_server(registry, http_port, http_addr)
+
+    # ship aggregated counters in the background
+    stats.max_pending = flush_size
+    flusher = Flusher(stats, flush_stats, flush_interval)
+    for interval, job in jobs:  # ie. qshape collection of the combined daemon
+        flusher.every(interval, job)
+    flusher.start()
+
+    if listen_udp or listen_tcp:
+        reader = SyslogListener(listen_udp, listen_tcp, batch_size=batch_size, max_latency=batch_latency,
+                                recv_buffer=recv_buffer)
+    elif follow:
+        reader = FollowReader(log_files[0], batch_size=batch_size, max_latency=batch_latency, checkpoint=checkpoint,
+                              checkpoint_interval=checkpoint_interval)
     else:
-        reader = fileinput.input(log_files)
+        reader = BatchReader(log_files, batch_size=batch_size, max_latency=batch_latency)
+
+    def stop(signum, frame):  # stop gracefully, so pending metrics are flushed or saved in the snapshot
+        logger.info('Stopping on signal %s', signum)
+        reader.stop()
+    handlers = dict((signum, signal.signal(signum, stop)) for signum in (signal.SIGTERM, signal.SIGHUP))
+
+    shedder = None
+    if max_sampling > 1 and reader.islive():
+        shedder = LoadShedder(parser_pool.depth, parser_pool.capacity, queue_id, watermark=shed_watermark,
+                              max_rate=max_sampling)
+        health.sampling_rate = lambda: shedder.rate
 
     # start pulling log files to the queue
-    for line in reader:
+    for batch in reader:
+        health.lines_read += len(batch)
+        if shedder:
+            sampled = shedder.sample(batch)
+            health.lines_shed += len(batch) - len(sampled)
+            batch = sampled
         try:
-            parser_pool.add_line(line.strip('\n'), block=not reader.isstdin())
-        except Full:
-            logger.warning('Line parser queue full')
+            parser_pool.add_batch(batch, block=not reader.islive())
+        except LinesDropped, e:
+            logger.warning('Line parser queue full, dropped %s lines', e.lines)
+            health.lines_dropped += e.lines
             time.sleep(0.1)
 
     parser_pool.join()
+    if snapshot:
+        # metrics not sent yet are saved instead of flushed, the restarted collector sends them
+        flusher.stop(flush=False)
+        health.report(stats)
+        save_snapshot(snapshot, parts)
+    else:
+        flusher.stop()
+    for signum, handler in handlers.iteritems():
+        signal.signal(signum, handler)
     print("Finished log parsing")
 
 
 
-def argparse_maker():
+def parse_quantiles(percentiles):
+    """
+    :param percentiles: comma separated percentiles, ie. "50,90,99"
+    :return: tuple of sorted quantiles, ie. (0.5, 0.9, 0.99)
+    """
+    try:
+        quantiles = tuple(sorted(round(float(p) / 100, 6) for p in percentiles.split(',') if p.strip()))
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid percentiles: {}'.format(percentiles))
+    if not all(0 <= q <= 1 for q in quantiles):
+        raise argparse.ArgumentTypeError('percentiles must be between 0 and 100: {}'.format(percentiles))
+    return quantiles
+
+
+def handler_argparse_maker():
+    """
+    :return: argparse object with options of handlers, shared by executables parsing logs
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-l", "--local", dest="local_emails", default=[], action="append",
+                        metavar="local_emails",
+                        help="Search for STRING in incoming email addresses and incr stat NAME and if COUNT, count in incoming - STRING,NAME,COUNT. "
+                             "STRING user@domain matches the address, @domain the domain and its subdomains, anything else is a substring")
+    parser.add_argument("-L", "--local-file", dest="local_files", default=[], action="append",
+                        metavar="file",
+                        help="Read local_emails from file, one STRING,NAME,COUNT per line")
+    parser.add_argument("--track-messages", dest="track_messages", default=0, type=int,
+                        metavar="messages",
+                        help="Max number of messages followed from cleanup to removal for latency and size stats, "
+                             "ie. 100000; 0 disables following messages")
+    parser.add_argument("--track-ttl", dest="track_ttl", default=7200, type=int,
+                        metavar="seconds",
+                        help="Forget followed messages not seen in logs for this long")
+    parser.add_argument("--max-hosts", dest="max_hosts", default=0, type=int,
+                        metavar="hosts",
+                        help="Count also per source host of log lines, for up to this many hosts; lines of other hosts "
+                             "are counted as host 'other'")
+    parser.add_argument("--top", dest="top_k", default=0, type=int,
+                        metavar="k",
+                        help="Report this many heaviest client IPs, sender domains and relays every flush")
+    parser.add_argument("--top-capacity", dest="top_capacity", default=1000, type=int,
+                        metavar="items",
+                        help="Number of client IPs, sender domains and relays monitored for --top")
+    parser.add_argument("--quantiles", dest="quantiles", default=(), type=parse_quantiles,
+                        metavar="percentiles",
+                        help="Report these percentiles (and max) of delivery delays by direction every flush, "
+                             "ie. 50,90,99")
+    parser.add_argument("-r", "--rules", dest="rule_files", default=[], action="append",
+                        metavar="file",
+                        help="Register extra handlers declared in an INI rule file, see rules.example.ini")
+    return parser
+
+
+def argparse_maker(description=__doc__):
     """
     :return: argparse object
     """
-    parser = argparse.ArgumentParser(description=__doc__,
+    parser = argparse.ArgumentParser(description=description, parents=[handler_argparse_maker()],
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("-v", "--verbose", dest="verbosity", default=0, action="count",
                         help="-v for a little info, -vv for debugging")
     parser.add_argument("-c", "--concurrency", dest="concurrency", default=multiprocessing.cpu_count(), type=int,
                         metavar="threads",
-                        help="Number of threads to spawn for handling lines")
-    parser.add_argument("-l", "--local", dest="local_emails", default=[], action="append",
-                        metavar="local_emails",
-                        help="Search for STRING in incoming email addresses and incr stat NAME and if COUNT, count in incoming - STRING,NAME,COUNT")
+                        help="Number of threads (or processes) to spawn for handling lines")
+    parser.add_argument("-m", "--processes", dest="processes", default=False, action="store_true",
+                        help="Parse lines in worker processes instead of threads")
+    parser.add_argument("-f", "--flush-interval", dest="flush_interval", default=STATSD_FLUSH_INTERVAL, type=float,
+                        metavar="seconds",
+                        help="Interval between flushes of aggregated counters to StatsD")
+    parser.add_argument("--flush-size", dest="flush_size", default=1000, type=int,
+                        metavar="metrics",
+                        help="Flush early once this many distinct metrics are pending")
+    parser.add_argument("-b", "--batch-size", dest="batch_size", default=500, type=int,
+                        metavar="lines",
+                        help="Number of lines handed to parsers at once")
+    parser.add_argument("--batch-latency", dest="batch_latency", default=0.1, type=float,
+                        metavar="seconds",
+                        help="How long a partial batch read from stdin may wait for more lines")
+    parser.add_argument("--self-prefix", dest="self_prefix", default=PREFIX,
+                        metavar="prefix",
+                        help="Prefix of metrics describing health of the collector itself")
+    parser.add_argument("--http-port", dest="http_port", default=None, type=int,
+                        metavar="port",
+                        help="Expose aggregated metrics for Prometheus/OpenMetrics scrapes on this port")
+    parser.add_argument("--http-addr", dest="http_addr", default='',
+                        metavar="address",
+                        help="Address the metrics endpoint listens on")
+    parser.add_argument("--sink", dest="sink_spec", default=None,
+                        metavar="spec",
+                        help="Where to send metrics: udp://host:port, tcp://host:port, file:///path.jsonl or null, "
+                             "StatsD over UDP configured by STATSD_* variables by default")
+    parser.add_argument("--listen-udp", dest="listen_udp", default=None,
+                        metavar="[host:]port",
+                        help="Receive syslog messages over UDP instead of reading stdin or files")
+    parser.add_argument("--listen-tcp", dest="listen_tcp", default=None,
+                        metavar="[host:]port",
+                        help="Receive syslog messages over TCP (octet counted or new line framed) instead of reading "
+                             "stdin or files")
+    parser.add_argument("--recv-buffer", dest="recv_buffer", default=None, type=int,
+                        metavar="bytes",
+                        help="Receive buffer size of the syslog sockets")
+    parser.add_argument("-F", "--follow", dest="follow", default=False, action="store_true",
+                        help="Keep reading the log file as it grows, across rotation and truncation, like tail -F")
+    parser.add_argument("--checkpoint", dest="checkpoint", default=None,
+                        metavar="file",
+                        help="Save position in the followed log file here and resume from it on start")
+    parser.add_argument("--max-sampling", dest="max_sampling", default=0, type=int,
+                        metavar="N",
+                        help="Under overload of live input parse only 1 in up to N messages and scale counters by the "
+                             "sampling rate, instead of dropping whole batches (powers of 2, 0 disables)")
+    parser.add_argument("--shed-watermark", dest="shed_watermark", default=0.5, type=float,
+                        metavar="fraction",
+                        help="Fill of the parser queue which starts sampling")
+    parser.add_argument("--checkpoint-interval", dest="checkpoint_interval", default=5, type=float,
+                        metavar="seconds",
+                        help="Interval between saves of the checkpoint")
+    parser.add_argument("--snapshot", dest="snapshot", default=None,
+                        metavar="file",
+                        help="Save tracked messages and unsent metrics here on exit (SIGTERM, SIGHUP, end of input) "
+                             "and load them on start")
     parser.add_argument('log_files', metavar='file', type=str, nargs='*', default="-",
                         help='an integer for the accumulator')
     return parser
@@ -309,8 +1212,28 @@ def main():
     assert args.local_emails is not None
     assert args.log_files is not None
     log_init(args.verbosity)
+    process_args(args)
+
 
-    process(log_files=args.log_files, concurrency=args.concurrency, local_emails=args.local_emails)
+def process_args(args, jobs=(), states=()):
+    """
+    Runs `process` with parsed command line arguments
+    :param args: namespace parsed by `argparse_maker`
+    :param jobs: list of (interval, callable) run periodically by the flushing thread
+    :param states: list of (name, object with `dump` and `load`) saved in the snapshot too
+    :return: result of `process`
+    """
+    return process(log_files=args.log_files, concurrency=args.concurrency, local_emails=args.local_emails,
+                   local_files=args.local_files, flush_interval=args.flush_interval, flush_size=args.flush_size,
+                   processes=args.processes, batch_size=args.batch_size, batch_latency=args.batch_latency,
+                   track_messages=args.track_messages, track_ttl=args.track_ttl, self_prefix=args.self_prefix,
+                   http_port=args.http_port, http_addr=args.http_addr,
+                   listen_udp=args.listen_udp, listen_tcp=args.listen_tcp, recv_buffer=args.recv_buffer,
+                   max_hosts=args.max_hosts, top_k=args.top_k, top_capacity=args.top_capacity, quantiles=args.quantiles,
+                   rule_files=args.rule_files, follow=args.follow, checkpoint=args.checkpoint,
+                   checkpoint_interval=args.checkpoint_interval, max_sampling=args.max_sampling,
+                   shed_watermark=args.shed_watermark, sink_spec=args.sink_spec, jobs=jobs,
+                   snapshot=args.snapshot, states=states)
 
 
 if __name__ == '__main__':
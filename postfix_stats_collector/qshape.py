@@ -7,6 +7,9 @@ STATSD_PORT=8125
 STATSD_PREFIX=None
 STATSD_MAXUDPSIZE=512
 STATSD_DELAY=10
+
+Queue shapes are sent as gauges, only those which changed since the previous collection (or disappeared, which are
+zeroed once). All of them are sent again every --resync-interval seconds, so StatsD catches up after lost packets.
 """
 
 import os
@@ -18,13 +21,20 @@ import argparse
 import signal
 import threading
 from postfix_stats_collector.common import log_init
+from postfix_stats_collector.spool import SpoolScanner, SPOOL_DIR
+from postfix_stats_collector.exposition import MetricsRegistry, start_http_server
 from itertools import ifilter
+from collections import defaultdict
 
-from statsd.defaults.env import statsd
+from postfix_stats_collector.sinks import make_sink
+from postfix_stats_collector.snapshot import save_snapshot, load_snapshot
 
 logger = logging.getLogger(__name__)
 
 STATSD_DELAY = int(os.environ.get("STATSD_DELAY", 10))
+RESYNC_INTERVAL = 300
+
+COUNTER_SUFFIXES = ('.skipped', '.timeout')  # events of a collection, other stats describe the queues
 
 QUEUES = ["maildrop",
           "hold",
@@ -33,9 +43,10 @@ QUEUES = ["maildrop",
           "deferred"]
 
 
-def get_qshape_stats(limit_top_domains=0):
+def get_qshape_stats(limit_top_domains=0, scanner=None, timeout=None):
     """
-    Executes postfix `qshape` on every queue and transforms its output for monitoring usage.
+    Executes postfix `qshape` (or reads the spool with `scanner`) on every queue concurrently and transforms its
+    output for monitoring usage.
 
     `qshape` is a brilliant to have an insight into current state of system, but with whole monitoring backend
     we are getting ability to peek into historical data and chart it.
@@ -69,77 +80,305 @@ def get_qshape_stats(limit_top_domains=0):
                           foo.bar   4   3  2  2  2  2   2   2   2    2    2    2
 
     :param limit_top_domains: limit how many top domains should be reported as separate metrics (default=0)
+    :param scanner: SpoolScanner reading the queues natively instead of executing `qshape`
+    :param timeout: seconds to wait for all queues, queues not collected in time are reported as timed out
     :return: list of stats [(key, value),...], where key is: "postfix.qshape.{queue}.{domain}.{bucket}"
     """
     t0 = time.time()
-    try:
-        for queue in QUEUES:
-            # iterate on non empty lines from qshape output
-            logger.debug("working on qshape queue: {}".format(queue))
-            lines = ifilter(lambda x: x,
-                            subprocess.check_output(['/usr/sbin/qshape', '-n', str(limit_top_domains), '-b', '12', queue]).splitlines())
-            logger.debug("qshape output: {}".format(lines))
-            header_line = lines.next().strip()
-            headers = header_line.split()
-            assert headers[0] == 'T'
-            headers = headers[1:]
-            for line in lines:
-                values = line.split()
-                domain = values[0].lower()  # 1st entry is always TOTAL
-                total_sum = int(values[1])
-                yield ("postfix.qshape.{queue}.{domain}.{bucket}".format(queue=queue, domain=domain, bucket='sum'), int(total_sum))
-
-                values = values[2:]  # get rid of domain and sum
-
-                # get from:  0  1  2  1  0 10 0 0
-                # to:       14 13 11 10 10  0 0
-                values_inverted_summed = values  # let's initiate the size
-                last_value = total_sum
-                for i in range(len(values)):
-                    last_value -= int(values[i])
-                    values_inverted_summed[i] = last_value
-
-                domain = domain.replace(".", "_")  # we don't want to create tree from domain name so "." are forbidden
-                # we don't report 5120+ value as it does not add any value
-                # it's always zero as we deliver everything before the nd of times
-                for i in range(len(headers)-1):
-                    bucket = headers[i]
-                    value = values_inverted_summed[i]  # skip the title of the row
-                    yield ("postfix.qshape.{queue}.{domain}.{bucket}".format(queue=queue, domain=domain, bucket=bucket), value)
-    except OSError as e:
-        logger.error("Skipping qshape due to execution error: {}".format(e))
+    workers = []
+    for queue in QUEUES:
+        worker = QueueWorker.start_for(queue, limit_top_domains, scanner)
+        if worker:
+            workers.append(worker)
+        else:
+            logger.warning("Previous collection of queue {} still running, skipping it".format(queue))
+            yield "postfix.qshape.{}.skipped".format(queue), 1
+
+    for worker in workers:
+        worker.join(None if timeout is None else max(t0 + timeout - time.time(), 0))
+        if worker.is_alive():
+            logger.warning("Collection of queue {} did not finish in {}s".format(worker.queue, timeout))
+            yield "postfix.qshape.{}.timeout".format(worker.queue), 1
+        elif worker.error:
+            logger.error("Skipping qshape due to execution error: {}".format(worker.error))
+        else:
+            for stat in transform_qshape(worker.queue, *worker.result):
+                yield stat
+            yield "postfix.qshape.{}.processing_time".format(worker.queue), worker.processing_time
     t1 = time.time()
     yield "postfix.qshape.processing_time", t1-t0
 
 
-def process(run_once=False):
+class QueueWorker(threading.Thread):
+    """
+    Thread collecting qshape rows of a single queue.
+    At most one worker runs per queue, a worker which missed its deadline keeps running in the background and
+    new collection of that queue is not started until it finishes.
+    """
+    running = dict()  # queue -> QueueWorker
+    running_lock = threading.Lock()
+
+    def __init__(self, queue, limit_top_domains=0, scanner=None):
+        super(QueueWorker, self).__init__(name='qshape-{}'.format(queue))
+        self.queue = queue
+        self.limit_top_domains = limit_top_domains
+        self.scanner = scanner
+        self.result = None
+        self.error = None
+        self.processing_time = None
+        self.daemon = True
+
+    @classmethod
+    def start_for(cls, queue, limit_top_domains=0, scanner=None):
+        """
+        :return: started QueueWorker or None when previous collection of the queue is still running
+        """
+        with cls.running_lock:
+            previous = cls.running.get(queue)
+            if previous and previous.is_alive():
+                return None
+            worker = cls.running[queue] = cls(queue, limit_top_domains, scanner)
+        worker.start()
+        return worker
+
+    def run(self):
+        logger.debug("working on qshape queue: {}".format(self.queue))
+        t0 = time.time()
+        try:
+            if self.scanner:
+                self.result = self.scanner.shape(self.queue, self.limit_top_domains)
+            else:
+                self.result = run_qshape(self.queue, self.limit_top_domains)
+        except Exception as e:
+            self.error = e
+        self.processing_time = time.time() - t0
+
+
+def run_qshape(queue, limit_top_domains=0):
+    """
+    Executes postfix `qshape` on a queue and parses its output
+    :param queue: queue name
+    :param limit_top_domains: limit how many top domains should be reported as separate rows
+    :return: (headers, rows), where headers are bucket names and rows are (domain, total, [count per bucket])
+    """
+    # iterate on non empty lines from qshape output
+    lines = ifilter(lambda x: x,
+                    subprocess.check_output(['/usr/sbin/qshape', '-n', str(limit_top_domains), '-b', '12', queue]).splitlines())
+    logger.debug("qshape output: {}".format(lines))
+    header_line = lines.next().strip()
+    headers = header_line.split()
+    assert headers[0] == 'T'
+    headers = headers[1:]
+    rows = []
+    for line in lines:
+        values = line.split()
+        rows.append((values[0], int(values[1]), [int(value) for value in values[2:]]))
+    return headers, rows
+
+
+def transform_qshape(queue, headers, rows):
+    """
+    Transforms qshape buckets into cumulative stats, see `get_qshape_stats`
+    :return: generator of (key, value)
+    """
+    for domain, total_sum, values in rows:
+        domain = domain.lower()  # 1st entry is always TOTAL
+        yield ("postfix.qshape.{queue}.{domain}.{bucket}".format(queue=queue, domain=domain, bucket='sum'), int(total_sum))
+
+        # get from:  0  1  2  1  0 10 0 0
+        # to:       14 13 11 10 10  0 0
+        values_inverted_summed = list(values)  # let's initiate the size
+        last_value = total_sum
+        for i in range(len(values)):
+            last_value -= int(values[i])
+            values_inverted_summed[i] = last_value
+
+        domain = domain.replace(".", "_")  # we don't want to create tree from domain name so "." are forbidden
+        # we don't report 5120+ value as it does not add any value
+        # it's always zero as we deliver everything before the nd of times
+        for i in range(len(headers)-1):
+            bucket = headers[i]
+            value = values_inverted_summed[i]  # skip the title of the row
+            yield ("postfix.qshape.{queue}.{domain}.{bucket}".format(queue=queue, domain=domain, bucket=bucket), value)
+
+
+class GaugeSnapshot(object):
+    """
+    Values of qshape gauges sent last time, so only changes have to be sent on the next collection.
+    """
+
+    def __init__(self, resync_interval=RESYNC_INTERVAL):
+        """
+        :param resync_interval: seconds between collections sending all values
+        :return:
+        """
+        self.resync_interval = resync_interval
+        self.resync_at = 0
+        self.queues = dict()  # queue -> {stat -> value}
+
+    def changes(self, stats, now=None):
+        """
+        Remembers current values and finds those to send.
+        Stats of a queue missing in the current values are zeroed, unless the whole queue is missing (ie. its
+        collection timed out), then its previous values are kept.
+        :param stats: list of (stat, value) gauges, where stat is "postfix.qshape.{queue}...."
+        :param now: current time
+        :return: list of (stat, value) which are new, changed or zeroed, all of them on resync
+        """
+        now = time.time() if now is None else now
+        resync = now >= self.resync_at
+        if resync:
+            self.resync_at = now + self.resync_interval
+
+        current = defaultdict(dict)
+        for stat, value in stats:
+            current[stat.split('.', 3)[2]][stat] = value
+
+        changes = []
+        for queue, values in current.iteritems():
+            previous = self.queues.get(queue, {})
+            for stat, value in values.iteritems():
+                if resync or previous.get(stat) != value:
+                    changes.append((stat, value))
+            for stat in previous:
+                if stat not in values:
+                    changes.append((stat, 0))
+            self.queues[queue] = values
+        return sorted(changes)
+
+    def dump(self):
+        """
+        :return: values sent last time, for a snapshot
+        """
+        return self.resync_at, self.queues
+
+    def load(self, state):
+        """
+        Continues with values sent before a restart, so they are not sent again until they change or resync is due
+        :param state: result of `dump`
+        :return: None
+        """
+        self.resync_at, self.queues = state
+
+
+def split_counters(stats):
+    """
+    :param stats: (stat, value) pairs of `get_qshape_stats`
+    :return: (gauges describing the queues, counters of collection events)
+    """
+    gauges = [(stat, value) for stat, value in stats if not stat.endswith(COUNTER_SUFFIXES)]
+    counters = [(stat, value) for stat, value in stats if stat.endswith(COUNTER_SUFFIXES)]
+    return gauges, counters
+
+
+def report_qshape(client, snapshot, scanner=None, timeout=None, skipped_ticks=0):
+    """
+    Collects queue shapes and sends changed gauges and counters of the collection
+    :param client: StatsD client (or pipeline) or StatsAggregator, anything with `gauge` and `incr`
+    :param snapshot: GaugeSnapshot of gauges sent previously
+    :param scanner: SpoolScanner reading the queues natively instead of executing `qshape`
+    :param timeout: seconds to wait for all queues
+    :param skipped_ticks: number of collections skipped since the previous one
+    :return: list of all (stat, value) collected
+    """
+    stats = list(get_qshape_stats(scanner=scanner, timeout=timeout))
+    gauges, counters = split_counters(stats)
+    changes = snapshot.changes(gauges)
+    logger.debug("Sending {} of {} qshape gauges".format(len(changes), len(gauges)))
+    for stat, value in changes:
+        client.gauge(stat, value)
+    for stat, value in counters:
+        client.incr(stat, value)
+    if skipped_ticks:
+        client.incr("postfix.qshape.skipped_ticks", skipped_ticks)
+    return stats
+
+
+class CollectionJob(object):
+    """
+    Scheduled job running `report` in a background thread, so a slow collection never blocks the scheduler.
+    Ticks arriving while the previous collection is still running are skipped and their count is passed to the next
+    `report` call.
+    """
+
+    def __init__(self, report):
+        """
+        :param report: callable taking number of skipped ticks
+        :return:
+        """
+        self.report = report
+        self.thread = None
+        self.skipped = 0
+
+    def __call__(self):
+        if self.thread and self.thread.is_alive():
+            self.skipped += 1
+            logger.warning("Previous qshape collection still running, skipping tick")
+            return
+
+        skipped, self.skipped = self.skipped, 0
+        self.thread = threading.Thread(target=self.report, args=(skipped,))
+        self.thread.daemon = True
+        self.thread.start()
+
+
+def process(run_once=False, native=False, spool_dir=SPOOL_DIR, timeout=STATSD_DELAY, http_port=None, http_addr='',
+            resync_interval=RESYNC_INTERVAL, sink_spec=None, snapshot_file=None):
     """
     runs the processign loop as log as running_event is set or undefined
-    :param running_event: Event or None
+    :param run_once: report stats once and exit
+    :param native: read queue files from `spool_dir` instead of executing `qshape`
+    :param spool_dir: postfix spool directory
+    :param timeout: seconds to wait for collection of all queues
+    :param http_port: expose stats for Prometheus/OpenMetrics scrapes on this port
+    :param http_addr: address the metrics endpoint listens on
+    :param resync_interval: seconds between sends of all gauges, only changed gauges are sent in between
+    :param sink_spec: where to send stats, see `sinks.parse_spec`, StatsD over UDP by default
+    :param snapshot_file: gauges sent last are saved here on exit and loaded on start
     :return: None
     """
     print("Starting qshape processing")
 
-    # handle ctrl+c
+    # handle ctrl+c, SIGTERM and SIGHUP
     print('Press Ctrl+C to exit')
     running_event = threading.Event()
     running_event.set()
     def signal_handler(signal, frame):
         print('Attempting to close workers')
         running_event.clear()
-    signal.signal(signal.SIGINT, signal_handler)
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, signal_handler)
+
+    scanner = SpoolScanner(spool_dir) if native else None
+    sink = make_sink(sink_spec)
+    registry = None
+    if http_port is not None:
+        registry = MetricsRegistry()
+        start_http_server(registry, http_port, http_addr)
+    snapshot = GaugeSnapshot(resync_interval)
+    if snapshot_file:
+        load_snapshot(snapshot_file, dict(qshape=snapshot))
 
-    def report_stats():
-        with statsd.pipeline() as pipe:
-            for stat, value in get_qshape_stats():
-                pipe.incr(stat, value)
+    def report_stats(skipped_ticks=0):
+        with sink.pipeline() as pipe:
+            stats = report_qshape(pipe, snapshot, scanner, timeout, skipped_ticks)
+        if registry:
+            gauges, counters = split_counters(stats)
+            if skipped_ticks:
+                counters.append(("postfix.qshape.skipped_ticks", skipped_ticks))
+            registry.set_gauges(gauges, counters)
 
     report_stats()  # report current metrics and schedule them to the future
+    job = CollectionJob(report_stats)
     if not run_once:
-        schedule.every(STATSD_DELAY).seconds.do(report_stats)
+        schedule.every(STATSD_DELAY).seconds.do(job)
         while running_event.is_set():
             schedule.run_pending()
             time.sleep(0.1)
+    if snapshot_file:
+        if job.thread:
+            job.thread.join(timeout)  # let the last collection update the snapshot
+        save_snapshot(snapshot_file, dict(qshape=snapshot))
     print("Finished qshape processing")
 
 
@@ -153,6 +392,30 @@ def argparse_maker():
                         help="-v for a little info, -vv for debugging")
     parser.add_argument("-o", "--once", dest="run_once", default=False, action="store_true",
                         help="Run once")
+    parser.add_argument("-n", "--native", dest="native", default=False, action="store_true",
+                        help="Read queue files directly instead of executing /usr/sbin/qshape")
+    parser.add_argument("-s", "--spool-dir", dest="spool_dir", default=SPOOL_DIR,
+                        help="Postfix spool directory used by --native")
+    parser.add_argument("-t", "--timeout", dest="timeout", default=STATSD_DELAY, type=float,
+                        metavar="seconds",
+                        help="Deadline for collecting all queues, slower queues are reported as timed out")
+    parser.add_argument("--http-port", dest="http_port", default=None, type=int,
+                        metavar="port",
+                        help="Expose stats for Prometheus/OpenMetrics scrapes on this port")
+    parser.add_argument("--http-addr", dest="http_addr", default='',
+                        metavar="address",
+                        help="Address the metrics endpoint listens on")
+    parser.add_argument("--resync-interval", dest="resync_interval", default=RESYNC_INTERVAL, type=float,
+                        metavar="seconds",
+                        help="Interval between sends of all queue gauges, only changed ones are sent in between")
+    parser.add_argument("--sink", dest="sink_spec", default=None,
+                        metavar="spec",
+                        help="Where to send stats: udp://host:port, tcp://host:port, file:///path.jsonl or null, "
+                             "StatsD over UDP configured by STATSD_* variables by default")
+    parser.add_argument("--snapshot", dest="snapshot_file", default=None,
+                        metavar="file",
+                        help="Save queue gauges sent last here on exit (SIGINT, SIGTERM, SIGHUP) and load them on start, "
+                             "so a restart does not send them all again")
     return parser
 
 
@@ -162,7 +425,9 @@ def main():
     assert args.verbosity is not None
     assert args.run_once is not None
     log_init(args.verbosity)
-    process(run_once=args.run_once)
+    process(run_once=args.run_once, native=args.native, spool_dir=args.spool_dir, timeout=args.timeout,
+            http_port=args.http_port, http_addr=args.http_addr, resync_interval=args.resync_interval,
+            sink_spec=args.sink_spec, snapshot_file=args.snapshot_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,81 @@
+"""
+Streaming quantiles with bounded relative error, in the spirit of HDR histograms and DDSketch.
+
+Values are counted in logarithmic buckets, each bucket being `gamma` times wider than the previous one, so any quantile
+is estimated within `accuracy` of its true value. Memory depends only on the range of values (about 1000 buckets for
+values spanning 9 orders of magnitude at 1% accuracy), never on their number, and histograms of parser workers merge
+by adding bucket counts.
+"""
+
+import math
+
+
+class LogHistogram(object):
+    """
+    Histogram of non-negative values. Plain data only, so it can be pickled and sent between processes.
+    """
+
+    def __init__(self, accuracy=0.01, min_value=0.001):
+        """
+        :param accuracy: relative error of estimated quantiles
+        :param min_value: smaller values are counted as 0
+        :return:
+        """
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.buckets = dict()  # index -> count of values in (gamma ** (index - 1), gamma ** index]
+        self.zeros = 0
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        if value > self.max:
+            self.max = value
+        if value < self.min_value:
+            self.zeros += 1
+            return
+        index = int(math.ceil(math.log(value) / self.log_gamma))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        """
+        Adds values counted by other histogram of the same accuracy
+        :param other: LogHistogram
+        :return: None
+        """
+        assert self.gamma == other.gamma
+        for index, count in other.buckets.iteritems():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def quantiles(self, qs):
+        """
+        :param qs: sorted quantiles, ie. (0.5, 0.9, 0.99)
+        :return: list of estimated values
+        """
+        results = []
+        if not self.count:
+            return [0.0] * len(qs)
+        ranks = [max(math.ceil(q * self.count) - 1, 0) for q in qs]  # nearest rank
+        i = 0
+        seen = self.zeros
+        while i < len(ranks) and ranks[i] < seen:
+            results.append(0.0)
+            i += 1
+        for index in sorted(self.buckets):
+            if i == len(ranks):
+                break
+            seen += self.buckets[index]
+            value = min(2 * self.gamma ** index / (self.gamma + 1), self.max)  # middle of the bucket
+            while i < len(ranks) and ranks[i] < seen:
+                results.append(value)
+                i += 1
+        results.extend([self.max] * (len(ranks) - i))
+        return results
+
+    def quantile(self, q):
+        return self.quantiles((q,))[0]
@@ -0,0 +1,90 @@
+"""
+Load shedding for live input (stdin, syslog listener) which can not wait for parsers.
+
+Once the parser queue fills above a watermark, only 1 in N lines is kept and counters incremented while parsing them
+are scaled by N, so dashboards stay roughly correct during bursts instead of silently losing whole batches. Lines are
+kept or dropped by a hash of their postfix queue ID, so all lines of a kept message are parsed together and its
+lifecycle stays complete. N doubles while the queue stays above the watermark and halves once it drains below a
+quarter of it.
+"""
+
+import time
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SampledBatch(list):
+    """
+    Batch of lines kept by sampling, counters of its lines are multiplied by `scale`.
+    """
+
+    def __init__(self, lines=(), scale=1):
+        super(SampledBatch, self).__init__(lines)
+        self.scale = scale
+
+
+def sample_key(line, queue_id):
+    """
+    :param queue_id: callable extracting queue ID from a line in any accepted syslog format
+    :return: hash of the line's queue ID, or of the whole line when it has none
+    """
+    return zlib.crc32(queue_id(line) or line) & 0xffffffff
+
+
+class LoadShedder(object):
+    """
+    Chooses the sampling rate from the depth of the parser queue and samples batches.
+    """
+
+    def __init__(self, depth, capacity, queue_id, watermark=0.5, max_rate=64, interval=1):
+        """
+        :param depth: callable returning number of waiting batches
+        :param capacity: max number of waiting batches
+        :param queue_id: callable extracting queue ID from a line
+        :param watermark: fraction of capacity which starts sampling
+        :param max_rate: highest N, at least 1 in N lines is always kept, N is a power of 2 up to max_rate
+        :param interval: min seconds between changes of the rate
+        :return:
+        """
+        self.depth = depth
+        self.capacity = capacity
+        self.queue_id = queue_id
+        self.high = watermark * capacity
+        self.low = watermark * capacity / 4
+        self.max_rate = max_rate
+        self.interval = interval
+        self.rate = 1
+        self.changed_at = 0
+
+    def update(self, now=None):
+        """
+        Adjusts the sampling rate to the current queue depth
+        :return: current rate
+        """
+        now = time.time() if now is None else now
+        if now - self.changed_at < self.interval:
+            return self.rate
+        depth = self.depth()
+        rate = self.rate
+        if depth >= self.high and rate * 2 <= self.max_rate:
+            rate *= 2  # lines kept at 2N are kept at N as well
+        elif depth <= self.low and rate > 1:
+            rate //= 2
+        if rate != self.rate:
+            logger.warning('Parser queue depth %s of %s, keeping 1 in %s lines', depth, self.capacity, rate)
+            self.rate = rate
+            self.changed_at = now
+        return rate
+
+    def sample(self, lines):
+        """
+        :param lines: batch of lines
+        :return: lines, or SampledBatch with the lines kept at the current rate
+        """
+        rate = self.update()
+        if rate == 1:
+            return lines
+        queue_id = self.queue_id
+        return SampledBatch((line for line in lines if sample_key(line, queue_id) % rate == 0), rate)
@@ -0,0 +1,147 @@
+"""
+Destinations of metrics, all with the interface of a StatsD client (`incr`, `gauge`, `timing` and `pipeline`).
+
+Sinks are selected with a URL-like spec:
+  udp://host:port       StatsD over UDP, pipelines are batched into datagrams of STATSD_MAXUDPSIZE bytes
+  tcp://host:port       StatsD over a persistent TCP connection, reconnected when it breaks, nothing is lost to
+                        full socket buffers under high volume
+  file:///path.jsonl    appends every metric as a JSON line with its time, for auditing and replay
+  null                  discards everything, to profile parsing without any cost of emission
+Without a spec the UDP client configured by the STATSD_* environment variables is used.
+STATSD_PREFIX applies to all of them.
+"""
+
+import os
+import json
+import time
+import socket
+import logging
+from contextlib import contextmanager
+
+from statsd.client import StatsClient, TCPStatsClient
+from statsd.client.base import StatsClientBase, PipelineBase
+
+logger = logging.getLogger(__name__)
+
+SCHEMES = ('udp', 'tcp', 'file', 'null')
+
+
+class NullSink(object):
+    """
+    StatsD client discarding everything, without even formatting the metrics
+    """
+
+    def incr(self, stat, count=1, rate=1):
+        pass
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        pass
+
+    def timing(self, stat, delta, rate=1):
+        pass
+
+    @contextmanager
+    def pipeline(self):
+        yield self
+
+
+class ReconnectingTCPClient(TCPStatsClient):
+    """
+    StatsD client over TCP which reconnects once a send fails, instead of raising on every send after the StatsD
+    server restarted.
+    """
+
+    def _send(self, data):
+        for attempt in (1, 2):
+            try:
+                if not self._sock:
+                    self.connect()
+                self._do_send(data)
+                return
+            except socket.error, e:
+                self.close()
+                if attempt == 2:
+                    logger.warning('Dropping %d bytes of metrics, sending to %s:%s failed: %s',
+                                   len(data), self._host, self._port, e)
+
+
+class FilePipeline(PipelineBase):
+    def _send(self):
+        self._client.write(self._stats)
+        self._stats.clear()
+
+
+class FileSink(StatsClientBase):
+    """
+    Appends metrics to a file as JSON lines: {"time": 1446358509.1, "stat": "postfix.messages.bounce", "value": "2",
+    "type": "c"}. Metrics of a pipeline are written at once.
+    """
+
+    def __init__(self, path, prefix=None):
+        self._prefix = prefix
+        self.path = path
+        self.file = open(path, 'a')
+
+    def pipeline(self):
+        return FilePipeline(self)
+
+    def _send(self, data):
+        self.write((data,))
+
+    def write(self, stats):
+        """
+        :param stats: StatsD formatted metrics, "stat:value|type"
+        :return: None
+        """
+        now = round(time.time(), 3)
+        lines = []
+        for data in stats:
+            stat, _, value = data.partition(':')
+            value, _, kind = value.partition('|')
+            lines.append(json.dumps({'time': now, 'stat': stat, 'value': value, 'type': kind}, sort_keys=True))
+        self.file.write('\n'.join(lines) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def parse_spec(spec):
+    """
+    :param spec: "udp://host:port", "tcp://host:port", "file:///path" or "null"
+    :return: (scheme, host, port, path)
+    """
+    scheme, _, rest = spec.partition('://')
+    if scheme not in SCHEMES:
+        raise ValueError('Unknown sink {}, expected one of {}'.format(spec, ', '.join(SCHEMES)))
+    if scheme == 'null':
+        return scheme, None, None, None
+    if scheme == 'file':
+        if not rest:
+            raise ValueError('Sink {} needs a path'.format(spec))
+        return scheme, None, None, rest
+    host, _, port = rest.rpartition(':')
+    if not port.isdigit():
+        host, port = rest, 8125
+    return scheme, host.strip('[]') or 'localhost', int(port), None
+
+
+def make_sink(spec=None):
+    """
+    :param spec: see `parse_spec`, None for the UDP client configured by the environment
+    :return: StatsD client like sink
+    """
+    if not spec:
+        from statsd.defaults.env import statsd
+        return statsd
+
+    scheme, host, port, path = parse_spec(spec)
+    prefix = os.getenv('STATSD_PREFIX')
+    ipv6 = ':' in (host or '')
+    if scheme == 'udp':
+        return StatsClient(host, port, prefix=prefix, maxudpsize=int(os.getenv('STATSD_MAXUDPSIZE', 512)), ipv6=ipv6)
+    if scheme == 'tcp':
+        return ReconnectingTCPClient(host, port, prefix=prefix, timeout=10, ipv6=ipv6)
+    if scheme == 'file':
+        return FileSink(path, prefix=prefix)
+    return NullSink()
@@ -0,0 +1,60 @@
+"""
+Snapshots of in-memory state, so a restarted collector (ie. after a deploy or SIGHUP from logrotate) continues with
+the messages it was tracking, the metrics not sent yet and the queue gauges sent previously, instead of reporting
+gaps and rebuilding its state from scratch.
+
+A snapshot is a zlib compressed pickle of {name: state} written atomically. Every part of the state is an object with
+`dump()` returning plain data and `load(state)` merging it back. The file is trusted like the rest of the collector's
+configuration, it must not be writable by anyone else.
+"""
+
+import os
+import time
+import zlib
+import pickle
+import logging
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+def save_snapshot(path, parts):
+    """
+    :param path: snapshot file
+    :param parts: dict of name -> object with `dump`
+    :return: size of the snapshot in bytes
+    """
+    state = dict((name, part.dump()) for name, part in parts.iteritems())
+    data = zlib.compress(pickle.dumps({'version': VERSION, 'time': time.time(), 'state': state}, 2))
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+    logger.info('Saved snapshot of %s to %s (%d bytes)', ', '.join(sorted(state)), path, len(data))
+    return len(data)
+
+
+def load_snapshot(path, parts):
+    """
+    Loads parts found in the snapshot, a missing or invalid snapshot is ignored
+    :param path: snapshot file
+    :param parts: dict of name -> object with `load`
+    :return: True if a snapshot was loaded
+    """
+    if not os.path.exists(path):
+        return False
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.loads(zlib.decompress(f.read()))
+        if snapshot.get('version') != VERSION:
+            raise ValueError('unsupported version {}'.format(snapshot.get('version')))
+    except Exception, e:
+        logger.warning('Ignoring snapshot %s: %s', path, e)
+        return False
+
+    for name, state in snapshot['state'].iteritems():
+        if name in parts:
+            parts[name].load(state)
+    logger.info('Loaded snapshot %s taken %.0fs ago', path, time.time() - snapshot['time'])
+    return True
@@ -0,0 +1,222 @@
+"""
+Native reader of the postfix queue directories, a replacement for running `/usr/sbin/qshape`.
+
+Queue files are made of records: type (1 byte), length (7 bits per byte, low order first, high bit set when more
+bytes follow) and data. Only envelope records are needed to shape the queue:
+  C  sizes, 1st field is message content size and 2nd the offset of the content, which lets us skip it
+  T  arrival time
+  R  recipient not delivered yet (delivered ones are rewritten in place to "D")
+  M  start of message content
+  E  end of the file
+"""
+
+import os
+import time
+import errno
+import logging
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = '/var/spool/postfix'
+
+# qshape -b 12 buckets; minutes, doubling and the last one being open ended
+BUCKETS = [5 * 2 ** i for i in range(11)]
+HEADERS = [str(bucket) for bucket in BUCKETS] + ['{}+'.format(BUCKETS[-1])]
+
+REC_TYPE_SIZE = 'C'
+REC_TYPE_TIME = 'T'
+REC_TYPE_RCPT = 'R'
+REC_TYPE_MESG = 'M'
+REC_TYPE_END = 'E'
+
+
+def read_record(f):
+    """
+    :param f: queue file opened in binary mode
+    :return: (type, data) or (None, None) at the end of file
+    """
+    rec_type = f.read(1)
+    if not rec_type:
+        return None, None
+
+    length = 0
+    shift = 0
+    while True:
+        byte = f.read(1)
+        if not byte:
+            raise ValueError('Truncated record length')
+        byte = ord(byte)
+        length |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+
+    data = f.read(length)
+    if len(data) != length:
+        raise ValueError('Truncated record data')
+    return rec_type, data
+
+
+def write_record(f, rec_type, data):
+    """
+    Counterpart of `read_record`, used to build synthetic queue files
+    """
+    f.write(rec_type)
+    length = len(data)
+    while True:
+        byte = length & 0x7f
+        length >>= 7
+        if length:
+            byte |= 0x80
+        f.write(chr(byte))
+        if not length:
+            break
+    f.write(data)
+
+
+def write_queue_file(path, arrival_time, recipients, sender='sender@example.com', content='Subject: test\n\ntest\n',
+                     delivered=()):
+    """
+    Writes minimal queue file, good enough for `read_queue_file` and benchmarks
+    :param arrival_time: unix timestamp
+    :param recipients: recipient addresses waiting for delivery
+    :param delivered: recipient addresses already delivered
+    :return: None
+    """
+    lines = content.splitlines()
+    with open(path, 'wb') as f:
+        # content offset depends on the size record itself, so it is written with a fixed width like postfix does
+        write_record(f, REC_TYPE_SIZE, '%15d %15d %15d' % (0, 0, 0))
+        write_record(f, REC_TYPE_TIME, '%d 0' % arrival_time)
+        write_record(f, 'S', sender)
+        for recipient in delivered:
+            write_record(f, 'D', recipient)
+        for recipient in recipients:
+            write_record(f, REC_TYPE_RCPT, recipient)
+        write_record(f, REC_TYPE_MESG, '')
+        data_offset = f.tell()
+        for line in lines:
+            write_record(f, 'N', line)
+        message_size = f.tell() - data_offset
+        write_record(f, 'X', '')
+        write_record(f, REC_TYPE_END, '')
+
+        f.seek(0)
+        write_record(f, REC_TYPE_SIZE, '%15d %15d %15d' % (message_size, data_offset, len(recipients)))
+
+
+def read_queue_file(path):
+    """
+    Reads envelope of a queue file
+    :return: (arrival time or None, list of recipient domains)
+    """
+    arrival_time = None
+    domains = []
+    message_end = None
+
+    with open(path, 'rb') as f:
+        while True:
+            rec_type, data = read_record(f)
+            if rec_type is None or rec_type == REC_TYPE_END:
+                break
+            elif rec_type == REC_TYPE_RCPT:
+                domains.append(data.rpartition('@')[2].lower() or 'localhost')
+            elif rec_type == REC_TYPE_TIME:
+                arrival_time = float(data.split()[0])
+            elif rec_type == REC_TYPE_SIZE:
+                fields = data.split()
+                message_end = int(fields[0]) + int(fields[1])
+            elif rec_type == REC_TYPE_MESG and message_end:
+                f.seek(message_end)  # skip message content
+
+    return arrival_time, domains
+
+
+def bucket_index(age):
+    """
+    :param age: age of message in seconds
+    :return: index of the bucket within HEADERS
+    """
+    minutes = age / 60.0
+    for i, bucket in enumerate(BUCKETS):
+        if minutes < bucket:
+            return i
+    return len(BUCKETS)
+
+
+def skip_missing(error):
+    """
+    Error handler of `os.walk`, directories which disappeared are skipped, other errors (ie. EACCES) are raised
+    """
+    if error.errno != errno.ENOENT:
+        raise error
+
+
+class SpoolScanner(object):
+    """
+    Walks postfix queue directories and shapes them like qshape does.
+    Parsed queue files are cached, a file is read again only when its mtime or size changed.
+    """
+
+    def __init__(self, spool_dir=SPOOL_DIR):
+        self.spool_dir = spool_dir
+        self.cache = dict()  # queue -> {path -> (mtime, size, (arrival time, domains))}
+
+    def scan(self, queue):
+        """
+        :param queue: queue name, ie. "deferred"
+        :return: generator of (arrival time, list of recipient domains) for every message in the queue
+        """
+        cache = self.cache.setdefault(queue, dict())  # separate per queue, so queues can be scanned concurrently
+        seen = set()
+        for root, dirs, files in os.walk(os.path.join(self.spool_dir, queue), onerror=skip_missing):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                    cached = cache.get(path)
+                    if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+                        envelope = cached[2]
+                    else:
+                        envelope = read_queue_file(path)
+                        if envelope[0] is None:
+                            envelope = (st.st_mtime, envelope[1])
+                        cache[path] = (st.st_mtime, st.st_size, envelope)
+                except (IOError, OSError) as e:
+                    if e.errno == errno.ENOENT:
+                        continue  # message left the queue in the meantime
+                    raise  # ie. no permission, the queue must not be reported as empty
+                except ValueError as e:
+                    logger.debug('Skipping queue file %s: %s', path, e)
+                    continue
+                seen.add(path)
+                yield envelope
+
+        # forget messages which left the queue
+        for path in [stale for stale in cache if stale not in seen]:
+            del cache[path]
+
+    def shape(self, queue, limit_top_domains=0, now=None):
+        """
+        Counts recipients by domain and age bucket
+        :param queue: queue name
+        :param limit_top_domains: how many top domains should be reported next to TOTAL
+        :param now: current unix timestamp
+        :return: (headers, rows) as parsed from qshape output; rows are (domain, total, [count per bucket])
+        """
+        now = now or time.time()
+        total = [0] * len(HEADERS)
+        domains = dict()
+        for arrival_time, rcpt_domains in self.scan(queue):
+            i = bucket_index(now - arrival_time)
+            for domain in rcpt_domains:
+                total[i] += 1
+                if domain not in domains:
+                    domains[domain] = [0] * len(HEADERS)
+                domains[domain][i] += 1
+
+        rows = [('TOTAL', sum(total), total)]
+        top = sorted(domains.iteritems(), key=lambda (domain, counts): (-sum(counts), domain))
+        for domain, counts in top[:limit_top_domains]:
+            rows.append((domain, sum(counts), counts))
+        return HEADERS, rows
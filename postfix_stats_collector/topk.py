@@ -0,0 +1,80 @@
+"""
+Heavy hitters in fixed memory using the Space-Saving algorithm (Metwally, Agrawal, El Abbadi).
+
+At most `capacity` items are monitored. An item not monitored yet replaces the one with the lowest count and inherits
+that count as its possible overestimation (error). Any item occurring more than total/capacity times is guaranteed to
+be monitored, so the top of a few hundred monitored items reliably shows who drives the load.
+"""
+
+import heapq
+
+
+class SpaceSaving(object):
+    """
+    Space-Saving summary of a stream of items. Plain data only, so it can be pickled and sent between processes.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = dict()  # item -> [count, error]
+        self.heap = []  # (count, item), entries whose count is outdated are skipped lazily
+        self.total = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def offer(self, item, count=1):
+        """
+        Counts occurrences of item
+        :return: None
+        """
+        self.total += count
+        entry = self.counts.get(item)
+        if entry is None:
+            if len(self.counts) < self.capacity:
+                entry = self.counts[item] = [0, 0]
+            else:
+                min_count, min_item = self.pop_min()
+                del self.counts[min_item]
+                entry = self.counts[item] = [min_count, min_count]
+        entry[0] += count
+        heapq.heappush(self.heap, (entry[0], item))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(counts[0], key) for key, counts in self.counts.iteritems()]
+            heapq.heapify(self.heap)
+
+    def pop_min(self):
+        """
+        :return: (count, item) of the monitored item with the lowest count
+        """
+        while True:
+            count, item = heapq.heappop(self.heap)
+            entry = self.counts.get(item)
+            if entry is not None and entry[0] == count:
+                return count, item
+
+    def merge(self, other):
+        """
+        Adds summary of another stream, keeping `capacity` items with highest counts
+        :param other: SpaceSaving
+        :return: None
+        """
+        for item, (count, error) in other.counts.iteritems():
+            entry = self.counts.setdefault(item, [0, 0])
+            entry[0] += count
+            entry[1] += error
+        self.total += other.total
+        if len(self.counts) > self.capacity:
+            for item, entry in heapq.nsmallest(len(self.counts) - self.capacity, self.counts.iteritems(),
+                                               key=lambda (item, entry): entry[0]):
+                del self.counts[item]
+        self.heap = [(counts[0], key) for key, counts in self.counts.iteritems()]
+        heapq.heapify(self.heap)
+
+    def top(self, k):
+        """
+        :param k: number of items
+        :return: list of (item, count, error) ordered by count, count is overestimated by at most error
+        """
+        top = heapq.nlargest(k, self.counts.iteritems(), key=lambda (item, entry): entry[0])
+        return [(item, count, error) for item, (count, error) in top]
@@ -0,0 +1,196 @@
+"""
+Tracking of postfix messages by queue ID, from cleanup through qmgr and delivery to removal from the queue.
+
+When a message is removed its size, number of recipients and delivery latencies are recorded as timings:
+  postfix.messages.lifecycle.size
+  postfix.messages.lifecycle.nrcpt
+  postfix.messages.lifecycle.delay                  end-to-end latency of the slowest recipient
+  postfix.messages.lifecycle.delays.before_qmgr     time before the queue manager, including message transmission
+  postfix.messages.lifecycle.delays.in_qmgr         time in the queue manager
+  postfix.messages.lifecycle.delays.conn_setup      connection setup time, including DNS, HELO and TLS
+  postfix.messages.lifecycle.delays.transmission    message transmission time
+Delays are reported in milliseconds.
+
+Memory is bounded: messages not seen for `ttl` seconds are expired and when more than `max_messages` are tracked the
+oldest ones are evicted. With `max_messages` 0 nothing is tracked, every message adds up to 7 timing samples, so
+tracking is enabled only on request.
+"""
+
+import time
+import logging
+from collections import deque
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+DELAYS = ('before_qmgr', 'in_qmgr', 'conn_setup', 'transmission')
+
+
+class Message(object):
+    __slots__ = ('created', 'last_seen', 'size', 'nrcpt', 'delay', 'delays')
+
+    def __init__(self, now):
+        self.created = now
+        self.last_seen = now
+        self.size = None
+        self.nrcpt = None
+        self.delay = None
+        self.delays = None
+
+
+class MessageTracker(object):
+    """
+    Thread-safe, bounded map of queue ID -> Message
+    """
+    prefix = 'postfix.messages.lifecycle'
+
+    def __init__(self, stats, max_messages=100000, ttl=7200):
+        """
+        :param stats: StatsAggregator receiving the metrics
+        :param max_messages: max number of tracked messages, 0 disables tracking
+        :param ttl: seconds after which a message not seen in logs is forgotten
+        :return:
+        """
+        self.stats = stats
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.reset()
+
+    def reset(self, keep=None):
+        """
+        Forgets tracked messages and recreates the lock (ie. in a freshly forked process)
+        :param keep: callable taking queue ID, True for messages to keep (ie. those of a worker's shard)
+        :return: None
+        """
+        tracked = [entry for entry in self.order if self.messages.get(entry[0]) is entry[1]] if keep else ()
+        self.lock = Lock()
+        self.messages = dict()
+        self.order = deque()  # (queue ID, Message) in order of tracking
+        for message_id, message in tracked:
+            if keep(message_id):
+                self.messages[message_id] = message
+                self.order.append((message_id, message))
+
+    def __len__(self):
+        return len(self.messages)
+
+    def dump(self):
+        """
+        :return: list of tracked messages as tuples, for a snapshot
+        """
+        with self.lock:
+            return [(message_id, message.created, message.last_seen, message.size, message.nrcpt, message.delay,
+                     message.delays)
+                    for message_id, message in self.order if self.messages.get(message_id) is message]
+
+    def load(self, messages):
+        """
+        Tracks messages of a snapshot, messages expired meanwhile are dropped
+        :param messages: result of `dump`
+        :return: None
+        """
+        with self.lock:
+            for message_id, created, last_seen, size, nrcpt, delay, delays in messages:
+                message = self.messages[message_id] = Message(created)
+                message.last_seen = last_seen
+                message.size = size
+                message.nrcpt = nrcpt
+                message.delay = delay
+                message.delays = delays
+                self.order.append((message_id, message))
+            self.evict(time.time())
+
+    def get(self, message_id, now):
+        """
+        Must be called with lock held
+        :return: Message
+        """
+        message = self.messages.get(message_id)
+        if message is None:
+            message = self.messages[message_id] = Message(now)
+            self.order.append((message_id, message))
+            self.evict(now)
+        else:
+            message.last_seen = now
+        return message
+
+    def evict(self, now):
+        """
+        Expires messages not seen for `ttl` seconds and evicts the oldest ones above `max_messages`.
+        Must be called with lock held.
+        :return: None
+        """
+        messages = self.messages
+        if len(self.order) > 2 * self.max_messages:  # drop entries of already removed messages
+            self.order = deque(entry for entry in self.order if messages.get(entry[0]) is entry[1])
+        order = self.order
+        while order:
+            message_id, message = order[0]
+            if messages.get(message_id) is not message:  # already removed
+                order.popleft()
+            elif now - message.last_seen > self.ttl:
+                order.popleft()
+                del messages[message_id]
+                self.stats.incr(self.prefix + '.expired', 1)
+            elif len(messages) > self.max_messages:
+                order.popleft()
+                del messages[message_id]
+                self.stats.incr(self.prefix + '.evicted', 1)
+            elif now - message.created > self.ttl:  # old, but still active
+                order.popleft()
+                message.created = now
+                order.append((message_id, message))
+            else:
+                break
+
+    def cleanup(self, message_id):
+        if not self.max_messages:
+            return
+        with self.lock:
+            self.get(message_id, time.time())
+
+    def queued(self, message_id, size, nrcpt):
+        if not self.max_messages:
+            return
+        with self.lock:
+            message = self.get(message_id, time.time())
+            message.size = int(size)
+            message.nrcpt = int(nrcpt)
+
+    def delivered(self, message_id, delay, delays):
+        """
+        Records delivery to one recipient, message keeps latencies of the slowest one
+        :param delay: total delay, ie. "0.1"
+        :param delays: delay breakdown, ie. "0.04/0.02/0.04/0"
+        :return: None
+        """
+        if not self.max_messages:
+            return
+        delay = float(delay)
+        delays = [float(value) for value in delays.split('/')]
+        with self.lock:
+            message = self.get(message_id, time.time())
+            if message.delay is None or delay > message.delay:
+                message.delay = delay
+            if message.delays is None:
+                message.delays = delays
+            else:
+                message.delays = map(max, message.delays, delays)
+
+    def removed(self, message_id):
+        if not self.max_messages:
+            return
+        with self.lock:
+            message = self.messages.pop(message_id, None)
+        if message is None:
+            return
+
+        stats = self.stats
+        stats.incr(self.prefix + '.completed', 1)
+        if message.size is not None:
+            stats.timing(self.prefix + '.size', message.size)
+            stats.timing(self.prefix + '.nrcpt', message.nrcpt)
+        if message.delay is not None:
+            stats.timing(self.prefix + '.delay', message.delay * 1000)
+            for name, value in zip(DELAYS, message.delays):
+                stats.timing(self.prefix + '.delays.' + name, value * 1000)
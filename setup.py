@@ -17,7 +17,7 @@ setup(
     packages=find_packages(),
     install_requires=[
         'schedule',
-        'statsd'
+        'statsd>=3.3'
     ],
     classifiers=[
     ],
@@ -25,6 +25,9 @@ setup(
         'console_scripts': [
             'postfix-stats-qshape=postfix_stats_collector.qshape:main',
             'postfix-stats-logparser=postfix_stats_collector.logparser:main',
+            'postfix-stats-benchmark=postfix_stats_collector.benchmark:main',
+            'postfix-stats-backfill=postfix_stats_collector.backfill:main',
+            'postfix-stats-daemon=postfix_stats_collector.daemon:main',
         ],
     }
 )
@@ -1,4 +1,15 @@
+import os
+import re
 import time
+import gzip
+import errno
+import json
+import shutil
+import socket
+import threading
+import urllib2
+import tempfile
+import subprocess
 import unittest
 import fileinput
 import mock
@@ -6,8 +17,27 @@ import Queue
 
 from collections import defaultdict
 
-from postfix_stats_collector.qshape import get_qshape_stats
-from postfix_stats_collector.logparser import ParserPool, register_handlers, Handler
+from postfix_stats_collector.qshape import get_qshape_stats, CollectionJob, GaugeSnapshot, report_qshape, \
+    split_counters
+from postfix_stats_collector import daemon
+from postfix_stats_collector.spool import SpoolScanner, write_queue_file, read_queue_file
+from postfix_stats_collector.logparser import ParserPool, ProcessParserPool, register_handlers, Handler, flush_stats, \
+    stats, queue_id, parse_envelope, BatchReader, MetricNames, parse_quantiles, load_rules, RuleHandler, Parser
+from postfix_stats_collector.aggregator import StatsAggregator, Flusher, Wakeup
+from postfix_stats_collector.tracker import MessageTracker
+from postfix_stats_collector.health import CollectorHealth, ParserHealth
+from postfix_stats_collector.exposition import MetricsRegistry, start_http_server
+from postfix_stats_collector.addresses import AddressMatcher, SubstringAutomaton
+from postfix_stats_collector.listener import SyslogListener, StreamFramer
+from postfix_stats_collector.follow import FollowReader
+from postfix_stats_collector.topk import SpaceSaving
+from postfix_stats_collector.sampling import LoadShedder, SampledBatch
+from postfix_stats_collector.sinks import make_sink, parse_spec, FileSink, NullSink, ReconnectingTCPClient
+from postfix_stats_collector.snapshot import save_snapshot, load_snapshot
+from postfix_stats_collector import logparser
+from postfix_stats_collector import backfill
+from postfix_stats_collector.quantiles import LogHistogram
+from postfix_stats_collector.benchmark import generate_log_lines, generate_qshape_output, parse_mix
 from pprint import pprint
 
 STATIC_QSHAPE = """
@@ -36,19 +66,162 @@ class TestQshapeParser(unittest.TestCase):
         self.assertEqual(dict_stats['postfix.qshape.active.example_com.10'], 4)
         self.assertIn('postfix.qshape.processing_time', dict_stats)
 
+    def test_timeout(self):
+        release = threading.Event()
+
+        def slow_qshape(args):
+            if args[-1] == 'deferred':
+                release.wait()
+            return STATIC_QSHAPE
+
+        with mock.patch('subprocess.check_output', mock.Mock(side_effect=slow_qshape)):
+            dict_stats = dict(get_qshape_stats(timeout=0.2))
+            self.assertEqual(dict_stats['postfix.qshape.deferred.timeout'], 1)
+            self.assertEqual(dict_stats['postfix.qshape.active.total.sum'], 6)
+            self.assertIn('postfix.qshape.active.processing_time', dict_stats)
+            self.assertNotIn('postfix.qshape.deferred.total.sum', dict_stats)
+            gauges, counters = split_counters(dict_stats.items())
+            self.assertEqual(counters, [('postfix.qshape.deferred.timeout', 1)])
+            self.assertIn(('postfix.qshape.active.total.sum', 6), gauges)
+
+            # deferred queue is still being collected, so it is not started again
+            dict_stats = dict(get_qshape_stats(timeout=0.2))
+            self.assertEqual(dict_stats['postfix.qshape.deferred.skipped'], 1)
+            release.set()
+
+    def test_gauge_snapshot(self):
+        snapshot = GaugeSnapshot(resync_interval=60)
+        first = [('postfix.qshape.active.total.sum', 2), ('postfix.qshape.active.a_com.sum', 2),
+                 ('postfix.qshape.deferred.total.sum', 5)]
+        self.assertEqual(snapshot.changes(first, now=0), sorted(first))
+        self.assertEqual(snapshot.changes(first, now=10), [])
+
+        # a.com left the active queue, deferred queue was not collected
+        self.assertEqual(snapshot.changes([('postfix.qshape.active.total.sum', 1)], now=20),
+                         [('postfix.qshape.active.a_com.sum', 0), ('postfix.qshape.active.total.sum', 1)])
+        self.assertEqual(snapshot.changes([('postfix.qshape.active.total.sum', 1)], now=30), [])
+        self.assertEqual(snapshot.changes([('postfix.qshape.active.total.sum', 1)], now=60),
+                         [('postfix.qshape.active.total.sum', 1)])
+        self.assertEqual(snapshot.queues['deferred'], {'postfix.qshape.deferred.total.sum': 5})
+
+    @mock.patch('subprocess.check_output', mock_check_output)
+    def test_daemon(self):
+        args = daemon.argparse_maker().parse_args(['--qshape-interval', '5', '--sink', 'null', '-'])
+        self.assertEqual((args.qshape_interval, args.sink_spec, args.log_files), (5, 'null', ['-']))
+
+        stats = StatsAggregator()
+        snapshot = GaugeSnapshot()
+        report_qshape(stats, snapshot, skipped_ticks=1)
+        metrics = stats.swap()
+        self.assertEqual(metrics.gauges['postfix.qshape.active.total.sum'], 6)
+        self.assertEqual(metrics.counters['postfix.qshape.skipped_ticks'], 1)
+        report_qshape(stats, snapshot)
+        self.assertNotIn('postfix.qshape.active.total.sum', stats.swap().gauges)
+
+    def test_collection_job(self):
+        release = threading.Event()
+        report = mock.Mock(side_effect=lambda skipped: release.wait())
+
+        job = CollectionJob(report)
+        job()
+        job()
+        job()
+        release.set()
+        job.thread.join()
+        job()
+        job.thread.join()
+        self.assertEqual(report.mock_calls, [mock.call(0), mock.call(2)])
+
+
+class TestSpoolScanner(unittest.TestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.now = time.time()
+        for queue in ('active', 'deferred/A', 'deferred/B', 'hold'):
+            os.makedirs(os.path.join(self.spool_dir, queue))
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def add_message(self, queue, name, age, recipients, **kwargs):
+        path = os.path.join(self.spool_dir, queue, name)
+        write_queue_file(path, self.now - age * 60, recipients, **kwargs)
+        return path
+
+    def test_read_queue_file(self):
+        path = self.add_message('active', 'A1', 0, ['a@Example.com', 'b@foo.bar'], delivered=['c@done.com'],
+                                content='Subject: x\n\n' + 'R' * 300 + '\n')
+        arrival_time, domains = read_queue_file(path)
+        self.assertEqual(int(arrival_time), int(self.now))
+        self.assertEqual(domains, ['example.com', 'foo.bar'])
+
+    def test_shape(self):
+        self.add_message('deferred/A', 'A1', 1, ['a@example.com'])
+        self.add_message('deferred/A', 'A2', 7, ['a@example.com', 'b@example.com'])
+        self.add_message('deferred/B', 'B1', 30, ['a@foo.bar'])
+        self.add_message('deferred/B', 'B2', 6000, ['a@gmail.com'])
+
+        scanner = SpoolScanner(self.spool_dir)
+        headers, rows = scanner.shape('deferred', limit_top_domains=1, now=self.now)
+        self.assertEqual(headers[0], '5')
+        self.assertEqual(headers[-1], '5120+')
+        self.assertEqual(rows[0], ('TOTAL', 5, [1, 2, 0, 1, 0, 0, 0, 0, 0, 0, 0, 1]))
+        self.assertEqual(rows[1], ('example.com', 3, [1, 2, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]))
+        self.assertEqual(len(rows), 2)
+
+        stats = dict(get_qshape_stats(limit_top_domains=1, scanner=scanner))
+        self.assertEqual(stats['postfix.qshape.deferred.total.sum'], 5)
+        self.assertEqual(stats['postfix.qshape.deferred.total.5'], 4)
+        self.assertEqual(stats['postfix.qshape.deferred.total.40'], 1)
+        self.assertEqual(stats['postfix.qshape.deferred.example_com.5'], 2)
+        self.assertEqual(stats['postfix.qshape.maildrop.total.sum'], 0)
+
+    def test_cache(self):
+        path = self.add_message('active', 'A1', 0, ['a@example.com'])
+        scanner = SpoolScanner(self.spool_dir)
+        with mock.patch('postfix_stats_collector.spool.read_queue_file', side_effect=read_queue_file) as reader:
+            self.assertEqual(len(list(scanner.scan('active'))), 1)
+            self.assertEqual(len(list(scanner.scan('active'))), 1)
+            self.assertEqual(reader.call_count, 1)
+
+            os.unlink(path)
+            self.assertEqual(list(scanner.scan('active')), [])
+            self.assertEqual(scanner.cache['active'], {})
+
+
+    def test_errors(self):
+        self.add_message('active', 'A1', 0, ['a@example.com'])
+        scanner = SpoolScanner(self.spool_dir)
+        self.assertEqual(list(scanner.scan('missing')), [])
+
+        gone = IOError(errno.ENOENT, 'No such file or directory')
+        with mock.patch('postfix_stats_collector.spool.read_queue_file', side_effect=gone):
+            self.assertEqual(list(scanner.scan('active')), [])
+
+        denied = IOError(errno.EACCES, 'Permission denied')
+        with mock.patch('postfix_stats_collector.spool.read_queue_file', side_effect=denied):
+            self.assertRaises(IOError, list, scanner.scan('active'))
+            stats = dict(get_qshape_stats(scanner=scanner))
+        self.assertNotIn('postfix.qshape.active.total.sum', stats)
+        self.assertEqual(stats['postfix.qshape.hold.total.sum'], 0)
+
+        with mock.patch('os.listdir', side_effect=OSError(errno.EACCES, 'Permission denied')):
+            self.assertRaises(OSError, list, scanner.scan('active'))
+
 
 class TestLogParser(unittest.TestCase):
     def test_handler_registration(self):
         register_handlers()
         self.assertTrue(Handler.handlers)
 
-    @mock.patch('postfix_stats_collector.logparser.statsd')
+    @mock.patch('postfix_stats_collector.logparser.sink')
     def test_lines(self, statsd_mock):
         statsd_data = defaultdict(int)
 
         def statsd_mock_incr(k, v):
             statsd_data[k] += v
         statsd_mock.incr.side_effect = statsd_mock_incr
+        statsd_mock.pipeline.return_value.__enter__.return_value = statsd_mock
 
         logreader = fileinput.input('tests.mail.log')
         parser_pool = ParserPool(10)
@@ -59,6 +232,7 @@ class TestLogParser(unittest.TestCase):
                 time.sleep(0.1)
 
         parser_pool.join()
+        flush_stats()
         self.assertTrue(statsd_mock.incr.called)
         self.assertIn(mock.call('postfix.messages.bounce', 1), statsd_mock.incr.mock_calls)  #
         self.assertDictContainsSubset({
@@ -69,6 +243,920 @@ class TestLogParser(unittest.TestCase):
             },
             statsd_data)
 
+    def test_process_pool(self):
+        register_handlers()
+        stats.swap()
+
+        parser_pool = ProcessParserPool(3, batch_size=4)
+        for line in fileinput.input('tests.mail.log'):
+            parser_pool.add_line(line.strip('\n'), block=True)
+        parser_pool.join()
+
+        self.assertDictContainsSubset({
+            'postfix.messages.bounce': 1,
+            'postfix.messages.cleanup': 3,
+            'postfix.messages.send.resp_codes.5_4_4': 2,
+            'postfix.messages.send.status.bounced': 2
+            },
+            stats.swap().counters)
+
+    def test_process_pool_full(self):
+        register_handlers()
+        stats.swap()
+
+        parser_pool = ProcessParserPool(2, batch_size=1000)
+        full = parser_pool.queues[0]
+        parser_pool.queues[0] = mock.Mock(**{'put.side_effect': Queue.Full})
+        lines = open('tests.mail.log').read().splitlines()
+        with self.assertRaises(logparser.LinesDropped) as raised:
+            parser_pool.add_batch(lines)
+        # lines of the full shard are dropped exactly once, the other shard is still sent
+        self.assertEqual(raised.exception.lines, len(parser_pool.queues[0].put.call_args[0][0]))
+        self.assertEqual(parser_pool.pending, [[], []])
+        self.assertLess(raised.exception.lines, len(lines))
+        parser_pool.queues[0] = full
+        parser_pool.join()
+        self.assertTrue(stats.swap().counters)
+
+    def test_process_pool_quiet(self):
+        register_handlers()
+        stats.swap()
+
+        parser_pool = ProcessParserPool(2)
+        parser_pool.add_batch(open('tests.mail.log').read().splitlines(), block=True)
+        # no more lines arrive, workers report on schedule anyway
+        counters = defaultdict(int)
+        deadline = time.time() + 3
+        while counters['postfix.messages.cleanup'] < 3 and time.time() < deadline:
+            time.sleep(0.1)
+            for stat, value in stats.swap().counters.items():
+                counters[stat] += value
+        parser_pool.join()
+        self.assertEqual(counters['postfix.messages.cleanup'], 3)
+
+    def test_queue_id(self):
+        self.assertEqual(queue_id('Nov  1 06:25:09 f86adfc82f78 postfix/qmgr[40]: 7774E75F4: removed'), '7774E75F4')
+        self.assertEqual(queue_id('garbage'), '')
+        self.assertEqual(queue_id('<22>1 2015-11-01T06:25:09Z f86adfc82f78 postfix/qmgr 40 - - 7774E75F4: removed'),
+                         '7774E75F4')
+        self.assertEqual(queue_id('<22>1 2015-11-01T06:25:09Z mx postfix/qmgr 40 - [origin ip="192.0.2.1"] '
+                                  '7774E75F4: removed'), '7774E75F4')
+        self.assertEqual(queue_id('<22>1 2015-11-01T06:25:09Z mx postfix/qmgr'), '')
+
+    def test_process_pool_rfc5424_shards(self):
+        parser_pool = ProcessParserPool(4, batch_size=1000, max_latency=60)
+        try:
+            for i in xrange(100):
+                parser_pool.add_line('<22>1 2015-11-01T06:25:09Z mx postfix/qmgr 40 - - {:X}: removed'.format(i))
+            self.assertGreater(len([pending for pending in parser_pool.pending if pending]), 1)
+        finally:
+            parser_pool.join()
+
+    def test_batches(self):
+        register_handlers()
+        stats.swap()
+
+        reader = BatchReader(['tests.mail.log'], batch_size=4)
+        parser_pool = ParserPool(2)
+        batches = list(reader)
+        for batch in batches:
+            parser_pool.add_batch(batch, block=True)
+        parser_pool.join()
+
+        self.assertTrue(all(len(batch) <= 4 for batch in batches))
+        self.assertEqual(sum(len(batch) for batch in batches), len(open('tests.mail.log').read().splitlines()))
+        self.assertFalse(reader.isstdin())
+        self.assertFalse(reader.islive())
+        self.assertEqual(stats.swap().counters['postfix.messages.cleanup'], 3)
+
+    def test_batch_latency(self):
+        r, w = os.pipe()
+        os.write(w, 'first\nsecond\nthi')
+        reader = BatchReader(None, batch_size=100, max_latency=0.05)
+        with mock.patch('sys.stdin', os.fdopen(r)):
+            batches = iter(reader)
+            self.assertEqual(next(batches), ['first', 'second'])  # yielded before the pipe is closed
+            os.write(w, 'rd\n')
+            os.close(w)
+            self.assertEqual(list(batches), [['third']])
+
+    def test_health(self):
+        register_handlers()
+        stats.swap()
+        health = CollectorHealth(prefix='collector')
+
+        parser_pool = ParserPool(2, health=health)
+        parser_pool.add_batch(open('tests.mail.log').read().splitlines(), block=True)
+        parser_pool.join()
+
+        health.lines_read = 45
+        health.report(stats)
+        metrics = stats.swap()
+        self.assertEqual(metrics.counters['collector.lines.read'], 45)
+        self.assertEqual(metrics.counters['collector.handlers.CleanupHandler.matches'], 3)
+        self.assertEqual(metrics.counters['collector.lines.matched'] + metrics.counters['collector.lines.unmatched'],
+                         metrics.counters['collector.lines.parsed'])
+        self.assertEqual(metrics.gauges['collector.queue_depth'], 0)
+        self.assertIn('collector.workers.thread0.utilisation', metrics.gauges)
+
+        # only changes are reported
+        health.report(stats)
+        self.assertNotIn('collector.lines.read', stats.swap().counters)
+
+    def test_health_regex_time(self):
+        health = ParserHealth('thread0')
+        aggregator = StatsAggregator()
+        for i in xrange(100):
+            health.handler_time['CleanupHandler'] += 0.0005
+            health.report(aggregator, 'collector')
+        # fractions of a millisecond carry over to later reports
+        self.assertEqual(aggregator.swap().counters['collector.handlers.CleanupHandler.regex_time'], 50)
+
+    def test_process_pool_health(self):
+        register_handlers()
+        stats.swap()
+
+        parser_pool = ProcessParserPool(2, health=CollectorHealth())
+        parser_pool.add_batch(open('tests.mail.log').read().splitlines(), block=True)
+        parser_pool.join()
+
+        metrics = stats.swap()
+        self.assertEqual(metrics.counters['postfix.collector.handlers.CleanupHandler.matches'], 3)
+        self.assertIn('postfix.collector.workers.process1.utilisation', metrics.gauges)
+
+    @mock.patch.object(stats, 'max_hosts', 10)
+    def test_process_pool_health_hosts(self):
+        register_handlers()
+        stats.swap()
+
+        parser_pool = ProcessParserPool(2, health=CollectorHealth())
+        parser_pool.add_batch(open('tests.mail.log').read().splitlines(), block=True)
+        parser_pool.join()
+
+        metrics = stats.swap()
+        self.assertTrue(metrics.hosts)
+        for counters in metrics.hosts.itervalues():
+            self.assertFalse([stat for stat in counters if stat.startswith('postfix.collector.')])
+
+
+class TestMetricNames(unittest.TestCase):
+    def test_names(self):
+        names = MetricNames('postfix.messages.{}.resp_codes.{}', max_size=3)
+        name = names('send', '2.0.0')
+        self.assertEqual(name, 'postfix.messages.send.resp_codes.2_0_0')
+        self.assertIs(names('send', '2.0.0'), name)
+        self.assertEqual(names('recv', '2.0.0'), 'postfix.messages.recv.resp_codes.2_0_0')
+        names('send', '4.4.1')
+        names('send', '5.1.1')  # over max_size, memo starts over
+        self.assertEqual(names.size, 1)
+        self.assertEqual(names('send', '2.0.0'), name)
+
+    def test_handler_arguments(self):
+        class BrokenHandler(Handler):
+            facilities = set()
+            filter_re = re.compile(r'(?P<message_id>\w+): (?P<status>\w+)')
+
+            def handle(self, status=None, message_id=None):
+                pass
+
+        self.assertRaises(AssertionError, BrokenHandler)
+
+
+class TestRules(unittest.TestCase):
+    def tearDown(self):
+        for facility, handlers in Handler.handlers.items():
+            handlers[:] = [handler for handler in handlers if not isinstance(handler, RuleHandler)]
+
+    def test_example_rules(self):
+        register_handlers()
+        rules = load_rules('rules.example.ini')
+        self.assertEqual([(rule.name, rule.prefilter) for rule in rules], [
+            ('postscreen_pass', 'PASS'),
+            ('postscreen_reject', 'NOQUEUE: reject:'),
+            ('postscreen_dnsbl', 'DNSBL rank'),
+            ('anvil_max_connection_rate', 'max connection rate'),
+            ('pickup', ': uid='),
+            ('deferred', 'status=deferred'),
+        ])
+        self.assertIn('postscreen_pass', [rule.name for rule in Handler.handlers['postscreen']])
+        self.assertEqual(len(Handler.handlers['smtp']), 2)
+        load_rules('rules.example.ini')  # loading again replaces the rules
+        self.assertEqual(len(Handler.handlers['smtp']), 2)
+
+        stats.swap()
+        stats.top_k = 1
+        try:
+            for line in [
+                'Nov  1 06:25:09 mx postfix/postscreen[7]: PASS NEW [192.0.2.1]:5000',
+                'Nov  1 06:25:09 mx postfix/postscreen[7]: NOQUEUE: reject: RCPT from [192.0.2.2]:5000: 550 5.7.1 '
+                'Service unavailable',
+                'Nov  1 06:25:09 mx postfix/anvil[7]: statistics: max connection rate 3/60s for (smtp:192.0.2.1) at '
+                'Nov  1 06:20:01',
+                'Nov  1 06:25:09 mx postfix/pickup[7]: 7774E75F4: uid=0 from=<root>',
+                'Nov  1 06:25:09 mx postfix/smtp[7]: 7774E75F4: to=<a@example.com>, relay=none, delay=1, '
+                'delays=1/0/0/0, dsn=4.4.1, status=deferred (connect timed out)',
+            ]:
+                Parser.parse_line(line)
+            metrics = stats.swap()
+        finally:
+            stats.top_k = 0
+        self.assertEqual(metrics.counters['postfix.postscreen.pass.NEW'], 1)
+        self.assertEqual(metrics.counters['postfix.postscreen.reject.550'], 1)
+        self.assertEqual(metrics.counters['postfix.anvil.max_connection_rate.smtp'], 1)
+        self.assertEqual(metrics.counters['postfix.messages.pickup'], 1)
+        self.assertEqual(metrics.counters['postfix.messages.deferred.4_4_1'], 1)
+        self.assertEqual(metrics.counters['postfix.messages.send.status.deferred'], 1)  # built-in handler still runs
+        self.assertEqual(list(metrics.top()), [('postscreen_rejects', '192.0.2.2', 1)])
+
+    def test_prefilter(self):
+        rule = RuleHandler('test', ['test'], r'(?P<word>\w+)', prefilter='hit', incr=['test.{word}'])
+        stats.swap()
+        self.assertFalse(rule.parse('miss'))
+        self.assertTrue(rule.parse('hit.me'))
+        self.assertEqual(dict(stats.swap().counters), {'test.hit': 1})
+        self.assertRaises(ValueError, RuleHandler, 'test', ['test'], r'(?P<word>\w+)', incr=['test.{other}'])
+
+
+class TestBackfill(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        backfill.bucket_seconds = 0
+
+    def test_chunks(self):
+        path = os.path.join(self.tmp_dir, 'mail.log')
+        with open(path, 'w') as f:
+            f.write('first line\nsecond line\nthird')
+        chunks = backfill.split_chunks(path, 5)
+        self.assertEqual(chunks, [(path, 0, 11), (path, 11, 23), (path, 23, 28)])
+        self.assertEqual(backfill.parse_task(chunks[1])[:2], (1, 12))
+
+    @unittest.skipUnless(any(os.access(os.path.join(d, 'xz'), os.X_OK) for d in os.environ['PATH'].split(':')),
+                         'xz not installed')
+    @mock.patch('postfix_stats_collector.backfill.lzma', None)
+    def test_xz(self):
+        register_handlers()
+        path = os.path.join(self.tmp_dir, 'mail.log.1.xz')
+        shutil.copy('tests.mail.log', path[:-3])
+        subprocess.check_call(['xz', path[:-3]])
+        lines = len(open('tests.mail.log').read().splitlines())
+        self.assertEqual(backfill.parse_task(path)[:2], (lines, os.path.getsize('tests.mail.log')))
+
+        with open(path, 'wb') as f:
+            f.write('not xz')
+        with self.assertRaises(IOError):
+            backfill.parse_task(path)
+
+    def test_timestamps(self):
+        self.assertEqual(backfill.parse_timestamp('2015-11-01T06:25:09.123+01:00'), 1446355509)
+        self.assertEqual(backfill.parse_timestamp('2015-11-01T05:25:09Z'), 1446355509)
+        self.assertEqual(backfill.line_date('<22>1 2015-11-01T05:25:09Z host postfix/smtp 1 - - x'),
+                         '2015-11-01T05:25:09Z')
+        self.assertEqual(backfill.line_date('Jul 2 12:24:48 host postfix/smtp[1]: x'), 'Jul 2 12:24:48')
+
+    def test_backfill(self):
+        register_handlers()
+        compressed = os.path.join(self.tmp_dir, 'mail.log.1.gz')
+        with open('tests.mail.log') as src:
+            f = gzip.open(compressed, 'wb')
+            f.write(src.read())
+            f.close()
+        output = os.path.join(self.tmp_dir, 'graphite.txt')
+        with open(output, 'w') as f:
+            lines, size, seconds = backfill.backfill(['tests.mail.log', compressed], processes=2, bucket=3600,
+                                                     output=f)
+        self.assertEqual(lines, 2 * len(open('tests.mail.log').read().splitlines()))
+        self.assertEqual(size, 2 * os.path.getsize('tests.mail.log'))
+
+        cleanups = defaultdict(int)
+        for line in open(output):
+            stat, value, timestamp = line.split()
+            self.assertEqual(int(timestamp) % 3600, 0)
+            if stat == 'postfix.messages.cleanup':
+                cleanups[timestamp] += int(value)
+        self.assertEqual(sum(cleanups.values()), 6)
+
+
+class TestEnvelope(unittest.TestCase):
+    def test_formats(self):
+        self.assertEqual(parse_envelope('Nov  1 06:25:09 f86adfc82f78 postfix/qmgr[40]: 7774E75F4: removed'),
+                         ('Nov  1 06:25:09', 'f86adfc82f78', 'qmgr', '7774E75F4: removed'))
+        self.assertEqual(parse_envelope('Jul 2 12:24:48 username postfix/qmgr[12345]: 1234567890A: removed'),
+                         ('Jul 2 12:24:48', 'username', 'qmgr', '1234567890A: removed'))
+        self.assertEqual(parse_envelope('2015-11-01T06:25:09.123+00:00 relay postfix/qmgr[40]: 7774E75F4: removed'),
+                         ('2015-11-01T06:25:09.123+00:00', 'relay', 'qmgr', '7774E75F4: removed'))
+        self.assertEqual(parse_envelope('<22>1 2015-11-01T06:25:09Z relay postfix/qmgr 40 - - 7774E75F4: removed'),
+                         ('2015-11-01T06:25:09Z', 'relay', 'qmgr', '7774E75F4: removed'))
+        self.assertEqual(parse_envelope('<22>1 2015-11-01T06:25:09Z relay postfix/qmgr 40 - [id a="\\]"][b] 7774E75F4: removed'),
+                         ('2015-11-01T06:25:09Z', 'relay', 'qmgr', '7774E75F4: removed'))
+        self.assertEqual(parse_envelope('Nov  1 06:25:09 relay postfix/master: warning: bad command'),
+                         ('Nov  1 06:25:09', 'relay', 'master', 'warning: bad command'))
+        self.assertIsNone(parse_envelope('garbage'))
+        self.assertIsNone(parse_envelope(''))
+
+    def test_unregistered_facility(self):
+        line = 'Nov  1 06:25:09 f86adfc82f78 postfix/pickup[4904]: 7774E75F4: uid=0 from=<root>'
+        self.assertIsNone(parse_envelope(line, set(['qmgr'])))
+        self.assertEqual(parse_envelope(line, set(['pickup']))[2], 'pickup')
+
+
+class TestStatsAggregator(unittest.TestCase):
+    def test_flush(self):
+        stats = StatsAggregator()
+        for i in range(5):
+            stats.incr('postfix.messages.cleanup', 1)
+        stats.incr('postfix.messages.bounce', 2)
+
+        client = mock.MagicMock()
+        pipe = client.pipeline.return_value.__enter__.return_value
+        self.assertEqual(stats.flush(client), 2)
+        self.assertEqual(client.pipeline.call_count, 1)
+        self.assertIn(mock.call('postfix.messages.cleanup', 5), pipe.incr.mock_calls)
+        self.assertIn(mock.call('postfix.messages.bounce', 2), pipe.incr.mock_calls)
+
+        # nothing pending, nothing sent
+        self.assertEqual(stats.flush(client), 0)
+        self.assertEqual(client.pipeline.call_count, 1)
+
+    def test_flush_needed(self):
+        stats = StatsAggregator(max_pending=2)
+        stats.incr('a')
+        self.assertFalse(stats.flush_needed.is_set())
+        stats.incr('b')
+        self.assertTrue(stats.flush_needed.is_set())
+
+    def test_wakeup(self):
+        wakeup = Wakeup()
+        self.assertFalse(wakeup.wait(0.01))
+        threading.Timer(0.05, wakeup.set).start()
+        t0 = time.time()
+        self.assertTrue(wakeup.wait(5))
+        self.assertLess(time.time() - t0, 1)
+        self.assertTrue(wakeup.wait(0))
+        wakeup.clear()
+        self.assertFalse(wakeup.is_set())
+        self.assertFalse(wakeup.wait(0))
+
+    def test_flusher_jobs(self):
+        stats = StatsAggregator()
+        flushed = threading.Event()
+        ran = threading.Event()
+        flusher = Flusher(stats, flushed.set, 60)
+        flusher.every(0.01, ran.set)
+        flusher.start()
+        try:
+            self.assertTrue(ran.wait(5))
+            self.assertFalse(flushed.is_set())  # jobs do not flush
+            stats.flush_needed.set()
+            self.assertTrue(flushed.wait(5))
+        finally:
+            flusher.stop()
+
+    def test_hosts(self):
+        stats = StatsAggregator(max_hosts=2)
+        for host in ('relay1.example.com', 'relay2', 'relay3', 'relay1.example.com', None):
+            stats.set_host(host)
+            stats.incr('postfix.messages.cleanup', 1)
+
+        worker = StatsAggregator(max_hosts=2)
+        for host in ('relay4', 'relay2'):
+            worker.set_host(host)
+            worker.incr('postfix.messages.bounce', 1)
+        stats.merge(worker.swap())
+
+        metrics = stats.swap()
+        self.assertEqual(metrics.counters['postfix.messages.cleanup'], 5)
+        self.assertEqual(dict((host, dict(counters)) for host, counters in metrics.hosts.iteritems()), {
+            'relay1_example_com': {'postfix.messages.cleanup': 2},
+            'relay2': {'postfix.messages.cleanup': 1, 'postfix.messages.bounce': 1},
+            'other': {'postfix.messages.cleanup': 1, 'postfix.messages.bounce': 1},
+        })
+
+        client = mock.MagicMock()
+        metrics.send(client)
+        pipe = client.pipeline.return_value.__enter__.return_value
+        self.assertIn(mock.call('postfix.hosts.relay1_example_com.messages.cleanup', 2), pipe.incr.mock_calls)
+
+        registry = MetricsRegistry()
+        registry.update(metrics)
+        self.assertIn('postfix_messages_cleanup_total 5\npostfix_messages_cleanup_total{host="other"} 1\n',
+                      registry.openmetrics)
+
+
+class TestLoadShedder(unittest.TestCase):
+    def test_rate(self):
+        depth = [0]
+        shedder = LoadShedder(lambda: depth[0], 100, queue_id, watermark=0.5, max_rate=6, interval=1)
+        self.assertEqual(shedder.update(now=10), 1)
+        depth[0] = 60
+        self.assertEqual(shedder.update(now=11), 2)
+        self.assertEqual(shedder.update(now=11.5), 2)  # changed less than interval ago
+        self.assertEqual(shedder.update(now=12), 4)
+        self.assertEqual(shedder.update(now=13), 4)  # 8 exceeds max_rate
+        depth[0] = 20
+        self.assertEqual(shedder.update(now=14), 4)  # between watermarks
+        depth[0] = 10
+        self.assertEqual(shedder.update(now=15), 2)
+        self.assertEqual(shedder.update(now=16), 1)
+
+    def test_sample(self):
+        shedder = LoadShedder(lambda: 100, 100, queue_id, max_rate=4, interval=0)
+        lines = ['Nov  1 06:25:09 host postfix/qmgr[40]: {:X}: {}'.format(i // 2, i) for i in xrange(4000)]
+        shedder.update()
+        batch = shedder.sample(lines)
+        self.assertIsInstance(batch, SampledBatch)
+        self.assertEqual(batch.scale, 4)
+        self.assertTrue(800 < len(batch) < 1200)
+        kept = [queue_id(line) for line in batch]
+        self.assertEqual(len(kept), 2 * len(set(kept)))  # both lines of kept messages
+
+    def test_sample_rfc5424(self):
+        shedder = LoadShedder(lambda: 100, 100, queue_id, max_rate=4, interval=0)
+        lines = ['<22>1 2015-11-01T06:25:09Z mx postfix/qmgr 40 - - {:X}: {}'.format(i // 2, i) for i in xrange(4000)]
+        shedder.update()
+        kept = [queue_id(line) for line in shedder.sample(lines)]
+        self.assertTrue(400 < len(set(kept)) < 600)
+        self.assertEqual(len(kept), 2 * len(set(kept)))  # both lines of kept messages
+
+    def test_scaled_counters(self):
+        stats = StatsAggregator(top_k=1)
+        stats.set_scale(4)
+        stats.incr('postfix.messages.cleanup')
+        stats.top('clients', '192.0.2.1')
+        stats.set_scale(1)
+        stats.incr('postfix.messages.cleanup')
+        metrics = stats.swap()
+        self.assertEqual(metrics.counters['postfix.messages.cleanup'], 5)
+        self.assertEqual(list(metrics.top()), [('clients', '192.0.2.1', 4)])
+
+
+class TestSpaceSaving(unittest.TestCase):
+    def test_heavy_hitters(self):
+        summary = SpaceSaving(capacity=10)
+        for i in xrange(1000):
+            summary.offer('heavy')
+            summary.offer('medium' if i % 2 else 'spam{}'.format(i))
+        self.assertEqual(len(summary), 10)
+        self.assertEqual(summary.total, 2000)
+        top = summary.top(2)
+        self.assertEqual([item for item, count, error in top], ['heavy', 'medium'])
+        self.assertEqual(top[0][1:], (1000, 0))
+        self.assertTrue(top[1][1] - top[1][2] <= 500 <= top[1][1])
+
+        other = SpaceSaving(capacity=10)
+        other.offer('medium', 600)
+        summary.merge(other)
+        self.assertEqual(len(summary), 10)
+        self.assertEqual(summary.top(1)[0][0], 'medium')
+
+    def test_aggregator(self):
+        stats = StatsAggregator(top_k=1)
+        for ip in ('192.0.2.1', '192.0.2.1', '2001:db8::1'):
+            stats.top('clients', ip)
+        StatsAggregator().top('clients', 'ignored')  # disabled
+
+        client = mock.MagicMock()
+        stats.flush(client)
+        pipe = client.pipeline.return_value.__enter__.return_value
+        self.assertEqual(pipe.incr.mock_calls, [mock.call('postfix.top.clients.192_0_2_1', 2)])
+
+
+class TestLogHistogram(unittest.TestCase):
+    def test_quantiles(self):
+        values = [i * 0.37 for i in xrange(10000)]
+        histograms = [LogHistogram(), LogHistogram()]
+        for i, value in enumerate(values):
+            histograms[i % 2].add(value)
+        histogram = histograms[0]
+        histogram.merge(histograms[1])
+
+        self.assertEqual(histogram.count, 10000)
+        self.assertEqual(histogram.max, values[-1])
+        for q, value in zip((0, 0.5, 0.9, 0.99, 1), histogram.quantiles((0, 0.5, 0.9, 0.99, 1))):
+            expected = values[int(q * (len(values) - 1))]
+            self.assertAlmostEqual(value, expected, delta=expected * 0.01 + 0.37)
+        self.assertEqual(LogHistogram().quantiles((0.5, 0.9)), [0.0, 0.0])
+
+    def test_aggregator(self):
+        self.assertEqual(parse_quantiles('99,50,99.9'), (0.5, 0.99, 0.999))
+        stats = StatsAggregator(quantiles=parse_quantiles('50,99.9'))
+        for value in (0, 100, 100, 200):
+            stats.observe('postfix.delays.send.total', value)
+        StatsAggregator().observe('postfix.delays.send.total', 1)  # disabled
+
+        client = mock.MagicMock()
+        stats.flush(client)
+        pipe = client.pipeline.return_value.__enter__.return_value
+        gauges = dict(call[1] for call in pipe.gauge.mock_calls)
+        self.assertEqual(sorted(gauges), ['postfix.delays.send.total.max', 'postfix.delays.send.total.p50',
+                                          'postfix.delays.send.total.p99_9'])
+        self.assertAlmostEqual(gauges['postfix.delays.send.total.p50'], 100, delta=1)
+        self.assertAlmostEqual(gauges['postfix.delays.send.total.p99_9'], 200, delta=2)
+
+
+class TestMessageTracker(unittest.TestCase):
+    def test_lifecycle(self):
+        stats = StatsAggregator()
+        tracker = MessageTracker(stats)
+        tracker.cleanup('7774E75F4')
+        tracker.queued('7774E75F4', '980', '2')
+        tracker.delivered('7774E75F4', '0.1', '0.04/0.02/0.04/0')
+        tracker.delivered('7774E75F4', '0.3', '0.04/0.2/0.01/0.05')
+        self.assertEqual(len(tracker), 1)
+        tracker.removed('7774E75F4')
+        tracker.removed('unknown')
+        self.assertEqual(len(tracker), 0)
+
+        metrics = stats.swap()
+        self.assertEqual(metrics.counters['postfix.messages.lifecycle.completed'], 1)
+        self.assertEqual(metrics.timers['postfix.messages.lifecycle.size'], [980])
+        self.assertEqual(metrics.timers['postfix.messages.lifecycle.nrcpt'], [2])
+        self.assertEqual(metrics.timers['postfix.messages.lifecycle.delay'], [300])
+        self.assertEqual(metrics.timers['postfix.messages.lifecycle.delays.in_qmgr'], [200])
+        self.assertEqual(metrics.timers['postfix.messages.lifecycle.delays.conn_setup'], [40])
+
+    def test_eviction(self):
+        stats = StatsAggregator()
+        tracker = MessageTracker(stats, max_messages=10, ttl=60)
+        for i in xrange(25):
+            tracker.cleanup('ID%s' % i)
+        self.assertEqual(len(tracker), 10)
+        self.assertIn('ID24', tracker.messages)
+        self.assertNotIn('ID0', tracker.messages)
+        self.assertEqual(stats.swap().counters['postfix.messages.lifecycle.evicted'], 15)
+
+        with mock.patch('time.time', return_value=time.time() + 120):
+            tracker.cleanup('late')
+        self.assertEqual(len(tracker), 1)
+        self.assertEqual(stats.swap().counters['postfix.messages.lifecycle.expired'], 10)
+
+
+    def test_disabled(self):
+        stats = StatsAggregator()
+        tracker = MessageTracker(stats, max_messages=0)
+        tracker.cleanup('7774E75F4')
+        tracker.delivered('7774E75F4', '0.1', '0.04/0.02/0.04/0')
+        tracker.removed('7774E75F4')
+        self.assertEqual(len(tracker), 0)
+        self.assertFalse(stats.swap().pending)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_generators(self):
+        lines = generate_log_lines(100, seed=1, mix=parse_mix('smtp=1,qmgr=0'))
+        self.assertEqual(lines, generate_log_lines(100, seed=1, mix=parse_mix('smtp=1,qmgr=0')))
+        envelopes = [parse_envelope(line) for line in lines]
+        self.assertTrue(all(envelopes))
+        self.assertNotIn('qmgr', set(envelope[2] for envelope in envelopes))
+
+        with mock.patch('subprocess.check_output', mock.Mock(return_value=generate_qshape_output(5))):
+            dict_stats = dict(get_qshape_stats(limit_top_domains=5))
+        self.assertIn('postfix.qshape.deferred.domain4_example_com.5', dict_stats)
+
+
+class TestAddressMatcher(unittest.TestCase):
+    def test_match(self):
+        matcher = AddressMatcher()
+        matcher.add_spec('info@example.com,info,yes')
+        matcher.add_spec('@example.com,example,no')
+        matcher.add_spec('@mail.example.com,mail,no')
+        matcher.add_spec('+bounce,bounce,no')
+        matcher.add_spec('.*,regex,no')
+        matcher.build()
+
+        self.assertEqual(matcher.match('Info@Example.com'), ('info@example.com', ('info', True)))
+        self.assertEqual(matcher.match('sales@example.com')[0], '@example.com')
+        self.assertEqual(matcher.match('sales@eu.mail.example.com')[0], '@mail.example.com')
+        self.assertIsNone(matcher.match('sales@example.com.evil.org'))
+        self.assertIsNone(matcher.match('sales@notexample.com'))
+        self.assertEqual(matcher.match('list+bounce@example.org')[0], '+bounce')
+        self.assertIsNone(matcher.match('anything@example.org'))  # rules are literal, not regular expressions
+        self.assertRaises(ValueError, matcher.add_spec, 'info@example.com,info')
+
+    def test_automaton(self):
+        automaton = SubstringAutomaton()
+        for pattern in ('he', 'she', 'his', 'hers', 'shell'):
+            automaton.add(pattern)
+        self.assertEqual(len(automaton), 5)
+        self.assertRaises(RuntimeError, automaton.search, 'ushers')
+        automaton.build()
+        self.assertEqual(automaton.search('ushers'), 'she')
+        self.assertEqual(automaton.search('seashells'), 'shell')
+        self.assertEqual(automaton.search('ahishe'), 'his')
+        self.assertEqual(automaton.search('xhxex'), None)
+        automaton.add('hish')
+        automaton.build()
+        self.assertEqual(automaton.search('ahishe'), 'hish')
+
+    def test_load(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('# local mailboxes\n\nroot@localhost,root,no\n@lists.example.com,lists,yes\n')
+            matcher = AddressMatcher()
+            self.assertEqual(matcher.load(path), 2)
+            self.assertEqual(matcher.match('announce@lists.example.com')[1], ('lists', True))
+
+            with open(path, 'a') as f:
+                f.write('broken\n')
+            self.assertRaises(ValueError, AddressMatcher().load, path)
+        finally:
+            os.remove(path)
+
+
+class TestSyslogListener(unittest.TestCase):
+    def test_framing(self):
+        framer = StreamFramer(max_size=100)
+        self.assertEqual(framer.feed('<22>first\r\n<22>sec'), ['<22>first'])
+        self.assertEqual(framer.feed('ond\n14 <22>multi\nli'), ['<22>second'])
+        self.assertEqual(framer.feed('ne\n2015-11-01T06:25:09Z host postfix/smtp[1]: iso\n1'),
+                         ['<22>multi\nline', '2015-11-01T06:25:09Z host postfix/smtp[1]: iso'])
+        self.assertEqual(framer.feed('0 <22>tenths\nlast'), ['<22>tenths'])
+        self.assertEqual(framer.close(), ['last'])
+
+        framer.feed('x' * 101)
+        self.assertEqual(framer.dropped, 101)
+
+    def test_listener(self):
+        register_handlers()
+        listener = SyslogListener('127.0.0.1:0', '127.0.0.1:0', batch_size=3, max_latency=0.01)
+        batches = []
+        thread = threading.Thread(target=lambda: batches.extend(listener))
+        thread.start()
+        try:
+            line = '<22>Nov  1 06:25:09 f86adfc82f78 postfix/qmgr[40]: 7774E75F4: removed'
+            udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp.sendto(line + '\n', listener.udp.getsockname())
+            udp.close()
+
+            tcp = socket.create_connection(listener.tcp.getsockname())
+            tcp.sendall('{} {}{}\n'.format(len(line), line, line))
+            tcp.close()
+
+            deadline = time.time() + 5
+            while sum(len(batch) for batch in batches) < 3 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            listener.stop()
+            thread.join()
+
+        self.assertEqual(sorted(line for batch in batches for line in batch), [line] * 3)
+        self.assertEqual(parse_envelope(line)[2:], ('qmgr', '7774E75F4: removed'))
+
+
+class TestFollowReader(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp, 'mail.log')
+        self.checkpoint = os.path.join(self.tmp, 'mail.pos')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, data, path=None, mode='a'):
+        with open(path or self.log, mode) as f:
+            f.write(data)
+
+    def reader(self):
+        reader = FollowReader(self.log, max_latency=0.01, poll_interval=0.01, checkpoint=self.checkpoint)
+        reader.resume()  # iteration starts lazily
+        return reader
+
+    def test_rotation(self):
+        self.write('a\nb\n')
+        reader = self.reader()
+        lines = iter(reader)
+        self.write('c\n')
+        self.assertEqual(next(lines), ['c'])
+
+        os.rename(self.log, self.log + '.1')
+        self.write('d\ne', self.log + '.1')  # written before the logger reopened its file
+        self.write('ff\n')
+        self.assertEqual(next(lines), ['d', 'e'])
+        self.assertEqual(next(lines), ['ff'])
+
+        self.write('g\n', mode='w')  # copytruncate
+        self.assertEqual(next(lines), ['g'])
+
+        reader.stop()
+        self.assertEqual(list(lines), [])
+        self.assertEqual(reader.load_checkpoint(), (os.stat(self.log).st_ino, 2))
+
+    def test_resume(self):
+        self.write('a\n')
+        reader = self.reader()
+        lines = iter(reader)
+        self.write('b\nc')
+        self.assertEqual(next(lines), ['b'])
+        reader.stop()
+        self.assertEqual(list(lines), [])
+
+        # rotated while stopped
+        self.write('\nd\n')
+        os.rename(self.log, self.log + '.1')
+        self.write('e\n')
+        reader = self.reader()
+        lines = iter(reader)
+        self.assertEqual(next(lines), ['c', 'd'])
+        self.assertEqual(next(lines), ['e'])
+        reader.stop()
+        self.assertEqual(list(lines), [])
+
+        self.write('f\n')
+        reader = self.reader()
+        lines = iter(reader)
+        self.assertEqual(next(lines), ['f'])
+        reader.stop()
+        list(lines)
+
+
+class TestSinks(unittest.TestCase):
+    def test_parse_spec(self):
+        self.assertEqual(parse_spec('udp://127.0.0.1:8125'), ('udp', '127.0.0.1', 8125, None))
+        self.assertEqual(parse_spec('tcp://[::1]:9125'), ('tcp', '::1', 9125, None))
+        self.assertEqual(parse_spec('tcp://statsd'), ('tcp', 'statsd', 8125, None))
+        self.assertEqual(parse_spec('file:///var/log/metrics.jsonl'), ('file', None, None, '/var/log/metrics.jsonl'))
+        self.assertEqual(parse_spec('null'), ('null', None, None, None))
+        self.assertRaises(ValueError, parse_spec, 'http://localhost')
+        self.assertIsInstance(make_sink('null'), NullSink)
+
+    def test_file(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'metrics.jsonl')
+            sink = make_sink('file://' + path)
+            self.assertIsInstance(sink, FileSink)
+            with sink.pipeline() as pipe:
+                pipe.incr('postfix.messages.bounce', 2)
+                pipe.gauge('postfix.collector.queue_depth', 3)
+            sink.timing('postfix.delays.send', 1.5)
+            sink.close()
+
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual([(r['stat'], r['value'], r['type']) for r in records], [
+                ('postfix.messages.bounce', '2', 'c'),
+                ('postfix.collector.queue_depth', '3', 'g'),
+                ('postfix.delays.send', '1.500000', 'ms')])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_tcp_reconnect(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        sink = ReconnectingTCPClient(*server.getsockname())
+
+        with sink.pipeline() as pipe:
+            pipe.incr('a')
+            pipe.incr('b')
+        conn = server.accept()[0]
+        self.assertEqual(conn.recv(100), 'a:1|c\nb:1|c\n')
+        conn.close()
+
+        # the first send may still succeed into the broken connection, a later one reconnects
+        deadline = time.time() + 5
+        server.settimeout(0.1)
+        conn = None
+        while conn is None and time.time() < deadline:
+            sink.incr('c')
+            try:
+                conn = server.accept()[0]
+            except socket.timeout:
+                pass
+        self.assertIsNotNone(conn)
+        self.assertTrue(conn.recv(100).startswith('c:1|c\n'))
+        conn.close()
+        sink.close()
+        server.close()
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_parts(self):
+        stats = StatsAggregator()
+        stats.incr('postfix.messages.cleanup', 2)
+        tracker = MessageTracker(stats)
+        tracker.queued('7774E75F4', '980', '2')
+        tracker.cleanup('AC6937608')
+        gauges = GaugeSnapshot()
+        gauges.changes([('postfix.qshape.active.total.sum', 2)])
+        save_snapshot(self.path, dict(metrics=stats, tracker=tracker, qshape=gauges))
+
+        restored_stats = StatsAggregator()
+        restored_tracker = MessageTracker(restored_stats)
+        restored_gauges = GaugeSnapshot()
+        self.assertTrue(load_snapshot(self.path, dict(metrics=restored_stats, tracker=restored_tracker,
+                                                      qshape=restored_gauges)))
+        self.assertEqual(restored_stats.swap().counters['postfix.messages.cleanup'], 2)
+        self.assertEqual(sorted(restored_tracker.messages), ['7774E75F4', 'AC6937608'])
+        self.assertEqual(restored_gauges.changes([('postfix.qshape.active.total.sum', 2)]), [])
+
+        restored_tracker.removed('7774E75F4')
+        self.assertEqual(restored_stats.swap().timers['postfix.messages.lifecycle.size'], [980])
+
+        restored_tracker.reset(lambda message_id: message_id.startswith('A'))
+        self.assertEqual(list(restored_tracker.messages), ['AC6937608'])
+
+        with open(self.path, 'wb') as f:
+            f.write('garbage')
+        self.assertFalse(load_snapshot(self.path, dict(metrics=restored_stats)))
+
+    def test_restart(self):
+        with open('tests.mail.log') as f:
+            lines = f.readlines()[:10]
+        first = os.path.join(self.tmp, 'first.log')
+        second = os.path.join(self.tmp, 'second.log')
+        with open(first, 'w') as f:
+            f.writelines(line for line in lines if 'removed' not in line)
+        with open(second, 'w') as f:
+            f.writelines(line for line in lines if 'removed' in line)
+
+        logparser.tracker.reset()  # messages left by other tests
+        logparser.stats.swap()
+        client = mock.MagicMock()
+        pipe = client.pipeline.return_value.__enter__.return_value
+        with mock.patch('postfix_stats_collector.logparser.sink', client):
+            for log_file in (first, second):
+                logparser.process([log_file], concurrency=2, processes=True, track_messages=1000,
+                                  snapshot=self.path)
+                tracker = MessageTracker(StatsAggregator())
+                load_snapshot(self.path, dict(tracker=tracker))
+                if log_file == first:
+                    self.assertEqual(sorted(tracker.messages), ['7774E75F4', 'AC6937608'])
+                metrics = StatsAggregator()
+                load_snapshot(self.path, dict(metrics=metrics))
+                self.assertIn('postfix.collector.lines.read', metrics.swap().counters)  # saved, not flushed
+        self.assertEqual(len(tracker), 0)
+        self.assertNotIn(mock.call('postfix.messages.lifecycle.completed', 2), pipe.incr.mock_calls)
+        metrics = StatsAggregator()
+        load_snapshot(self.path, dict(metrics=metrics))
+        self.assertEqual(metrics.swap().counters['postfix.messages.lifecycle.completed'], 2)
+
+
+class TestExposition(unittest.TestCase):
+    @mock.patch('postfix_stats_collector.logparser.sink', mock.MagicMock())
+    def test_server_after_fork(self):
+        started = []
+
+        def pool(*args, **kwargs):
+            started.append('pool')
+            return ProcessParserPool(*args, **kwargs)
+
+        with mock.patch('postfix_stats_collector.logparser.ProcessParserPool', side_effect=pool), \
+                mock.patch('postfix_stats_collector.logparser.start_http_server',
+                           side_effect=lambda *args: started.append('http')):
+            try:
+                logparser.process(['tests.mail.log'], concurrency=2, processes=True, http_port=0)
+            finally:
+                logparser.registry = None
+        self.assertEqual(started, ['pool', 'http'])  # workers do not inherit the server
+
+    def test_registry(self):
+        stats = StatsAggregator()
+        registry = MetricsRegistry()
+        for i in xrange(2):
+            stats.incr('postfix.messages.bounce', 2)
+            stats.gauge('postfix.collector.queue_depth', i)
+            stats.timing('postfix.messages.lifecycle.delay', 100)
+            registry.update(stats.swap())
+        registry.set_gauges([('postfix.qshape.active.example_com.5', 3)], [('postfix.qshape.deferred.timeout', 1)])
+        registry.set_gauges([], [('postfix.qshape.deferred.timeout', 1)])
+
+        self.assertIn('postfix_messages_bounce_total 4\n', registry.openmetrics)
+        self.assertIn('# TYPE postfix_messages_bounce counter\n', registry.openmetrics)
+        self.assertIn('postfix_collector_queue_depth 1\n', registry.openmetrics)
+        self.assertIn('postfix_messages_lifecycle_delay_count 2\n', registry.openmetrics)
+        self.assertIn('postfix_messages_lifecycle_delay_sum 200.0\n', registry.openmetrics)
+        self.assertIn('postfix_qshape_active_example_com_5 3\n', registry.openmetrics)
+        self.assertIn('postfix_qshape_deferred_timeout_total 2\n', registry.openmetrics)
+        self.assertNotIn('postfix_qshape_deferred_timeout 1\n', registry.openmetrics)
+        self.assertTrue(registry.openmetrics.endswith('# EOF\n'))
+        self.assertIn('# TYPE postfix_messages_bounce_total counter\n', registry.prometheus)
+        self.assertNotIn('# EOF', registry.prometheus)
+
+    def test_http(self):
+        registry = MetricsRegistry()
+        registry.set_gauges([('postfix.qshape.active.total.sum', 6)])
+        server = start_http_server(registry, 0, '127.0.0.1')
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+            response = urllib2.urlopen(urllib2.Request(url, headers={'Accept': 'application/openmetrics-text'}))
+            self.assertIn('openmetrics', response.info()['Content-Type'])
+            self.assertIn('postfix_qshape_active_total_sum 6\n', response.read())
+            self.assertIn('text/plain', urllib2.urlopen(url).info()['Content-Type'])
+        finally:
+            server.shutdown()
+            server.server_close()
+
 
 if __name__ == '__main__':
     unittest.main()